@@ -1,35 +1,63 @@
 from app.db import get_db, Report
-from app.services import generator
-from app.utils import logger, cleanup, ReportStatusEnum
+from app.services import report_cache, scheduler, cancel_report, generate_store_report, batch_timestamps
+from app.services.file_service import check_format, convert_report, MEDIA_TYPES, EXTENSIONS, HEADINGS
+from app.services.blob_service import report_source, read_source
+from app.services.row_service import query_rows, MAX_LIMIT
+from app.services.timeline_service import parse_windows, format_windows, window_headings
+from app.utils import logger, blob_response, accepts_gzip, ReportStatusEnum, ReportFormatEnum
 
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
-from fastapi import APIRouter, Depends, BackgroundTasks, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Depends, HTTPException, Request, Query
 
 from datetime import datetime
-from typing import Optional
-import os, traceback
+from typing import Optional, List
+import traceback, uuid
 
 router = APIRouter()
 
 
-# API for triggering a new report generation
+# API for triggering a new report generation, reports with higher priority are generated first
+# Optional windows like 15m,4h,30d replace the default hour, day and week columns
 @router.post("/trigger")
-async def trigger_report(background_tasks: BackgroundTasks, timestamp: Optional[datetime] = None, db: AsyncSession = Depends(get_db)):
+async def trigger_report(timestamp: Optional[datetime] = None, format: ReportFormatEnum = ReportFormatEnum.csv, priority: int = 0, windows: Optional[str] = None, db: AsyncSession = Depends(get_db)):
     try:
-        
-        report = Report(status=ReportStatusEnum.Running)
+        try:
+            check_format(format)
+            windows = format_windows(parse_windows(windows)) if windows else None
+        except ValueError as error:
+            raise HTTPException(
+                status_code=400,
+                detail=str(error)
+            )
+
+        key = report_cache.key(timestamp, format, windows)
+
+        # Identical report already finished or being generated
+        report_id = await report_cache.lookup(key)
+        if report_id is not None:
+            return report_id
+
+        report_cache.reserve(key)
 
-        if timestamp is not None:
-            report.created_at = timestamp
+        try:
+            report = Report(status=ReportStatusEnum.Queued, created_at=key[0], format=format, priority=priority, windows=windows)
 
-        db.add(report)
-        await db.commit()
-        await db.refresh(report)
-        background_tasks.add_task(generator, report.id)
+            db.add(report)
+            await db.commit()
+            await db.refresh(report)
+
+        except Exception as error:
+            report_cache.release(key, error)
+            raise
+
+        report_cache.start(key, report.id)
+        scheduler.wake()
         return report.id
+
+    except HTTPException:
+        raise
     
     except Exception as _:
         tb = traceback.format_exc()
@@ -43,12 +71,156 @@ async def trigger_report(background_tasks: BackgroundTasks, timestamp: Optional[
         await db.close()
 
 
+# API for triggering reports of many timestamps, e.g. every hour of a month, as a list or a range from start to end every step seconds
+# New reports share a batch and are generated together with one scan over the union of their windows
+@router.post("/trigger/batch")
+async def trigger_batch(
+    timestamps: Optional[List[datetime]] = Query(None),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    step: int = 3600,
+    format: ReportFormatEnum = ReportFormatEnum.csv,
+    priority: int = 0,
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        try:
+            check_format(format)
+            timestamps = batch_timestamps(timestamps, start, end, step)
+        except ValueError as error:
+            raise HTTPException(
+                status_code=400,
+                detail=str(error)
+            )
+
+        keys = list(dict.fromkeys(report_cache.key(timestamp, format) for timestamp in timestamps))
+
+        # Timestamps with a finished or in-flight report reuse it
+        report_ids, reserved = {}, []
+        for key in keys:
+            report_id = await report_cache.lookup(key)
+            if report_id is not None:
+                report_ids[key] = report_id
+            else:
+                report_cache.reserve(key)
+                reserved.append(key)
+
+        try:
+            batch_id = str(uuid.uuid4())
+            new_ids = {key: str(uuid.uuid4()) for key in reserved}
+
+            db.add_all([
+                Report(id=new_ids[key], status=ReportStatusEnum.Queued, created_at=key[0], format=format, priority=priority, batch_id=batch_id)
+                for key in reserved
+            ])
+            await db.commit()
+
+        except Exception as error:
+            for key in reserved:
+                report_cache.release(key, error)
+            raise
+
+        for key in reserved:
+            report_ids[key] = new_ids[key]
+            report_cache.start(key, new_ids[key])
+
+        scheduler.wake()
+        return [{"timestamp": key[0], "id": report_ids[key]} for key in keys]
+
+    except HTTPException:
+        raise
+
+    except Exception as _:
+        tb = traceback.format_exc()
+        logger.error(tb)
+        raise HTTPException(
+            status_code=500,
+            detail="Internal Server Error"
+        )
+
+    finally:
+        await db.close()
+
+
 # API for fetching actual report
 @router.get("/get")
-async def get_report(id: str, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db)):
+async def get_report(id: str, request: Request, format: Optional[ReportFormatEnum] = None, db: AsyncSession = Depends(get_db)):
     try:
-        result = await db.execute(select(Report).filter(Report.id == id))
-        report = result.scalars().first()
+        # Recently finished reports are served without touching the db
+        cached = report_cache.get(id)
+
+        if cached is not None:
+            key, blob_key = cached
+            file, stored_format, windows = None, key[1], key[2] if len(key) > 2 else None
+        else:
+            result = await db.execute(select(Report.status, Report.format, Report.windows, Report.blob_key, Report.file).filter(Report.id == id))
+            report = result.first()
+
+            if not report:
+                raise HTTPException(
+                    status_code=404,
+                    detail="Report not found"
+                )
+
+            # Queued, Running, Cancelled or Failed
+            if report.status != ReportStatusEnum.Completed:
+                return report.status
+
+            blob_key, file, stored_format, windows = report.blob_key, report.file, report.format, report.windows
+
+        # Files in a local blob store are sent by the server straight from disk
+        try:
+            file = report_source(blob_key, file)
+        except FileNotFoundError:
+            raise HTTPException(
+                status_code=404,
+                detail="Report expired"
+            )
+
+        format = format or stored_format
+        etag = f'"{id}-{format.value}"'   # Reports never change once completed
+
+        # Compressed csv is sent as is to clients accepting gzip
+        if stored_format == ReportFormatEnum.csv_gzip and format == ReportFormatEnum.csv and accepts_gzip(request):
+            return blob_response(request, file, f"{id}.csv", etag=etag, encoding="gzip")
+
+        try:
+            if format != stored_format:
+                headings = window_headings(parse_windows(windows)) if windows else HEADINGS
+                file = convert_report(read_source(file), stored_format, format, headings)
+        except ValueError as error:
+            raise HTTPException(
+                status_code=400,
+                detail=str(error)
+            )
+
+        # Stream the BLOB in chunks
+        return blob_response(request, file, f"{id}.{EXTENSIONS[format]}", etag=etag, media_type=MEDIA_TYPES[format])
+
+    except HTTPException:
+        raise
+
+    except Exception as _:
+        tb = traceback.format_exc()
+        logger.error(tb)
+        raise HTTPException(
+            status_code=500,
+            detail="Internal Server Error"
+        )
+    
+    finally:
+        await db.close()
+
+
+# API for the status and progress percentage of a report
+@router.get("/progress")
+async def get_progress(id: str, db: AsyncSession = Depends(get_db)):
+    try:
+        result = await db.execute(select(
+            Report.status, Report.progress, Report.priority, Report.error,
+            Report.queued_at, Report.started_at, Report.finished_at
+        ).filter(Report.id == id))
+        report = result.first()
 
         if not report:
             raise HTTPException(
@@ -56,25 +228,70 @@ async def get_report(id: str, background_tasks: BackgroundTasks, db: AsyncSessio
                 detail="Report not found"
             )
 
-        if report.status == ReportStatusEnum.Running:
-            return ReportStatusEnum.Running
-        
-        # Save the BLOB content as a temporary CSV file
-        current_path = os.path.abspath(os.path.join(os.path.dirname(__file__)))
-        file_path = os.path.join(current_path, f"{report.id}.csv")
-        with open(file_path, "wb") as f:
-            f.write(report.file)
-
-        # Executed only after response is sent
-        background_tasks.add_task(cleanup, file_path)
-
-        # Return the CSV file as a response
-        return FileResponse(
-            path=file_path,
-            media_type="text/csv",
-            filename=f"{report.id}.csv"
+        return {"id": id, **report._asdict()}
+
+    except HTTPException:
+        raise
+
+    except Exception as _:
+        tb = traceback.format_exc()
+        logger.error(tb)
+        raise HTTPException(
+            status_code=500,
+            detail="Internal Server Error"
         )
 
+    finally:
+        await db.close()
+
+
+# API for querying the per store rows of a completed report
+# filter like downtime_last_day:gte:2 (repeatable), sort like -downtime_last_day, fields like store_id,downtime_last_day
+# Pages follow the next cursor of the previous page, a cursor is only valid with the same sort and filters
+@router.get("/{id}/rows")
+async def get_report_rows(
+    id: str,
+    filter: Optional[List[str]] = Query(None),
+    sort: Optional[str] = None,
+    fields: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=MAX_LIMIT),
+    after: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        result = await db.execute(select(Report.status, Report.row_count).filter(Report.id == id))
+        report = result.first()
+
+        if not report:
+            raise HTTPException(
+                status_code=404,
+                detail="Report not found"
+            )
+
+        # Queued, Running, Cancelled or Failed
+        if report.status != ReportStatusEnum.Completed:
+            return report.status
+
+        # Reports with custom windows or finished before rows were stored
+        if report.row_count is None:
+            raise HTTPException(
+                status_code=404,
+                detail="Rows are not stored for this report"
+            )
+
+        try:
+            rows, cursor = await query_rows(db, id, fields, filter, sort, limit, after)
+        except ValueError as error:
+            raise HTTPException(
+                status_code=400,
+                detail=str(error)
+            )
+
+        return {"report_id": id, "total": report.row_count, "rows": rows, "next": cursor}
+
+    except HTTPException:
+        raise
+
     except Exception as _:
         tb = traceback.format_exc()
         logger.error(tb)
@@ -82,6 +299,58 @@ async def get_report(id: str, background_tasks: BackgroundTasks, db: AsyncSessio
             status_code=500,
             detail="Internal Server Error"
         )
-    
+
     finally:
-        await db.close()
\ No newline at end of file
+        await db.close()
+
+
+# API for cancelling a queued or running report
+@router.post("/cancel")
+async def cancel(id: str):
+    try:
+        status = await cancel_report(id)
+
+        if status is None:
+            raise HTTPException(
+                status_code=404,
+                detail="Report not found"
+            )
+
+        return status
+
+    except HTTPException:
+        raise
+
+    except Exception as _:
+        tb = traceback.format_exc()
+        logger.error(tb)
+        raise HTTPException(
+            status_code=500,
+            detail="Internal Server Error"
+        )
+
+
+# API computing the report of a single store on demand, without queueing a report of all stores
+@router.get("/store/{store_id}")
+async def get_store_report(store_id: str, timestamp: Optional[datetime] = None):
+    try:
+        report = await generate_store_report(store_id, timestamp)
+
+        if report is None:
+            raise HTTPException(
+                status_code=404,
+                detail="Store not found"
+            )
+
+        return report
+
+    except HTTPException:
+        raise
+
+    except Exception as _:
+        tb = traceback.format_exc()
+        logger.error(tb)
+        raise HTTPException(
+            status_code=500,
+            detail="Internal Server Error"
+        )
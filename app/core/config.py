@@ -4,6 +4,34 @@ class Settings(BaseSettings):
     DATABASE_URL: str
     POOL_SIZE: int = 12
     DOWNTIME_OFFSET: int = 5
+    ENGINE: str = "python"          # python | numpy | rollup | timeline | sql
+    VERIFY_ENGINE: bool = False     # Cross check ENGINE against the python engine
+    FETCH_MODE: str = "all"         # all | stream | copy | snapshot
+    STREAM_CHUNK_SIZE: int = 50000
+    SHARD_COUNT: int = 1            # Worker processes for processing queries, 1 processes in the event loop
+    ROLLUP_INTERVAL: int = 300      # Seconds between hourly rollup refreshes
+    REPORT_CACHE_SIZE: int = 32     # Finished reports kept in memory, 0 disables caching
+    REPORT_CACHE_TTL: int = 600     # Seconds
+    REPORT_CACHE_RESOLUTION: int = 60   # Triggers within the same number of seconds share a report
+    INGEST_WORKERS: int = 4         # Parallel COPY connections of the ingestion script
+    INGEST_CHUNK_SIZE: int = 64 * 1024 * 1024   # Bytes of csv per COPY
+    STATUS_RETENTION_DAYS: int = 0  # Day partitions of store_status kept by ingestion, 0 keeps all
+    SNAPSHOT_DIR: str = ""          # Columnar day files of store_status written by ingestion, empty writes none
+    REPORT_WORKERS: int = 2         # Worker processes generating reports, 0 generates in the event loop
+    SCHEDULER_POLL_INTERVAL: int = 5    # Seconds between checks of the queue for reports queued by other servers
+    REPORT_LEASE_SECONDS: int = 120 # Running reports whose server sent no heartbeat for this long are queued again, well above SCHEDULER_POLL_INTERVAL
+    BATCH_MAX_REPORTS: int = 1000   # Timestamps accepted by one batch trigger
+    BATCH_PASS_REPORTS: int = 100   # Reports written by one scan of a batch, each holds up to two open files
+    REPORT_MAX_WINDOW_DAYS: int = 90    # Longest custom report window
+    TIMELINE_RETAIN_DAYS: int = 14  # Days of polls before the oldest needed one kept in cached timelines
+    DELTA_MAX_MINUTES: int = 0      # Python engine reports start from the state of a report up to this many minutes older, 0 saves no state
+    BLOB_STORE: str = "local"       # local, where report files are kept
+    BLOB_DIR: str = "blobs"         # Directory of the local blob store, shared by servers and workers
+    REPORT_RETENTION_DAYS: int = 0  # Finished reports older than this are deleted with their files, 0 keeps all
+    REPORT_RETENTION_COUNT: int = 0 # Newest finished reports kept, 0 keeps all
+    RETENTION_INTERVAL: int = 3600  # Seconds between retention runs
+    REPORT_ROWS: bool = True        # Store per store rows of completed reports for /report/{id}/rows
+    LOOP_LAG_INTERVAL: float = 0.5  # Seconds between event loop lag samples, 0 disables
 
     class Config:
         env_file = ".env"
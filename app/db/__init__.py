@@ -1,2 +1,2 @@
 from .database import get_db, create_tables
-from .models import Report, StoreHours, StoreStatus, Store
\ No newline at end of file
+from .models import Report, StoreHours, StoreStatus, Store, IngestionState, StoreStatusHourly, ReportRow, REPORT_ROW_METRICS
\ No newline at end of file
@@ -1,12 +1,34 @@
 from .models import Base
 from app.core import settings
+from app.utils.metrics import db_pool_checkout_seconds, db_pool_timeouts_total
 
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.exc import TimeoutError
+
+import time
+
+
+# Pool recording checkout latency and exhaustion
+class TimedQueuePool(AsyncAdaptedQueuePool):
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            db_pool_timeouts_total.inc()
+            raise
+        finally:
+            db_pool_checkout_seconds.observe(time.perf_counter() - start)
+
 
 # Create engine, define maximum concurrent connections
 engine = create_async_engine(
     settings.DATABASE_URL,
+    poolclass=TimedQueuePool,
     pool_size=settings.POOL_SIZE,
     max_overflow=2*settings.POOL_SIZE,
     echo=False
@@ -28,7 +50,35 @@ async def get_db():
         finally:
             await session.close()
 
+# Enum values and columns added after tables were first created, create_all does not alter existing tables
+UPGRADES = [
+    "ALTER TYPE reportstatusenum ADD VALUE IF NOT EXISTS 'Queued'",
+    "ALTER TYPE reportstatusenum ADD VALUE IF NOT EXISTS 'Cancelled'",
+    "ALTER TYPE reportstatusenum ADD VALUE IF NOT EXISTS 'Failed'",
+    "DO $$ BEGIN CREATE TYPE reportformatenum AS ENUM ('csv', 'csv_gzip', 'parquet', 'arrow'); EXCEPTION WHEN duplicate_object THEN NULL; END $$",
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS format reportformatenum NOT NULL DEFAULT 'csv'",
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS priority INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS progress INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS error VARCHAR",
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS queued_at TIMESTAMP WITH TIME ZONE DEFAULT now()",
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS started_at TIMESTAMP WITH TIME ZONE",
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS finished_at TIMESTAMP WITH TIME ZONE",
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS batch_id VARCHAR",
+    "CREATE INDEX IF NOT EXISTS ix_reports_batch_id ON reports (batch_id)",
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS windows VARCHAR",
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS state BYTEA",
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS blob_key VARCHAR",
+    "CREATE INDEX IF NOT EXISTS ix_reports_blob_key ON reports (blob_key)",
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS row_count INTEGER",
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS owner VARCHAR",
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP WITH TIME ZONE",
+]
+
 # Create tables if they don't already exist
 async def create_tables():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with engine.begin() as conn:
+        for statement in UPGRADES:
+            await conn.execute(text(statement))
\ No newline at end of file
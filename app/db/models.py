@@ -1,6 +1,6 @@
-from app.utils import StatusEnum, ReportStatusEnum
+from app.utils import StatusEnum, ReportStatusEnum, ReportFormatEnum
 
-from sqlalchemy import Column, Integer, String, CHAR, DateTime, CheckConstraint, Enum, Time, LargeBinary
+from sqlalchemy import Column, Integer, String, CHAR, DateTime, CheckConstraint, Enum, Time, LargeBinary, Float, Index, ForeignKey, BigInteger, SmallInteger
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 
@@ -26,21 +26,85 @@ class StoreHours(Base):
     end_time_local = Column(Time, nullable=False)
 
 
+# Range partitioned by day on timestamp, partitions are created and dropped by ingestion
 class StoreStatus(Base):
     __tablename__ = "store_status"
+    __table_args__ = (
+        Index("idx_store_status_store_timestamp", "store_id", "timestamp", postgresql_include=["status"]),
+        Index("idx_timestamp", "timestamp"),
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     store_id = Column(CHAR(36), nullable=False)
     status = Column(Enum(StatusEnum), nullable=False)
-    timestamp = Column(DateTime(timezone=True), nullable=False, index=True)
+    timestamp = Column(DateTime(timezone=True), primary_key=True)  # Partition key must be part of the primary key
 
 
+class StoreStatusHourly(Base):
+    __tablename__ = "store_status_hourly"
+
+    store_id = Column(CHAR(36), primary_key=True)
+    hour = Column(DateTime(timezone=True), primary_key=True, index=True)  # UTC start of hour
+    uptime_minutes = Column(Float, nullable=False, default=0)    # Of the intervals closed by polls in the hour
+    downtime_minutes = Column(Float, nullable=False, default=0)
+    last_wall = Column(BigInteger, nullable=False)  # Last poll of the hour in store hours, local wall clock and utc epoch microseconds
+    last_utc = Column(BigInteger, nullable=False)
+    last_status = Column(Enum(StatusEnum), nullable=False)
+    last_fold = Column(SmallInteger, nullable=False)
+
+
+# Also the queue of the report scheduler, queued reports run by priority then queued_at
 class Report(Base):
     __tablename__ = "reports"
 
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    file = Column(LargeBinary, nullable=True)
+    file = Column(LargeBinary, nullable=True)               # Reports finished before the blob store, moved out by the retention job
+    blob_key = Column(String, nullable=True, index=True)    # Key of the report file in the blob store
+    row_count = Column(Integer, nullable=True)              # Rows stored in report_rows, None if the report has none
     status = Column(Enum(ReportStatusEnum), nullable=False)
+    format = Column(Enum(ReportFormatEnum), nullable=False, default=ReportFormatEnum.csv)
     created_at = Column(DateTime(timezone=True), default=func.now())
-
-
+    priority = Column(Integer, nullable=False, default=0, server_default="0")  # Higher runs first
+    progress = Column(Integer, nullable=False, default=0, server_default="0")  # Percent
+    error = Column(String, nullable=True)
+    queued_at = Column(DateTime(timezone=True), default=func.now(), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    owner = Column(String, nullable=True)                   # Server generating a running report
+    heartbeat_at = Column(DateTime(timezone=True), nullable=True)  # Renewed by the owner, running reports whose lease expired are queued again
+    batch_id = Column(String, nullable=True, index=True)    # Reports of a batch trigger are claimed and generated together
+    windows = Column(String, nullable=True)                 # Custom report windows like 15m,4h,30d, default columns if empty
+    state = Column(LargeBinary, nullable=True)              # Per store state behind the report, later reports slide it with DELTA_MAX_MINUTES
+
+# Metrics of completed reports, one row per store, served by /report/{id}/rows
+REPORT_ROW_METRICS = [
+    "uptime_last_hour", "uptime_last_day", "uptime_last_week",
+    "downtime_last_hour", "downtime_last_day", "downtime_last_week",
+]
+
+
+# Per store rows of completed reports with the default columns, deleted with their report
+# Every metric is indexed after report_id, so sorting and keyset pages by any metric are index scans
+class ReportRow(Base):
+    __tablename__ = "report_rows"
+    __table_args__ = tuple(
+        Index(f"ix_report_rows_{metric}", "report_id", metric, "store_id") for metric in REPORT_ROW_METRICS
+    )
+
+    report_id = Column(String, ForeignKey("reports.id", ondelete="CASCADE"), primary_key=True)
+    store_id = Column(CHAR(36), primary_key=True)
+    uptime_last_hour = Column(Integer, nullable=False)      # Minutes
+    uptime_last_day = Column(Integer, nullable=False)       # Hours
+    uptime_last_week = Column(Integer, nullable=False)
+    downtime_last_hour = Column(Integer, nullable=False)    # Minutes
+    downtime_last_day = Column(Integer, nullable=False)     # Hours
+    downtime_last_week = Column(Integer, nullable=False)
+
+
+class IngestionState(Base):
+    __tablename__ = "ingestion_state"
+
+    key = Column(String, primary_key=True)
+    value = Column(String, nullable=True)
+    updated_at = Column(DateTime(timezone=True), default=func.now(), onupdate=func.now())
@@ -1,4 +1,6 @@
-import psycopg2, os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import psycopg2, os, argparse, re, time
 from urllib.parse import urlparse
 from app.core.config import settings
 
@@ -29,17 +31,7 @@ def get_connection():
     except Exception as error:
         print(f"Error: {error}")
         return False
-    
-conn = get_connection()
 
-if conn:
-    print("Connection to the PostgreSQL established successfully.")
-else:
-    print("Connection to the PostgreSQL encountered an error.")
-
-
-curr = conn.cursor()
-print("Cursor created.")
 
 # Determine the root of the project (two levels up from 'app' folder)
 current_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "csv/"))
@@ -64,50 +56,508 @@ create_timezones_table_query = """
 """
 
 create_store_status_query = """
-    CREATE TYPE status AS ENUM ('active', 'inactive');
+    DO $$ BEGIN
+        CREATE TYPE status AS ENUM ('active', 'inactive');
+    EXCEPTION
+        WHEN duplicate_object THEN NULL;
+    END $$;
     CREATE TABLE IF NOT EXISTS store_status (
-        id SERIAL PRIMARY KEY,
+        id SERIAL,
+        store_id VARCHAR(36),
+        status status,
+        timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+        PRIMARY KEY (id, timestamp)
+    ) PARTITION BY RANGE (timestamp);
+"""
+
+# One partition per UTC day, old days are dropped whole for retention
+create_partition_query = """
+    CREATE TABLE IF NOT EXISTS {name} PARTITION OF store_status
+    FOR VALUES FROM ('{start} 00:00:00+00') TO ('{end} 00:00:00+00');
+"""
+
+select_partitions_query = """
+    SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'store_status'::regclass;
+"""
+
+PARTITION_PREFIX = "store_status_p"
+
+create_ingestion_state_table_query = """
+    CREATE TABLE IF NOT EXISTS ingestion_state (
+        key VARCHAR PRIMARY KEY,
+        value VARCHAR,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+    );
+"""
+
+# Csv chunks are copied here in parallel and merged into the real tables in one transaction
+create_staging_tables_query = """
+    CREATE UNLOGGED TABLE IF NOT EXISTS stores_staging (
+        store_id VARCHAR(36),
+        timezone_str VARCHAR(50)
+    );
+    CREATE UNLOGGED TABLE IF NOT EXISTS store_hours_staging (
+        store_id VARCHAR(36),
+        day_of_week INT,
+        start_time_local TIME,
+        end_time_local TIME
+    );
+    CREATE UNLOGGED TABLE IF NOT EXISTS store_status_staging (
         store_id VARCHAR(36),
         status status,
         timestamp TIMESTAMP WITH TIME ZONE
     );
+    TRUNCATE stores_staging, store_hours_staging, store_status_staging;
+"""
+
+# Reports read (store_id, timestamp, status) of a week with index only scans of the covering index
+create_indices_query = """
+    CREATE INDEX IF NOT EXISTS idx_store_id ON store_hours(store_id);
+    CREATE INDEX IF NOT EXISTS idx_timestamp ON store_status(timestamp);
+    CREATE INDEX IF NOT EXISTS idx_store_status_store_timestamp ON store_status(store_id, timestamp) INCLUDE (status);
 """
 
-curr.execute(create_store_hours_table_query)
-curr.execute(create_timezones_table_query)
-curr.execute(create_store_status_query)
-print("Table created.")
+# Secondary indexes of a table, constraint indexes are left alone
+select_indices_query = """
+    SELECT indexname, indexdef FROM pg_indexes
+    WHERE schemaname = current_schema() AND tablename = %s
+    AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass);
+"""
 
-timezones_file_path = os.path.join(current_path, "timezones.csv")
-with open(timezones_file_path, 'r') as f:
-    curr.copy_expert(
-        "COPY stores (store_id, timezone_str) FROM stdin WITH CSV HEADER", f
-    )
+# Only one ingestion at a time, the staging tables are shared
+lock_query = """SELECT pg_advisory_lock(hashtext('ingestion'));"""
 
-store_hours_file_path = os.path.join(current_path, "menu_hours.csv")
-with open(store_hours_file_path, 'r') as f:
-    curr.copy_expert(
-        "COPY store_hours (store_id, day_of_week, start_time_local, end_time_local) FROM stdin WITH CSV HEADER", f
-    )
+truncate_query = """TRUNCATE stores, store_hours RESTART IDENTITY;"""
 
-store_status_file_path = os.path.join(current_path, "store_status.csv")
-with open(store_status_file_path, 'r') as f:
-    curr.copy_expert(
-        "COPY store_status (store_id, status, timestamp) FROM stdin WITH CSV HEADER", f
-    )
+merge_stores_query = """
+    INSERT INTO stores (store_id, timezone_str)
+    SELECT DISTINCT ON (store_id) store_id, timezone_str FROM stores_staging
+    ON CONFLICT (store_id) DO UPDATE SET timezone_str = EXCLUDED.timezone_str;
+"""
 
-# curr.execute(add_missing_store_ids_query)
-create_indices_query = """
-    CREATE INDEX idx_store_id ON store_hours(store_id);
-    CREATE INDEX idx_timestamp ON store_status(timestamp);
+# Hours of a store in the file replace all its previous hours
+merge_store_hours_query = """
+    DELETE FROM store_hours WHERE store_id IN (SELECT store_id FROM store_hours_staging);
+    INSERT INTO store_hours (store_id, day_of_week, start_time_local, end_time_local)
+    SELECT DISTINCT store_id, day_of_week, start_time_local, end_time_local FROM store_hours_staging;
+"""
+
+# Polls at or before the watermark were loaded by an earlier run, a re-delivered one is ignored even if its status changed
+merge_store_status_query = """
+    INSERT INTO store_status (store_id, status, timestamp)
+    SELECT DISTINCT store_id, status, timestamp FROM store_status_staging
+    WHERE timestamp IS NOT NULL AND (%(watermark)s::timestamptz IS NULL OR timestamp > %(watermark)s::timestamptz)
+    AND (timestamp AT TIME ZONE 'UTC')::date <> ALL(%(detached)s::date[]);
+"""
+
+# Day table loaded outside store_status, the check lets attaching it skip the scan of its rows
+create_detached_query = """
+    CREATE TABLE {name} (LIKE store_status INCLUDING DEFAULTS);
+    ALTER TABLE {name} ADD CONSTRAINT {name}_day CHECK (timestamp >= '{start} 00:00:00+00' AND timestamp < '{end} 00:00:00+00');
+"""
+
+merge_detached_query = """
+    INSERT INTO {name} (store_id, status, timestamp)
+    SELECT DISTINCT store_id, status, timestamp FROM store_status_staging
+    WHERE timestamp >= '{start} 00:00:00+00' AND timestamp < '{end} 00:00:00+00'
+    AND (%(watermark)s::timestamptz IS NULL OR timestamp > %(watermark)s::timestamptz);
+"""
+
+# Attaching needs no lock that blocks reports reading store_status, indexes matching the parent's become its partitions
+attach_partition_query = """
+    ALTER TABLE store_status ATTACH PARTITION {name} FOR VALUES FROM ('{start} 00:00:00+00') TO ('{end} 00:00:00+00');
+"""
+
+upsert_state_query = """
+    INSERT INTO ingestion_state (key, value, updated_at) VALUES (%s, %s, now())
+    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at;
 """
 
-curr.execute(create_indices_query)
+# stores and store_hours changed, running servers reload their metadata cache on next report
+bump_metadata_version_query = """
+    INSERT INTO ingestion_state (key, value, updated_at) VALUES ('metadata_version', now()::text, now())
+    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at;
+"""
+
+WATERMARK_KEY = "store_status_watermark"
+ROLLUP_WATERMARK_KEY = "rollup_watermark"
+
+# New days are loaded into tables indexed after their rows instead of maintained row by row when a load adds more than this share of rows
+DEFER_INDEX_RATIO = 0.2
+
+# file: (staging table, columns)
+CSV_FILES = {
+    "timezones.csv": ("stores_staging", "store_id, timezone_str"),
+    "menu_hours.csv": ("store_hours_staging", "store_id, day_of_week, start_time_local, end_time_local"),
+    "store_status.csv": ("store_status_staging", "store_id, status, timestamp"),
+}
+
+
+# Byte ranges [start, end) of a csv file split on line boundaries, header excluded
+def chunk_ranges(path: str, chunk_size: int):
+
+    size = os.path.getsize(path)
+    ranges = []
+
+    with open(path, 'rb') as f:
+        f.readline()
+        start = f.tell()
+
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = f.tell()
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+
+# File like view of bytes [start, end) of a file, for COPY FROM stdin
+class FileChunk:
+
+    def __init__(self, path: str, start: int, end: int):
+        self.file = open(path, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+
+
+    def read(self, size: int = -1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+    def close(self):
+        self.file.close()
+
+
+# COPY one chunk of a csv file into a staging table on its own connection
+def copy_chunk(path: str, start: int, end: int, table: str, columns: str):
+
+    conn = get_connection()
+    if not conn:
+        raise RuntimeError("Connection to the PostgreSQL encountered an error.")
+
+    chunk = FileChunk(path, start, end)
+    try:
+        curr = conn.cursor()
+        curr.copy_expert(f"COPY {table} ({columns}) FROM stdin WITH CSV", chunk)
+        rows = curr.rowcount
+        conn.commit()
+        return rows
+
+    finally:
+        chunk.close()
+        conn.close()
+
+
+# Copy a csv file into its staging table in parallel chunks
+def copy_file(path: str, table: str, columns: str, workers: int, chunk_size: int):
+
+    start = time.perf_counter()
+    ranges = chunk_ranges(path, chunk_size)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        rows = sum(executor.map(lambda r: copy_chunk(path, r[0], r[1], table, columns), ranges))
+
+    seconds = time.perf_counter() - start
+    print(f"Copied {rows} rows of {os.path.basename(path)} in {len(ranges)} chunks, {seconds:.2f}s ({rows / max(seconds, 1e-9):.0f} rows/s).")
+    return {"rows": rows, "chunks": len(ranges), "seconds": seconds}
+
+
+# Drop secondary indexes of table, returns their definitions to rebuild them after the load
+def drop_indices(curr, table: str):
+
+    curr.execute(select_indices_query, (table, table))
+    indices = curr.fetchall()
+
+    for name, _ in indices:
+        curr.execute(f'DROP INDEX IF EXISTS "{name}";')
+
+    # Indexes of a partitioned table are listed ON ONLY the parent, rebuilt they must cover all partitions
+    return [definition.replace(" ON ONLY ", " ON ", 1) for _, definition in indices]
+
+
+# Create day partitions of store_status for every day between the first and last poll of table after a timestamp
+def create_partitions(curr, table: str, after = None):
+
+    curr.execute(f"""
+        SELECT min(timestamp AT TIME ZONE 'UTC')::date, max(timestamp AT TIME ZONE 'UTC')::date FROM {table}
+        WHERE %(after)s::timestamptz IS NULL OR timestamp > %(after)s::timestamptz;
+    """, {"after": after})
+    first, last = curr.fetchone()
+    if first is None:
+        return []
+
+    names = []
+    day = first
+    while day <= last:
+        name = PARTITION_PREFIX + day.strftime("%Y%m%d")
+        curr.execute(create_partition_query.format(name=name, start=day.isoformat(), end=(day + timedelta(days=1)).isoformat()))
+        names.append(name)
+        day += timedelta(days=1)
+
+    return names
+
+
+# Load the polls of new days into tables of their own, index them like store_status and attach them as its partitions
+# Reports keep reading store_status meanwhile, days that already have a partition are left to the merge into store_status
+def load_detached_partitions(curr, table: str, after = None):
+
+    curr.execute(f"""
+        SELECT min(timestamp AT TIME ZONE 'UTC')::date, max(timestamp AT TIME ZONE 'UTC')::date FROM {table}
+        WHERE %(after)s::timestamptz IS NULL OR timestamp > %(after)s::timestamptz;
+    """, {"after": after})
+    first, last = curr.fetchone()
+    if first is None:
+        return [], 0
+
+    curr.execute(select_partitions_query)
+    existing = {name for (name,) in curr.fetchall()}
+
+    curr.execute(select_indices_query, ("store_status", "store_status"))
+    indices = [definition for _, definition in curr.fetchall()]
+    curr.execute("SELECT pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = 'store_status'::regclass AND contype = 'p';")
+    primary_keys = [definition for (definition,) in curr.fetchall()]
+
+    names, inserted = [], 0
+    day = first
+    while day <= last:
+        name = PARTITION_PREFIX + day.strftime("%Y%m%d")
+        bounds = {"name": name, "start": day.isoformat(), "end": (day + timedelta(days=1)).isoformat()}
+        day += timedelta(days=1)
+        if name in existing:
+            continue
+
+        curr.execute(create_detached_query.format(**bounds))
+        curr.execute(merge_detached_query.format(**bounds), {"watermark": after})
+        inserted += curr.rowcount
+
+        for definition in primary_keys:
+            curr.execute(f"ALTER TABLE {name} ADD {definition};")
+        for definition in indices:
+            curr.execute(re.sub(r"^CREATE (UNIQUE )?INDEX \S+ ON ONLY \S+", rf"CREATE \1INDEX ON {name}", definition))
+
+        curr.execute(attach_partition_query.format(**bounds))
+        names.append(name)
+
+    return names, inserted
+
+
+# UTC day of a partition from its name
+def partition_day(name: str):
+    return datetime.strptime(name[len(PARTITION_PREFIX):], "%Y%m%d").date()
+
+
+# Move a store_status table created before partitioning into day partitions
+def partition_legacy_table(curr):
+
+    curr.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('store_status');")
+    row = curr.fetchone()
+    if row is None or row[0] == 'p':
+        return
+
+    print("Partitioning existing store_status table.")
+    drop_indices(curr, "store_status")
+    curr.execute("SELECT conname FROM pg_constraint WHERE conrelid = 'store_status'::regclass AND contype = 'p';")
+    for (name,) in curr.fetchall():
+        curr.execute(f'ALTER TABLE store_status DROP CONSTRAINT "{name}";')
+    curr.execute("ALTER TABLE store_status RENAME TO store_status_unpartitioned;")
+
+    curr.execute(create_store_status_query)
+    create_partitions(curr, "store_status_unpartitioned")
+    curr.execute("""
+        INSERT INTO store_status (store_id, status, timestamp)
+        SELECT store_id, status, timestamp FROM store_status_unpartitioned WHERE timestamp IS NOT NULL;
+    """)
+    curr.execute("DROP TABLE store_status_unpartitioned;")
+
+
+# Drop whole day partitions before the last retention_days days of polls
+def drop_old_partitions(curr, retention_days: int):
+
+    curr.execute("SELECT max(timestamp AT TIME ZONE 'UTC')::date FROM store_status;")
+    last = curr.fetchone()[0]
+    if last is None or retention_days <= 0:
+        return []
+
+    cutoff = PARTITION_PREFIX + (last - timedelta(days=retention_days - 1)).strftime("%Y%m%d")
+
+    curr.execute(select_partitions_query)
+    dropped = sorted(name for (name,) in curr.fetchall() if name.startswith(PARTITION_PREFIX) and name < cutoff)
+
+    for name in dropped:
+        curr.execute(f"DROP TABLE {name};")
+
+    return dropped
+
+
+# Load the csv files of csv_dir into the database
+# full replaces all data, incremental appends polls newer than the stored watermark and upserts stores and hours
+def ingest(
+    csv_dir: str = current_path,
+    mode: str = "full",
+    workers: int = settings.INGEST_WORKERS,
+    chunk_size: int = settings.INGEST_CHUNK_SIZE,
+    retention_days: int = settings.STATUS_RETENTION_DAYS,
+    snapshot_dir: str = settings.SNAPSHOT_DIR
+):
+
+    if mode not in ("full", "incremental"):
+        raise ValueError(f"Unknown ingestion mode {mode}")
+
+    conn = get_connection()
+
+    if conn:
+        print("Connection to the PostgreSQL established successfully.")
+    else:
+        print("Connection to the PostgreSQL encountered an error.")
+        return
+
+    total_start = time.perf_counter()
+    stats = {"mode": mode, "files": {}}
+
+    curr = conn.cursor()
+    print("Cursor created.")
+
+    curr.execute(lock_query)
+
+    curr.execute(create_store_hours_table_query)
+    curr.execute(create_timezones_table_query)
+    curr.execute(create_store_status_query)
+    partition_legacy_table(curr)
+    curr.execute(create_ingestion_state_table_query)
+    curr.execute(create_staging_tables_query)
+    curr.execute(create_indices_query)
+    conn.commit()
+    print("Table created.")
+
+    # Files missing from csv_dir are skipped, incremental loads usually only bring new polls
+    for name, (table, columns) in CSV_FILES.items():
+        path = os.path.join(csv_dir, name)
+        if os.path.exists(path):
+            stats["files"][name] = copy_file(path, table, columns, workers, chunk_size)
+
+    if "store_status.csv" not in stats["files"] and mode == "full":
+        raise FileNotFoundError(os.path.join(csv_dir, "store_status.csv"))
+
+    start = time.perf_counter()
+
+    watermark = None
+    if mode == "incremental":
+        curr.execute("SELECT value FROM ingestion_state WHERE key = %s;", (WATERMARK_KEY,))
+        row = curr.fetchone()
+        if row is not None:
+            watermark = row[0]
+        else:
+            # Table loaded before watermarks existed
+            curr.execute("SELECT max(timestamp) FROM store_status;")
+            watermark = curr.fetchone()[0]
+
+    else:
+        curr.execute(truncate_query)
+
+        # Replaced polls go with their partitions
+        curr.execute(select_partitions_query)
+        for (name,) in curr.fetchall():
+            curr.execute(f"DROP TABLE {name};")
+
+        # Rollups of replaced data are recomputed from scratch
+        curr.execute("SELECT to_regclass('store_status_hourly') IS NOT NULL;")
+        if curr.fetchone()[0]:
+            curr.execute("TRUNCATE store_status_hourly;")
+        curr.execute("DELETE FROM ingestion_state WHERE key = %s;", (ROLLUP_WATERMARK_KEY,))
+
+    staged = stats["files"].get("store_status.csv", {}).get("rows", 0)
+    existing = 0
+    if mode == "incremental":
+        curr.execute("""
+            SELECT coalesce(sum(greatest(c.reltuples, 0)), 0) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'store_status'::regclass;
+        """)
+        existing = curr.fetchone()[0]
+
+    if "timezones.csv" in stats["files"]:
+        curr.execute(merge_stores_query)
+    if "menu_hours.csv" in stats["files"]:
+        curr.execute(merge_store_hours_query)
+    # Full loads replace polls too, report servers drop their cached metadata and timelines
+    if mode == "full" or "timezones.csv" in stats["files"] or "menu_hours.csv" in stats["files"]:
+        curr.execute(bump_metadata_version_query)
+
+    # Large loads index their new days once after the rows are in, smaller ones insert through the indexes of store_status
+    detached, stats["inserted"] = [], 0
+    if staged > 0 and staged > existing * DEFER_INDEX_RATIO:
+        start_detached = time.perf_counter()
+        detached, stats["inserted"] = load_detached_partitions(curr, "store_status_staging", watermark)
+        stats["detached_seconds"] = time.perf_counter() - start_detached
+        print(f"Loaded and indexed {len(detached)} new day partitions in {stats['detached_seconds']:.2f}s.")
+
+    partitions = create_partitions(curr, "store_status_staging", watermark)
+    curr.execute(merge_store_status_query, {"watermark": watermark, "detached": [partition_day(name) for name in detached]})
+    stats["inserted"] += curr.rowcount
+
+    # Watermark is stored in the same transaction as the rows, a rerun of the same files inserts nothing
+    curr.execute("SELECT max(timestamp) FROM store_status;")
+    last = curr.fetchone()[0]
+    if last is not None:
+        curr.execute(upsert_state_query, (WATERMARK_KEY, last.isoformat()))
+        stats["watermark"] = last.isoformat()
+
+    stats["merge_seconds"] = time.perf_counter() - start
+    print(f"Merged {stats['inserted']} new polls into {len(partitions)} day partitions in {stats['merge_seconds']:.2f}s.")
+
+    stats["dropped_partitions"] = drop_old_partitions(curr, retention_days)
+    if stats["dropped_partitions"]:
+        print(f"Dropped {len(stats['dropped_partitions'])} partitions older than {retention_days} days.")
+
+    curr.execute("TRUNCATE stores_staging, store_hours_staging, store_status_staging;")
+
+    print("Inserted values, starting commit.")
+    conn.commit()
+    print("Finished commit.")
+
+    # Fresh visibility map and statistics, so reports get index only scans and partition estimates right away
+    conn.autocommit = True
+    curr.execute(select_partitions_query)
+    existing_partitions = {name for (name,) in curr.fetchall()}
+    for name in partitions:
+        if name in existing_partitions:
+            curr.execute(f"VACUUM (ANALYZE) {name};")
+
+    # Columnar day files for FETCH_MODE=snapshot, only days with new polls are rewritten
+    if snapshot_dir and stats.get("watermark") is not None:
+        from app.services.snapshot_service import write_snapshots
+
+        start = time.perf_counter()
+        stats["snapshot_polls"] = write_snapshots(
+            curr, snapshot_dir,
+            [partition_day(name) for name in partitions], [partition_day(name) for name in stats["dropped_partitions"]],
+            stats["watermark"], full=mode == "full"
+        )
+        stats["snapshot_seconds"] = time.perf_counter() - start
+        print(f"Wrote snapshots of {len(partitions)} days in {stats['snapshot_seconds']:.2f}s.")
+
+    curr.close()
+    conn.close()
+
+    stats["seconds"] = time.perf_counter() - total_start
+    print(f"Ingested {stats['inserted']} polls in {stats['seconds']:.2f}s ({stats['inserted'] / max(stats['seconds'], 1e-9):.0f} polls/s).")
+    return stats
 
-print("Inserted values, starting commit.")
-conn.commit()
-print("Finished commit.")
 
-curr.close()
-conn.close()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load store monitoring csv files into the database")
+    parser.add_argument("--dir", default=current_path, help="Directory with timezones.csv, menu_hours.csv and store_status.csv")
+    parser.add_argument("--mode", choices=["full", "incremental"], default="full")
+    parser.add_argument("--workers", type=int, default=settings.INGEST_WORKERS)
+    parser.add_argument("--chunk-size", type=int, default=settings.INGEST_CHUNK_SIZE, help="Bytes per COPY chunk")
+    parser.add_argument("--retention-days", type=int, default=settings.STATUS_RETENTION_DAYS, help="Days of polls kept, 0 keeps all")
+    parser.add_argument("--snapshot-dir", default=settings.SNAPSHOT_DIR, help="Directory of columnar day snapshots, empty writes none")
+    args = parser.parse_args()
 
+    ingest(args.dir, args.mode, args.workers, args.chunk_size, args.retention_days, args.snapshot_dir)
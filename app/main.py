@@ -1,6 +1,12 @@
-from app.api.routes import report
+from app.api.routes import report, metrics
 from app.db import create_tables
+from app.services.rollup_service import rollup_job
+from app.services.blob_service import retention_job
+from app.services import scheduler
+from app.utils.metrics import monitor_loop_lag
+from app.core import settings
 from contextlib import asynccontextmanager
+import asyncio
 
 from fastapi import FastAPI
 
@@ -9,9 +15,31 @@ from fastapi import FastAPI
 async def lifespan(app: FastAPI):
     # Startup logic
     await create_tables()
+
+    # Generate queued reports off the event loop, reports left running by a previous server are queued again
+    await scheduler.start()
+
+    # Keep hourly rollups current while the server runs
+    rollup_task = asyncio.create_task(rollup_job()) if settings.ENGINE == "rollup" else None
+
+    # Expire old reports and their files
+    retention_task = asyncio.create_task(retention_job())
+
+    # Event loop lag exposed in /metrics
+    lag_task = asyncio.create_task(monitor_loop_lag(settings.LOOP_LAG_INTERVAL)) if settings.LOOP_LAG_INTERVAL > 0 else None
+
     yield  # The point at which the application runs
 
+    if rollup_task is not None:
+        rollup_task.cancel()
+    retention_task.cancel()
+    if lag_task is not None:
+        lag_task.cancel()
+
+    await scheduler.stop()
+
 
 app = FastAPI(lifespan=lifespan)
 
-app.include_router(report.router, prefix="/report")
\ No newline at end of file
+app.include_router(report.router, prefix="/report")
+app.include_router(metrics.router)
\ No newline at end of file
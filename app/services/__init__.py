@@ -1 +1,4 @@
-from .generator_service import generator
\ No newline at end of file
+from .generator_service import generator, generate_store_report
+from .cache_service import report_cache
+from .scheduler_service import scheduler, cancel_report
+from .batch_service import batch_timestamps
\ No newline at end of file
@@ -0,0 +1,190 @@
+from .store_service import StoreService
+from .calendar_service import StoreCalendar, to_epoch, WEEK_US
+from .file_service import ReportFile, HEADINGS, report_rows, finalize_report, BATCH_SIZE
+from .metadata_service import store_metadata, DEFAULT_TIMEZONE
+from .progress_service import JobProgress, JobCancelled, fail_report
+from app.db import get_db, Report, StoreStatus
+from app.utils import logger, semaphore
+from app.utils.metrics import report_stage_seconds, reports_total
+from app.core import settings
+
+from sqlalchemy.future import select
+
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+import traceback
+
+
+# Timestamps of a batch trigger, either given as a list or every step seconds from start to end
+def batch_timestamps(timestamps: list = None, start: datetime = None, end: datetime = None, step: int = 3600):
+
+    if timestamps:
+        timestamps = list(timestamps)
+    elif start is not None and end is not None:
+        if step <= 0:
+            raise ValueError("step must be positive")
+        count = int((end - start).total_seconds() // step) + 1 if end >= start else 0
+        timestamps = [start + timedelta(seconds=step * i) for i in range(min(count, settings.BATCH_MAX_REPORTS + 1))]
+    else:
+        raise ValueError("Either timestamps or start and end are required")
+
+    if not timestamps:
+        raise ValueError("No timestamps in the batch")
+    if len(timestamps) > settings.BATCH_MAX_REPORTS:
+        raise ValueError(f"At most {settings.BATCH_MAX_REPORTS} timestamps per batch")
+
+    return timestamps
+
+
+# Single ordered pass over the polls of a batch of reports, sorted by created_at
+# Every poll is fed to the StoreService of each report whose window contains it, rows are written store by store
+# Each report is written to its own temporary file, so a batch holds at most BATCH_SIZE rows per report in memory
+class BatchPass:
+
+    def __init__(self, reports: list):
+        self.reports = sorted(reports, key=lambda report: report.created_at)
+        self.ends = [to_epoch(report.created_at) for report in self.reports]
+        self.files = [ReportFile(report.id, report.format, HEADINGS, settings.REPORT_ROWS) for report in self.reports]
+        self.rows = [[] for _ in self.reports]
+        self.store_id = None
+        self.services = {}      # Report index: StoreService of the current store
+        self.calendar = None
+        self.stores = 0
+        self.count = 0
+
+
+    # Reports whose window [created_at - 7 days, created_at] contains a timestamp, as a range of indices
+    def containing(self, timestamp: int):
+        return range(bisect_left(self.ends, timestamp), bisect_right(self.ends, timestamp + WEEK_US))
+
+
+    def feed(self, query):
+
+        if query.store_id != self.store_id:
+            self.flush()
+            self.store_id, self.calendar = query.store_id, None
+            self.stores += 1
+
+        self.count += 1
+        timestamp = to_epoch(query.timestamp)
+
+        # All services of a store see polls in the same order, so they share one calendar
+        calendar = self.calendar
+        if calendar is None or not calendar.lo <= timestamp < calendar.hi:
+            calendar = self.calendar = StoreCalendar(
+                store_metadata.get_store_hours(query.store_id),
+                store_metadata.get_timezone(query.store_id, DEFAULT_TIMEZONE),
+                timestamp
+            )
+
+        services = self.services
+        for k in self.containing(timestamp):
+            service = services.get(k)
+            if service is None:
+                service = services[k] = StoreService(query.store_id, self.reports[k].created_at, calendar.timezone)
+                service.store_hours = calendar.store_hours
+            service.calendar = calendar
+            service.process_query(query)
+
+
+    # Add the rows of the current store to the reports it was processed for
+    def flush(self):
+
+        for k, row in zip(self.services, report_rows(self.services)):
+            rows = self.rows[k]
+            rows.append(row)
+            if len(rows) >= BATCH_SIZE:
+                self.files[k].write_rows(rows)
+                rows.clear()
+
+        self.services = {}
+
+
+    # File of the report at index k with all its rows, for finalize_report
+    def close(self, k: int):
+        if self.rows[k]:
+            self.files[k].write_rows(self.rows[k])
+        self.rows[k] = None
+        return self.files[k]
+
+
+# Passes over groups of at most BATCH_PASS_REPORTS consecutive reports, each created when the one before is done with
+# The files of a pass are open for the whole of it, so a batch holds at most twice BATCH_PASS_REPORTS open files
+def batch_passes(reports: list):
+    reports = sorted(reports, key=lambda report: report.created_at)
+    for i in range(0, len(reports), settings.BATCH_PASS_REPORTS):
+        yield BatchPass(reports[i:i + settings.BATCH_PASS_REPORTS])
+
+
+# Generate the reports of a batch trigger with one scan over the union of their windows per pass
+# Returns {report_id: blob key or None} like generate, so completed reports reach the server's report cache
+async def batch_generator(report_ids: list):
+
+    progress = JobProgress(report_ids)
+    blob_keys = dict.fromkeys(report_ids)
+    batch = None
+
+    try:
+        time0 = datetime.now()
+
+        async with semaphore:
+            async for db in get_db():
+                result = await db.execute(select(Report.id, Report.created_at, Report.format).filter(Report.id.in_(report_ids)))
+                reports = result.fetchall()
+
+        await store_metadata.refresh()
+        store_count = max(len(store_metadata.timezones), 1)
+        pass_count = -(-len(reports) // settings.BATCH_PASS_REPORTS)
+        count = stores = 0
+
+        for index, batch in enumerate(batch_passes(reports)):
+
+            start = batch.reports[0].created_at - timedelta(days=7)
+            end = batch.reports[-1].created_at
+            logger.info(f"Batch of {len(reports)} reports : Pass {index + 1} of {pass_count} processing polls from {start} to {end}")
+
+            async with semaphore:
+                async for db in get_db():
+                    result = await db.stream(select(StoreStatus.store_id, StoreStatus.timestamp, StoreStatus.status).filter(
+                        StoreStatus.timestamp >= start,
+                        StoreStatus.timestamp <= end
+                    ).order_by(StoreStatus.store_id, StoreStatus.timestamp).execution_options(max_row_buffer=settings.STREAM_CHUNK_SIZE))
+
+                    async for chunk in result.partitions(settings.STREAM_CHUNK_SIZE):
+                        for query in chunk:
+                            batch.feed(query)
+                        await progress.update(90 * (index + min(1, batch.stores / store_count)) / pass_count)
+
+            batch.flush()
+            await progress.update(90 * (index + 1) / pass_count, force=True)
+
+            # Reports cancelled meanwhile are not finalized
+            for k, report in enumerate(batch.reports):
+                blob_keys[report.id] = await finalize_report(report.id, batch.close(k))
+                reports_total.inc(result="completed" if blob_keys[report.id] is not None else "cancelled")
+
+            for report_file in batch.files:
+                report_file.discard()
+            count, stores = count + batch.count, max(stores, batch.stores)
+
+        logger.info(f"Batch of {len(reports)} reports : Processed {count} polls of {stores} stores in {(datetime.now() - time0).total_seconds()}")
+        report_stage_seconds.observe((datetime.now() - time0).total_seconds(), stage="batch")
+
+    except JobCancelled:
+        logger.info(f"Batch of {len(report_ids)} reports : Cancelled")
+        reports_total.inc(len(report_ids), result="cancelled")
+
+    except Exception as error:
+        tb = traceback.format_exc()
+        logger.error(tb)
+        for report_id in report_ids:
+            await fail_report(report_id, repr(error))
+        reports_total.inc(len(report_ids), result="failed")
+
+    # Temporaries of the pass that was not finalized, e.g. after a cancel or failure
+    finally:
+        if batch is not None:
+            for report_file in batch.files:
+                report_file.discard()
+
+    return blob_keys
@@ -0,0 +1,271 @@
+from .cache_service import report_cache
+from app.db import get_db, Report
+from app.utils import semaphore, ReportStatusEnum, logger
+from app.core import settings
+
+from sqlalchemy import update, delete, func, or_
+from sqlalchemy.future import select
+
+from abc import ABC, abstractmethod
+from datetime import timedelta
+import asyncio, hashlib, os, re, tempfile, time
+
+GRACE_SECONDS = 3600    # Blobs written this recently may belong to a report that is not finalized yet
+MIGRATE_BATCH = 100     # Report files moved out of the reports table per retention run
+FINISHED = (ReportStatusEnum.Completed, ReportStatusEnum.Cancelled, ReportStatusEnum.Failed)
+
+KEY = re.compile("[0-9a-f]{64}")
+CHUNK_SIZE = 1024 * 1024
+
+
+# Report files by content key, the reports table keeps only the key
+class BlobStore(ABC):
+
+    # Store data given as bytes or a binary file object read to its end, returns its key
+    @abstractmethod
+    def put(self, data) -> str:
+        pass
+
+    @abstractmethod
+    def read(self, key: str) -> bytes:
+        pass
+
+    # Missing blobs are ignored
+    @abstractmethod
+    def delete(self, key: str):
+        pass
+
+    # Keys of blobs written before a unix time
+    @abstractmethod
+    def keys(self, before: float):
+        pass
+
+    # Local file of a blob so the server can send it without reading it, None if the store is not on this filesystem
+    def path(self, key: str):
+        return None
+
+    # New named temporary file to write a report into, then stored with put_file
+    def temporary(self):
+        return tempfile.NamedTemporaryFile(suffix=".tmp", delete=False)
+
+    # Store a temporary file and remove it, returns its key
+    def put_file(self, path: str) -> str:
+        try:
+            with open(path, "rb") as file:
+                return self.put(file)
+        finally:
+            os.unlink(path)
+
+
+# Blobs as files named by the sha256 of their content under directory, identical reports share one file
+# Temporaries are written under the same directory, so storing one is a rename and never a copy
+class LocalBlobStore(BlobStore):
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+
+    def path(self, key: str):
+        if not KEY.fullmatch(key):
+            raise ValueError(f"Invalid blob key {key}")
+        return os.path.join(self.directory, key[:2], key)
+
+
+    def temporary(self):
+        directory = os.path.join(self.directory, "tmp")
+        os.makedirs(directory, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False)
+
+
+    # Bytes or a stream, copied chunk by chunk to a temporary while hashed
+    def put(self, data):
+
+        digest = hashlib.sha256()
+        chunks = [data] if isinstance(data, (bytes, bytearray, memoryview)) else iter(lambda: data.read(CHUNK_SIZE), b"")
+
+        with self.temporary() as file:
+            try:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    file.write(chunk)
+            except BaseException:
+                os.unlink(file.name)
+                raise
+
+        return self.store(file.name, digest.hexdigest())
+
+
+    # Hashed chunk by chunk and renamed into place
+    def put_file(self, path: str):
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+
+        return self.store(path, digest.hexdigest())
+
+
+    # Move a hashed temporary into place, readers never see a partial file
+    def store(self, temporary: str, key: str):
+
+        path = self.path(key)
+
+        # Written again, the existing file is kept through the sweep grace like a new one
+        try:
+            os.utime(path)
+            os.unlink(temporary)
+            return key
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temporary, path)
+
+        return key
+
+
+    def read(self, key: str):
+        with open(self.path(key), "rb") as file:
+            return file.read()
+
+
+    def delete(self, key: str):
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+    # Temporaries left by writers that died are removed on the way
+    def keys(self, before: float):
+
+        if not os.path.isdir(self.directory):
+            return
+
+        for prefix in os.scandir(self.directory):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.stat().st_mtime >= before:
+                    continue
+                if KEY.fullmatch(entry.name):
+                    yield entry.name
+                elif entry.name.endswith(".tmp"):
+                    os.unlink(entry.path)
+
+
+BLOB_STORES = {
+    "local": LocalBlobStore,
+}
+
+
+def create_blob_store():
+    if settings.BLOB_STORE not in BLOB_STORES:
+        raise ValueError(f"Unknown BLOB_STORE {settings.BLOB_STORE}")
+    return BLOB_STORES[settings.BLOB_STORE](settings.BLOB_DIR)
+
+
+blob_store = create_blob_store()
+
+
+# Content of a report to serve, the path of a local blob or the bytes of a remote one
+# Reports finished before the blob store keep their file in the table until it is moved, raises FileNotFoundError once expired
+def report_source(blob_key: str, file: bytes = None):
+
+    if file is not None:
+        return file
+
+    path = blob_store.path(blob_key)
+    if path is None:
+        return blob_store.read(blob_key)
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+
+    return path
+
+
+# Bytes of a report source, for conversions
+def read_source(source):
+    if isinstance(source, str):
+        with open(source, "rb") as file:
+            return file.read()
+    return source
+
+
+# Move report files still stored in the reports table to the blob store, a batch per run
+async def migrate_files():
+
+    async with semaphore:
+        async for db in get_db():
+            result = await db.execute(select(Report.id, Report.file).filter(Report.file.isnot(None)).limit(MIGRATE_BATCH))
+            rows = result.fetchall()
+
+            for report_id, file in rows:
+                await db.execute(update(Report).where(Report.id == report_id).values(blob_key=blob_store.put(file), file=None))
+            await db.commit()
+
+    return len(rows)
+
+
+# Delete finished reports older than REPORT_RETENTION_DAYS or beyond the newest REPORT_RETENTION_COUNT, returns their ids
+async def expire_reports():
+
+    finished_at = func.coalesce(Report.finished_at, Report.created_at)
+    conditions = []
+
+    if settings.REPORT_RETENTION_DAYS > 0:
+        conditions.append(finished_at < func.now() - timedelta(days=settings.REPORT_RETENTION_DAYS))
+
+    if settings.REPORT_RETENTION_COUNT > 0:
+        newest = select(Report.id).filter(Report.status.in_(FINISHED)).order_by(finished_at.desc()).limit(settings.REPORT_RETENTION_COUNT)
+        conditions.append(~Report.id.in_(newest.scalar_subquery()))
+
+    if not conditions:
+        return []
+
+    async with semaphore:
+        async for db in get_db():
+            result = await db.execute(delete(Report).where(Report.status.in_(FINISHED), or_(*conditions)).returning(Report.id))
+            report_ids = result.scalars().all()
+            await db.commit()
+
+    for report_id in report_ids:
+        report_cache.discard(report_id)
+
+    return report_ids
+
+
+# Delete blobs no report refers to, e.g. of expired or cancelled reports
+async def sweep_blobs():
+
+    keys = list(blob_store.keys(time.time() - GRACE_SECONDS))
+    if not keys:
+        return 0
+
+    async with semaphore:
+        async for db in get_db():
+            result = await db.execute(select(Report.blob_key).filter(Report.blob_key.in_(keys)).distinct())
+            referenced = set(result.scalars().all())
+
+    unreferenced = [key for key in keys if key not in referenced]
+    for key in unreferenced:
+        blob_store.delete(key)
+
+    return len(unreferenced)
+
+
+# Periodic job moving old report files out of the table and applying the retention policy
+async def retention_job():
+
+    while True:
+        try:
+            migrated = await migrate_files()
+            expired = await expire_reports()
+            swept = await sweep_blobs()
+            if migrated or expired or swept:
+                logger.info(f"Retention : Moved {migrated} report files, deleted {len(expired)} reports and {swept} blobs")
+        except Exception as _:
+            logger.exception("Retention job failed")
+
+        await asyncio.sleep(settings.RETENTION_INTERVAL)
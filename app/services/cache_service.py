@@ -0,0 +1,140 @@
+from app.core import settings
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+import asyncio, time
+
+
+# Finished reports keyed by (normalized created_at, format[, windows]), with TTL and LRU eviction
+# Triggers for a key being computed share the in-flight report instead of starting another one
+class ReportCache:
+
+    def __init__(self, max_size: int, ttl: int, resolution: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.resolution = resolution
+        self.entries = OrderedDict()    # key: (report_id, blob_key, expires_at)
+        self.keys = {}                  # report_id: key, for finished and in-flight reports
+        self.inflight = {}              # key: future resolving to report_id
+
+
+    # Round timestamp down to the cache resolution, None is now
+    def normalize(self, timestamp: datetime = None):
+
+        if timestamp is None:
+            timestamp = datetime.now(timezone.utc)
+        elif timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+
+        epoch = timestamp.timestamp()
+        if self.resolution > 0:
+            epoch -= epoch % self.resolution
+
+        return datetime.fromtimestamp(epoch, timezone.utc)
+
+
+    # Cache key of a report, reports with custom windows are keyed by their canonical windows too
+    def key(self, timestamp: datetime, format, windows: str = None):
+        if windows:
+            return self.normalize(timestamp), format, windows
+        return self.normalize(timestamp), format
+
+
+    # Report id of a finished or in-flight report for key, None if it has to be generated
+    async def lookup(self, key: tuple):
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[2] > time.monotonic():
+                self.entries.move_to_end(key)
+                return entry[0]
+            self.evict(key)
+
+        future = self.inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        return None
+
+
+    # Mark key as being computed, must be called without awaiting after a lookup miss
+    def reserve(self, key: tuple):
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        return future
+
+
+    # Attach the created report to a reserved key
+    def start(self, key: tuple, report_id: str):
+        self.keys[report_id] = key
+        future = self.inflight.get(key)
+        if future is not None and not future.done():
+            future.set_result(report_id)
+
+
+    # Drop a reservation whose report could not be created
+    def release(self, key: tuple, error: Exception):
+        future = self.inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_exception(error)
+            future.exception()  # Retrieved, avoids "never retrieved" warnings without waiters
+
+
+    # Store finished report and stop sharing the in-flight computation
+    def complete(self, report_id: str, blob_key: str):
+
+        key = self.keys.get(report_id)
+        if key is None:
+            return
+
+        self.inflight.pop(key, None)
+
+        if self.max_size <= 0:
+            self.keys.pop(report_id, None)
+            return
+
+        self.entries[key] = (report_id, blob_key, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.evict(next(iter(self.entries)))
+
+
+    # Forget a report whose generation failed so the next trigger retries
+    def fail(self, report_id: str):
+        key = self.keys.pop(report_id, None)
+        if key is not None:
+            self.inflight.pop(key, None)
+
+
+    # (key, blob_key) of a cached finished report, None if not cached
+    def get(self, report_id: str):
+
+        key = self.keys.get(report_id)
+        entry = self.entries.get(key) if key is not None else None
+
+        if entry is None or entry[0] != report_id:
+            return None
+
+        if entry[2] <= time.monotonic():
+            self.evict(key)
+            return None
+
+        self.entries.move_to_end(key)
+        return key, entry[1]
+
+
+    # Forget a finished report deleted by retention
+    def discard(self, report_id: str):
+        key = self.keys.get(report_id)
+        entry = self.entries.get(key) if key is not None else None
+        if entry is not None and entry[0] == report_id:
+            self.evict(key)
+
+
+    def evict(self, key: tuple):
+        report_id, _, _ = self.entries.pop(key)
+        self.keys.pop(report_id, None)
+
+
+report_cache = ReportCache(settings.REPORT_CACHE_SIZE, settings.REPORT_CACHE_TTL, settings.REPORT_CACHE_RESOLUTION)
@@ -0,0 +1,209 @@
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from bisect import bisect_right
+
+US = 1_000_000
+MINUTE_US = 60 * US
+HOUR_US = 60 * MINUTE_US
+DAY_US = 24 * HOUR_US
+WEEK_US = 7 * DAY_US
+OFFSET_STEP_US = 15 * MINUTE_US     # Every tz transition falls on a 15 minute boundary
+CALENDAR_DAYS = 10                  # A report week with margin on both sides
+ZONE_CACHE_SIZE = 4096
+BOUND = 1 << 62
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+# Convert a tz-aware datetime to integer microseconds since epoch
+def to_epoch(dt: datetime):
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+
+# Convert integer microseconds since epoch to a UTC datetime
+def from_epoch(timestamp: int):
+    return EPOCH + timedelta(microseconds=timestamp)
+
+
+# Convert a time object to integer microseconds since midnight
+def time_to_micros(t):
+    return ((t.hour * 60 + t.minute) * 60 + t.second) * US + t.microsecond
+
+
+# Store hours with ranges of a day that overlap or run past midnight
+# A poll in a later overlapping range opens its store hour before earlier polls, so pieces of a replay no longer start at its polls
+def overlapping_hours(store_hours: dict):
+
+    for ranges in store_hours.values():
+        if any(start > end for start, end in ranges):
+            return True
+        spans = sorted(ranges)
+        if any(start <= previous_end for (_, previous_end), (start, _) in zip(spans, spans[1:])):
+            return True
+
+    return False
+
+
+# UTC offset periods of a timezone between two UTC instants, shared by all stores in the timezone
+class ZoneOffsets:
+
+    def __init__(self, timezone_str: str, start: int, end: int):
+        tz = ZoneInfo(timezone_str)
+        self.starts = []
+        self.offsets = []
+
+        for t in range(start - start % OFFSET_STEP_US, end + OFFSET_STEP_US, OFFSET_STEP_US):
+            offset = datetime.fromtimestamp(t // US, tz).utcoffset() // timedelta(microseconds=1)
+            if not self.offsets or offset != self.offsets[-1]:
+                self.starts.append(t)
+                self.offsets.append(offset)
+
+        # First and last periods are open ended
+        self.starts[0] = -BOUND
+        self.ends = self.starts[1:] + [BOUND]
+
+
+    # UTC instant of a local wall time, fold picks among repeated and skipped times like datetime does
+    def to_utc(self, wall: int, fold: int = 0):
+
+        if len(self.offsets) == 1:
+            return wall - self.offsets[0]
+
+        candidates = [wall - offset for start, end, offset in zip(self.starts, self.ends, self.offsets) if start <= wall - offset < end]
+
+        if candidates:
+            return candidates[-1] if fold else candidates[0]
+
+        # Wall time skipped by a transition, fold 0 uses the offset before it and fold 1 the offset after
+        for i in range(1, len(self.starts)):
+            if self.starts[i] + self.offsets[i - 1] <= wall < self.starts[i] + self.offsets[i]:
+                return wall - self.offsets[i if fold else i - 1]
+
+        return wall - self.offsets[0]
+
+
+zones = {}
+
+
+def get_zone(timezone_str: str, start: int, end: int):
+
+    key = (timezone_str, start, end)
+    zone = zones.get(key)
+
+    if zone is None:
+        if len(zones) >= ZONE_CACHE_SIZE:
+            zones.clear()
+        zone = zones[key] = ZoneOffsets(timezone_str, start, end)
+
+    return zone
+
+
+# Sorted UTC intervals in which a store is open, compiled from its local weekly store hours
+# Segment i is [starts[i], ends[i]] in UTC with constant utc offset, opens and closes are its store hour in local wall time
+class StoreCalendar:
+
+    def __init__(self, store_hours: dict, timezone_str: str, start: int):
+        self.store_hours = store_hours
+        self.timezone = timezone_str
+        self.lo = start - start % DAY_US - DAY_US
+        self.hi = self.lo + CALENDAR_DAYS * DAY_US
+        self.zone = zone = get_zone(timezone_str, self.lo - 2 * DAY_US, self.hi + 2 * DAY_US)
+
+        # Ranges ending before they start never contain a time
+        week = {
+            day_of_week: [(time_to_micros(start), time_to_micros(end)) for start, end in ranges if start <= end]
+            for day_of_week, ranges in store_hours.items()
+        }
+
+        periods = [
+            (max(start, self.lo), min(end - 1, self.hi - 1), offset, start + zone.offsets[i - 1] - offset if i > 0 and zone.offsets[i - 1] > offset else start)
+            for i, (start, end, offset) in enumerate(zip(zone.starts, zone.ends, zone.offsets))
+        ]
+
+        segments = []
+
+        for day in range(self.lo // DAY_US - 1, self.hi // DAY_US + 1):
+            ranges = week.get((day + 3) % 7)    # 1970-01-01 was a Thursday
+            if not ranges:
+                continue
+
+            taken = []
+            for start, end in ranges:
+                opens, closes = day * DAY_US + start, day * DAY_US + end
+
+                for period_lo, period_hi, offset, fold_until in periods:
+                    lo = opens - offset if opens - offset > period_lo else period_lo
+                    hi = closes - offset if closes - offset < period_hi else period_hi
+                    if lo > hi:
+                        continue
+
+                    # Where ranges of a day overlap the first one wins
+                    if taken:
+                        for lo_part, hi_part in subtract(lo, hi, taken):
+                            segments.append((lo_part, hi_part, offset, opens, closes, fold_until))
+                    else:
+                        segments.append((lo, hi, offset, opens, closes, fold_until))
+                    taken.append((lo, hi))
+
+        segments.sort()
+        self.starts = [s[0] for s in segments]
+        self.ends = [s[1] for s in segments]
+        self.offsets = [s[2] for s in segments]
+        self.opens = [s[3] for s in segments]
+        self.closes = [s[4] for s in segments]
+        self.folds = [s[5] for s in segments]   # Times before this are the second occurrence of a repeated wall time
+
+
+    def covers(self, start: int, end: int):
+        return self.lo <= start and end < self.hi
+
+
+    # Index of the segment containing a UTC instant, -1 when closed
+    def lookup(self, timestamp: int):
+        i = bisect_right(self.starts, timestamp) - 1
+        if i >= 0 and timestamp <= self.ends[i]:
+            return i
+        return -1
+
+
+# Parts of the closed interval [lo, hi] not covered by any of the taken intervals
+def subtract(lo: int, hi: int, taken: list):
+
+    parts = [(lo, hi)]
+    for taken_lo, taken_hi in taken:
+        remaining = []
+        for part_lo, part_hi in parts:
+            if taken_hi < part_lo or taken_lo > part_hi:
+                remaining.append((part_lo, part_hi))
+                continue
+            if part_lo < taken_lo:
+                remaining.append((part_lo, taken_lo - 1))
+            if taken_hi < part_hi:
+                remaining.append((taken_hi + 1, part_hi))
+        parts = remaining
+
+    return parts
+
+
+# Compiled calendars by store_id, reused by later reports while store hours, timezone and window still match
+class CalendarCache:
+
+    def __init__(self):
+        self.calendars = {}
+
+
+    def get(self, store_id: str, store_hours: dict, timezone_str: str, start: int, end: int):
+
+        calendar = self.calendars.get(store_id)
+
+        if (
+            calendar is None or
+            calendar.timezone != timezone_str or
+            not calendar.covers(start, end) or
+            (calendar.store_hours is not store_hours and calendar.store_hours != store_hours)
+        ):
+            calendar = self.calendars[store_id] = StoreCalendar(store_hours, timezone_str, start)
+
+        return calendar
+
+
+calendar_cache = CalendarCache()
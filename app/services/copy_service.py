@@ -0,0 +1,207 @@
+from .calendar_service import US
+from app.db import get_db
+from app.utils import semaphore
+
+from datetime import datetime, timedelta
+import itertools, struct
+import numpy as np
+
+SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+PG_EPOCH_US = 946684800 * US    # Binary timestamptz counts microseconds from 2000-01-01
+
+# Polls of the report week straight from the covering index, status as a bool so no enum labels are sent
+# Wrapped in COPY (...) TO STDOUT WITH (FORMAT binary) by the driver
+COPY_QUERY = """
+    SELECT store_id, timestamp, status = 'active'
+    FROM store_status
+    WHERE timestamp >= $1 AND timestamp <= $2 AND status IS NOT NULL
+    ORDER BY store_id, timestamp
+"""
+
+# Layout of a binary COPY tuple when store_id fills its char(36), every field is preceded by its length
+ROW = np.dtype([
+    ("fields", ">i2"),
+    ("store_length", ">i4"), ("store_id", "S36"),
+    ("timestamp_length", ">i4"), ("timestamp", ">i8"),
+    ("status_length", ">i4"), ("status", "u1"),
+])
+
+HEADER = struct.Struct(">11sii")
+FIELDS = struct.Struct(">h")
+LENGTH = struct.Struct(">i")
+TIMESTAMP = struct.Struct(">q")
+METRICS = struct.Struct(">" + "ii" * 6)    # Six int4 fields, each preceded by its length
+
+COPY_HEADER = HEADER.pack(SIGNATURE, 0, 0)
+COPY_TRAILER = FIELDS.pack(-1)
+
+
+# Decodes a binary COPY stream chunk by chunk into codes, epoch microseconds and statuses
+# Codes are ordinals of store_ids, rows of unknown stores are dropped
+# Without store_ids every new store gets the next code, store_index then is the dictionary of the stream
+class CopyDecoder:
+
+    def __init__(self, store_ids: list = None):
+        self.grow = store_ids is None
+        self.store_index = {store_id.encode(): i for i, store_id in enumerate(store_ids or [])}
+        self.rest = b""
+        self.header = True
+        self.done = False
+        self.count = 0
+
+
+    # Complete rows of data and of the bytes left over from the previous chunk, as numpy arrays
+    def decode(self, data: bytes):
+
+        data = self.rest + data
+        pos = 0
+
+        if self.header:
+            if len(data) < HEADER.size:
+                self.rest = data
+                return self.empty()
+
+            signature, _, extension = HEADER.unpack_from(data)
+            if signature != SIGNATURE:
+                raise ValueError("Not a binary COPY stream")
+            if len(data) < HEADER.size + extension:
+                self.rest = data
+                return self.empty()
+
+            pos, self.header = HEADER.size + extension, False
+
+        # Fixed size rows are viewed in place, the first row of another shape (or the trailer) ends the fast path
+        count = (len(data) - pos) // ROW.itemsize
+        rows = np.frombuffer(data, ROW, count=count, offset=pos)
+        fixed = (
+            (rows["fields"] == 3) & (rows["store_length"] == 36) &
+            (rows["timestamp_length"] == 8) & (rows["status_length"] == 1)
+        )
+        if not fixed.all():
+            count = int(np.argmin(fixed))
+            rows = rows[:count]
+        pos += count * ROW.itemsize
+
+        codes, timestamps, statuses = self.codes(rows["store_id"]), rows["timestamp"] + PG_EPOCH_US, rows["status"]
+
+        if pos < len(data):
+            pos, slow = self.decode_rows(data, pos)
+            if slow[0]:
+                codes = np.concatenate((codes, np.array(slow[0], dtype=np.int32)))
+                timestamps = np.concatenate((timestamps, np.array(slow[1], dtype=np.int64)))
+                statuses = np.concatenate((statuses, np.array(slow[2], dtype=np.uint8)))
+
+        self.rest = data[pos:]
+
+        known = codes >= 0
+        if not known.all():
+            codes, timestamps, statuses = codes[known], timestamps[known], statuses[known]
+
+        self.count += len(codes)
+        return codes.astype(np.int32), timestamps.astype(np.int64), statuses.astype(np.uint8)
+
+
+    # Rows come ordered by store_id, each run of equal ids is looked up once
+    def codes(self, store_ids):
+
+        if len(store_ids) == 0:
+            return np.empty(0, dtype=np.int32)
+
+        starts = np.concatenate(([0], np.flatnonzero(store_ids[1:] != store_ids[:-1]) + 1))
+        lengths = np.diff(np.concatenate((starts, [len(store_ids)])))
+        run_codes = [self.code(store_id) for store_id in store_ids[starts].tolist()]
+
+        return np.repeat(np.array(run_codes, dtype=np.int32), lengths)
+
+
+    # Row by row decoding of any remaining complete rows, e.g. shorter store ids, up to the trailer
+    def decode_rows(self, data: bytes, pos: int):
+
+        codes, timestamps, statuses = [], [], []
+        size = len(data)
+
+        while pos + FIELDS.size <= size:
+            (fields,) = FIELDS.unpack_from(data, pos)
+            if fields == -1:
+                self.done = True
+                pos = size
+                break
+
+            values, end = [], pos + FIELDS.size
+            for _ in range(fields):
+                if end + LENGTH.size > size:
+                    break
+                (length,) = LENGTH.unpack_from(data, end)
+                end += LENGTH.size
+                if length == -1:
+                    values.append(None)     # NULL, no data follows
+                    continue
+                if length < 0 or end + length > size:
+                    break
+                values.append(data[end:end + length])
+                end += length
+
+            if len(values) < fields:
+                break
+
+            # Rows with a NULL column carry no poll and are skipped
+            if None in values:
+                pos = end
+                continue
+
+            store_id, timestamp, status = values
+            codes.append(self.code(store_id))
+            timestamps.append(TIMESTAMP.unpack(timestamp)[0] + PG_EPOCH_US)
+            statuses.append(status[0])
+            pos = end
+
+        return pos, (codes, timestamps, statuses)
+
+
+    def code(self, store_id: bytes):
+        if self.grow:
+            return self.store_index.setdefault(store_id, len(self.store_index))
+        return self.store_index.get(store_id, -1)
+
+
+    def empty(self):
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8)
+
+
+# Binary COPY tuples of report rows [store_id, six metrics] for report_rows, without header and trailer
+def encode_report_rows(report_id: str, rows: list):
+
+    report = report_id.encode()
+    prefix = FIELDS.pack(8) + LENGTH.pack(len(report)) + report
+    parts = []
+
+    for store_id, *metrics in rows:
+        store = store_id.encode()
+        parts += (prefix, LENGTH.pack(len(store)), store, METRICS.pack(*itertools.chain.from_iterable((4, value) for value in metrics)))
+
+    return b"".join(parts)
+
+
+# Stream the polls of the week before created_at through COPY TO STDOUT, on_chunk gets decoded arrays as they arrive
+# Skips SQLAlchemy rows, enum conversion and datetime objects, timestamps stay integers all the way to processing
+async def copy_polls(store_ids: list, created_at: datetime, on_chunk):
+
+    decoder = CopyDecoder(store_ids)
+
+    async def output(data: bytes):
+        codes, timestamps, statuses = decoder.decode(data)
+        if len(codes):
+            await on_chunk(codes, timestamps, statuses)
+
+    async with semaphore:
+        async for db in get_db():
+            connection = await db.connection()
+            raw = await connection.get_raw_connection()
+            await raw.driver_connection.copy_from_query(
+                COPY_QUERY, created_at - timedelta(days=7), created_at, output=output, format="binary"
+            )
+
+    if not decoder.done or decoder.rest:
+        raise ValueError("Incomplete binary COPY stream")
+
+    return decoder.count
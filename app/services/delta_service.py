@@ -0,0 +1,413 @@
+from .store_service import StoreService, ReportArray, report_window
+from .calendar_service import overlapping_hours, to_epoch, from_epoch, US
+from .metadata_service import store_metadata, DEFAULT_TIMEZONE
+from .snapshot_service import WATERMARK_KEY
+from app.db import get_db, Report, StoreStatus, IngestionState
+from app.utils import StatusEnum, ReportStatusEnum, semaphore
+from app.core import settings
+
+from sqlalchemy import text, update
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from collections import Counter
+from datetime import datetime, timedelta
+import io
+import numpy as np
+
+NONE = np.iinfo(np.int64).min   # Time of a state without a poll in store hours
+STATUSES = (None, StatusEnum.inactive, StatusEnum.active)
+
+NEXT_POLLS_COUNT = 16   # Polls read per store and round while looking for the first one in store hours
+
+# Next polls of each store from its own start, one index range scan per store instead of a scan of the whole range
+NEXT_POLLS = """
+    SELECT s.store_id, p.timestamp, p.status
+    FROM unnest(CAST(:store_ids AS varchar[]), CAST(:starts AS timestamptz[])) AS s(store_id, start)
+    CROSS JOIN LATERAL (
+        SELECT timestamp, status FROM store_status
+        WHERE store_status.store_id = s.store_id AND timestamp >= s.start AND timestamp <= :end
+        ORDER BY timestamp LIMIT :count
+    ) p
+    ORDER BY s.store_id, p.timestamp
+"""
+
+
+# Wall clock minutes of the part of [last_time, current_time] after limit, as add_time counts them
+def clipped(last_time: tuple, current_time: tuple, limit: int):
+    if current_time[1] < limit:
+        return 0
+    if limit > last_time[1]:
+        return (current_time[1] - limit)/US/60
+    return (current_time[0] - last_time[0])/US/60
+
+
+# StoreService remembering its state before the first poll of the day and of the hour window, saved with the report
+class DeltaStoreService(StoreService):
+
+    __slots__ = ("captured", "last_seen")
+
+    def __init__(self, store_id: str, created_at: datetime, timezone: str, reports: ReportArray = None, ordinal: int = 0):
+        super().__init__(store_id, created_at, timezone, reports, ordinal)
+        self.captured = [None, None]    # States before the day and hour windows, None until a poll reaches them
+        self.last_seen = None           # Last poll whether in store hours or not
+
+
+    def process_poll(self, timestamp: int, status: StatusEnum):
+
+        # The hour window starts after the day window, once it is reached both are
+        captured = self.captured
+        if captured[1] is None:
+            time_limit = self.window.time_limit
+            for i in range(2):
+                if captured[i] is None and timestamp >= time_limit[i + 1]:
+                    captured[i] = self.state()
+
+        self.last_seen = timestamp
+        super().process_poll(timestamp, status)
+
+
+# Adds minutes clipped by each (column, limit, sign) term to the row of a store in the new report
+class TermStoreService(StoreService):
+
+    __slots__ = ("terms",)
+
+    def __init__(self, store: StoreService, terms: list):
+        super().__init__(store.store_id, store.window.created_at, store.timezone, store.reports, store.ordinal)
+        self.store_hours, self.calendar = store.store_hours, store.calendar
+        self.terms = terms
+
+
+    def add_time(self, last_time: tuple, current_time: tuple, status: StatusEnum):
+        base = self.ordinal * 6 + (0 if status == StatusEnum.active else 3)
+        for column, limit, sign in self.terms:
+            self.reports.values[base + column] += sign * clipped(last_time, current_time, limit)
+
+
+# Replays the polls at the start of one window of the previous report, taking out minutes that left the window
+# Pieces after the first poll in store hours in the new window start inside it, so the replay ends with that poll
+# Polls after until were not seen by the previous report and are left to the tail
+class AgedStoreService(TermStoreService):
+
+    __slots__ = ("column", "until", "after", "counting", "captured", "first", "cursor")
+
+    def __init__(self, store: StoreService, column: int, old_limits: tuple, until: int, state: tuple = None, after: int = None):
+        new_limits = store.window.time_limit
+
+        # Reports only see polls of their own week, the week replay starts with no state like the previous report did
+        # Its first poll in the new week is where the two reports differ, in every window
+        if column == 0:
+            terms = [(i, old_limits[i], -1) for i in range(3)]
+        else:
+            terms = [(column, old_limits[column], -1), (column, new_limits[column], 1)]
+        super().__init__(store, terms)
+
+        if state is not None:
+            self.restore(state)
+        self.column = column
+        self.until = until
+        self.after = after          # Pieces of polls up to after are left to the week replay
+        self.counting = True
+        self.captured = None        # State before the first poll in store hours in the new window
+        self.first = None           # That poll
+        self.cursor = None          # Last poll fed
+
+
+    @property
+    def done(self):
+        return self.first is not None
+
+
+    def add_time(self, last_time: tuple, current_time: tuple, status: StatusEnum):
+        if self.counting:
+            super().add_time(last_time, current_time, status)
+
+
+    def process_poll(self, timestamp: int, status: StatusEnum):
+
+        self.cursor = timestamp
+        if self.done or timestamp > self.until:
+            return
+
+        new_limits = self.window.time_limit
+        if timestamp >= new_limits[self.column] and self.is_in_store_hours(timestamp) >= 0:
+            self.first, self.captured = timestamp, self.state()
+
+            # In the new week this poll is the first one, opening its store hour with its own status
+            if self.column == 0:
+                opening = TermStoreService(self, [(i, new_limits[i], 1) for i in range(3)])
+                opening.process_poll(timestamp, status)
+
+        self.counting = self.after is None or timestamp > self.after
+        super().process_poll(timestamp, status)
+
+
+# Per store state saved with a report, rows follow store_ids
+# Times are epoch microseconds with NONE for missing ones, states are the end, before the day and before the hour window
+class DeltaState:
+
+    def __init__(self, data: bytes):
+        with np.load(io.BytesIO(data)) as arrays:
+            self.store_ids = [store_id.decode() for store_id in arrays["store_ids"].tolist()]
+            self.reports = arrays["reports"]
+            self.walls, self.utcs = arrays["walls"], arrays["utcs"]
+            self.statuses, self.folds = arrays["statuses"], arrays["folds"]
+            self.seen = arrays["seen"]
+            self.created, self.until = int(arrays["created"]), int(arrays["until"])
+            self.version = str(arrays["version"])
+        self.index = {store_id: i for i, store_id in enumerate(self.store_ids)}
+
+
+    # State k of row i as (wall, utc, status, fold)
+    def state(self, i: int, k: int):
+        if self.utcs[i, k] == NONE:
+            return None, None, None, 0
+        return int(self.walls[i, k]), int(self.utcs[i, k]), STATUSES[self.statuses[i, k]], int(self.folds[i, k])
+
+
+# Serialize the states of a report's DeltaStoreServices, until is the time up to which every poll was seen
+def dump_state(stores: dict, created: int, until: int, version: str):
+
+    size = len(stores)
+    reports = np.zeros((size, 6))
+    walls, utcs = np.full((size, 3), NONE, dtype=np.int64), np.full((size, 3), NONE, dtype=np.int64)
+    statuses, folds = np.zeros((size, 3), dtype=np.int8), np.zeros((size, 3), dtype=np.int8)
+    seen = np.full(size, NONE, dtype=np.int64)
+
+    for i, store in enumerate(stores.values()):
+        reports[i] = store.report
+        end = store.state()
+
+        # Without a poll at or after a limit, the state before it is the end state
+        # Polls before the week are not seen by a report, a state from one is no state
+        for k, state in enumerate((end, store.captured[0] or end, store.captured[1] or end)):
+            if state[1] is not None and state[1] >= store.window.time_limit[0]:
+                walls[i, k], utcs[i, k] = state[0], state[1]
+                statuses[i, k], folds[i, k] = STATUSES.index(state[2]), state[3]
+        if store.last_seen is not None:
+            seen[i] = store.last_seen
+
+    buffer = io.BytesIO()
+    np.savez_compressed(
+        buffer, store_ids=np.array([store_id.encode() for store_id in stores], dtype=bytes) if size else np.array([], dtype="S1"),
+        reports=reports, walls=walls, utcs=utcs, statuses=statuses, folds=folds, seen=seen,
+        created=np.int64(created), until=np.int64(until), version=np.str_(version or ""),
+    )
+    return buffer.getvalue()
+
+
+# Latest poll ingested, polls up to it are all in the database and later ones may still arrive
+async def ingestion_watermark():
+
+    async with semaphore:
+        async for db in get_db():
+            result = await db.execute(select(IngestionState.value).filter(IngestionState.key == WATERMARK_KEY))
+            watermark = result.scalar()
+
+    return datetime.fromisoformat(watermark) if watermark is not None else None
+
+
+# Save the state behind a report for later delta reports
+# Data loaded without the ingestion pipeline has no watermark and is taken as complete
+async def save_state(report_id: str, stores: dict, created_at: datetime, watermark: datetime = None):
+
+    until = created_at if watermark is None else min(watermark, created_at)
+    data = dump_state(stores, to_epoch(created_at), to_epoch(until), store_metadata.version)
+
+    async with semaphore:
+        async for db in get_db():
+            await db.execute(update(Report).where(Report.id == report_id).values(state=data))
+            await db.commit()
+
+
+# State of the latest completed report at most DELTA_MAX_MINUTES before created_at, None if there is none to start from
+async def load_base(created_at: datetime):
+
+    async with semaphore:
+        async for db in get_db():
+            result = await db.execute(select(Report.state).filter(
+                Report.status == ReportStatusEnum.Completed,
+                Report.state.isnot(None),
+                Report.windows.is_(None),
+                Report.created_at <= created_at,
+                Report.created_at >= created_at - timedelta(minutes=settings.DELTA_MAX_MINUTES)
+            ).order_by(Report.created_at.desc()).limit(1))
+            data = result.scalar()
+
+    if data is None:
+        return None
+
+    # Store hours or timezones changed, or a full load replaced the polls the state was built from
+    base = DeltaState(data)
+    await store_metadata.refresh()
+    if base.version != (store_metadata.version or ""):
+        return None
+
+    # Polls the base has not seen must all fall inside the new week
+    if base.until < to_epoch(created_at - timedelta(days=7)):
+        return None
+
+    return base
+
+
+# Polls from start to end ordered by store then timestamp, the end itself is excluded
+async def fetch_polls(db: AsyncSession, start: datetime, end: datetime):
+
+    result = await db.execute(select(StoreStatus.store_id, StoreStatus.timestamp, StoreStatus.status).filter(
+        StoreStatus.timestamp >= start,
+        StoreStatus.timestamp < end
+    ).order_by(StoreStatus.store_id, StoreStatus.timestamp))
+
+    return result.fetchall()
+
+
+# Report of created_at slid from the base state, polls that left each window are fed by age and the rest by finish
+# Stores whose store hours overlap or run past midnight are not slid, their week is replayed from its polls by replay
+class SlidingReport:
+
+    def __init__(self, base: DeltaState, created_at: datetime, tail: list):
+        self.base = base
+        self.tail = tail
+        self.window = report_window(created_at)
+        self.old_limits = report_window(from_epoch(base.created)).time_limit
+        self.aged = [{}, {}, {}]    # AgedStoreServices of each window by store_id
+        self.replayed = {}          # Stores replayed in full by store_id
+        self.count = len(tail)
+
+        # Stores polled in the new week, the base only knows when it last saw each of its stores
+        store_ids = {store_id: None for i, store_id in enumerate(base.store_ids) if base.seen[i] >= self.window.time_limit[0]}
+        for query in tail:
+            store_ids.setdefault(query.store_id)
+
+        self.stores = {}
+        reports = ReportArray(len(store_ids))
+        for ordinal, store_id in enumerate(store_ids):
+            store = DeltaStoreService(store_id, created_at, store_metadata.get_timezone(store_id, DEFAULT_TIMEZONE), reports, ordinal)
+            store.load_store_hours()
+            self.stores[store_id] = store
+
+            if overlapping_hours(store.store_hours):
+                self.replayed[store_id] = store
+                continue
+
+            i = base.index.get(store_id)
+            if i is not None:
+                store.report = base.reports[i]
+                store.last_seen = int(base.seen[i])
+
+                # A last poll before the new week is not fetched by a full report either, the next one starts afresh
+                if base.utcs[i, 0] >= self.window.time_limit[0]:
+                    store.restore(base.state(i, 0))
+
+
+    def aged_store(self, column: int, store_id: str):
+
+        aged = self.aged[column].get(store_id)
+        if aged is None:
+            i = self.base.index[store_id]
+            until = int(self.base.utcs[i, 0])
+            if column == 0:
+                aged = AgedStoreService(self.stores[store_id], column, self.old_limits, until)
+            else:
+                # Without a poll in store hours in the new week every seen poll is up to the week replay
+                week = self.aged[0].get(store_id)
+                after = week.first if week is not None and week.done else until
+                aged = AgedStoreService(self.stores[store_id], column, self.old_limits, until, self.base.state(i, column), after)
+            self.aged[column][store_id] = aged
+
+        return aged
+
+
+    # Replay polls that left a window, ordered by store then timestamp
+    def age(self, column: int, queries: list):
+
+        self.count += len(queries)
+        for query in queries:
+            if query.store_id in self.base.index and query.store_id in self.stores and query.store_id not in self.replayed:
+                self.aged_store(column, query.store_id).process_query(query)
+
+
+    # Stores still waiting for their first poll in store hours inside the new window, with the time to read on from
+    # Only stores whose last poll in store hours is inside the new window have one
+    def pending(self, column: int):
+
+        limit, pending = self.window.time_limit[column], {}
+        for i, store_id in enumerate(self.base.store_ids):
+            if self.base.utcs[i, 0] >= limit and store_id in self.stores and store_id not in self.replayed:
+                aged = self.aged_store(column, store_id)
+                if not aged.done and (aged.cursor is None or aged.cursor < aged.until):
+                    pending[store_id] = limit if aged.cursor is None else max(limit, aged.cursor + 1)
+
+        return pending
+
+
+    # Polls of the new week of the stores replayed in full, ordered by store then timestamp
+    def replay(self, queries: list):
+
+        self.count += len(queries)
+        for query in queries:
+            self.replayed[query.store_id].process_query(query)
+
+
+    # Process the polls the base has not seen, returns the stores of the new report
+    def finish(self):
+
+        base = self.base
+        for column in (1, 2):
+            for store_id, aged in self.aged[column].items():
+                if aged.captured is not None:
+                    self.stores[store_id].captured[column - 1] = aged.captured
+
+        # Polls of a store up to its last one in store hours were processed by the base, polls outside store hours change nothing
+        for query in self.tail:
+            timestamp, i = to_epoch(query.timestamp), base.index.get(query.store_id)
+            if query.store_id in self.replayed:
+                continue
+            if i is None or timestamp > base.utcs[i, 0]:
+                self.stores[query.store_id].process_poll(timestamp, query.status)
+
+        return self.stores
+
+
+# Slide the base state to created_at, returns DeltaStoreServices and the number of polls read
+# Reads the polls the base has not seen, and the polls that left each window up to the first one in store hours still inside
+# Stores with overlapping store hours read their whole week instead
+async def process_delta(base: DeltaState, created_at: datetime):
+
+    next_polls = text(NEXT_POLLS).columns(StoreStatus.store_id, StoreStatus.timestamp, StoreStatus.status)
+
+    async with semaphore:
+        async for db in get_db():
+            result = await db.execute(select(StoreStatus.store_id, StoreStatus.timestamp, StoreStatus.status).filter(
+                StoreStatus.timestamp > from_epoch(base.until),
+                StoreStatus.timestamp <= created_at
+            ).order_by(StoreStatus.store_id, StoreStatus.timestamp))
+            sliding = SlidingReport(base, created_at, result.fetchall())
+
+            for column, limit in enumerate(sliding.window.time_limit):
+                sliding.age(column, await fetch_polls(db, from_epoch(sliding.old_limits[column]), from_epoch(limit)))
+
+                # Polls outside store hours are skipped, stores given a full batch of them read on
+                pending = sliding.pending(column)
+                while pending:
+                    result = await db.execute(next_polls, {
+                        "store_ids": list(pending),
+                        "starts": [from_epoch(start) for start in pending.values()],
+                        "end": from_epoch(base.created),
+                        "count": NEXT_POLLS_COUNT,
+                    })
+                    queries = result.fetchall()
+                    sliding.age(column, queries)
+
+                    counts = Counter(query.store_id for query in queries)
+                    pending = {store_id: start for store_id, start in sliding.pending(column).items() if counts[store_id] == NEXT_POLLS_COUNT}
+
+            if sliding.replayed:
+                result = await db.execute(select(StoreStatus.store_id, StoreStatus.timestamp, StoreStatus.status).filter(
+                    StoreStatus.store_id.in_(list(sliding.replayed)),
+                    StoreStatus.timestamp >= created_at - timedelta(days=7),
+                    StoreStatus.timestamp <= created_at
+                ).order_by(StoreStatus.store_id, StoreStatus.timestamp))
+                sliding.replay(result.fetchall())
+
+    return sliding.finish(), sliding.count
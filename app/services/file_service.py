@@ -1,68 +1,299 @@
-from app.db import Report, get_db
-from app.utils import semaphore, ReportStatusEnum, ReportColumnEnum
+from .progress_service import JobCancelled, SERVER_ID
+from .blob_service import blob_store
+from .copy_service import encode_report_rows, COPY_HEADER, COPY_TRAILER
+from app.db import Report, get_db, REPORT_ROW_METRICS
+from app.utils import semaphore, ReportStatusEnum, ReportColumnEnum, ReportFormatEnum
+from app.utils.metrics import report_stage_seconds
+from app.core import settings
 
-from sqlalchemy.future import select
+from sqlalchemy import update, func
 
-import io, csv
+import io, csv, gzip, os, zlib, itertools, tempfile, time
 
-# Function to write all reports to csv file
-async def csv_writer(report_id: str, stores: dict):
+# Optional dependency, only needed for the columnar formats
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
-    csv_buffer = io.StringIO()
-    writer = csv.writer(csv_buffer)
+BATCH_SIZE = 10000
 
-    # Write headings
-    headings = [
-        'store_id', 
-        'uptime_last_hour', 
-        'uptime_last_day', 
-        'update_last_week', 
-        'downtime_last_hour', 
-        'downtime_last_day', 
-        'downtime_last_week'
-    ]
+HEADINGS = [
+    'store_id',
+    'uptime_last_hour',
+    'uptime_last_day',
+    'update_last_week',
+    'downtime_last_hour',
+    'downtime_last_day',
+    'downtime_last_week'
+]
 
-    writer.writerow(headings)
+MEDIA_TYPES = {
+    ReportFormatEnum.csv: "text/csv",
+    ReportFormatEnum.csv_gzip: "application/gzip",
+    ReportFormatEnum.parquet: "application/vnd.apache.parquet",
+    ReportFormatEnum.arrow: "application/vnd.apache.arrow.file",
+}
+
+EXTENSIONS = {
+    ReportFormatEnum.csv: "csv",
+    ReportFormatEnum.csv_gzip: "csv.gz",
+    ReportFormatEnum.parquet: "parquet",
+    ReportFormatEnum.arrow: "arrow",
+}
+
+
+# Raise if format can not be written in this environment
+def check_format(format: ReportFormatEnum):
+    if format in (ReportFormatEnum.parquet, ReportFormatEnum.arrow) and pa is None:
+        raise ValueError(f"{format.value} reports require pyarrow to be installed")
+
+
+# Writes report rows as csv to a binary sink, optionally gzip compressed, encoding batch by batch
+class CsvReportWriter:
+
+    def __init__(self, sink, compress: bool = False, headings: list = HEADINGS):
+        self.text = io.StringIO()
+        self.writer = csv.writer(self.text)
+        self.sink = sink
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        self.write_rows([headings])
+
+
+    def write_rows(self, rows: list):
+
+        self.writer.writerows(rows)
+        data = self.text.getvalue().encode('utf-8')
+        self.text.seek(0)
+        self.text.truncate()
+
+        self.sink.write(self.compressor.compress(data) if self.compressor is not None else data)
+
+
+    # The sink stays open
+    def close(self):
+        if self.compressor is not None:
+            self.sink.write(self.compressor.flush())
+
+
+# Writes report rows as record batches of a parquet or arrow ipc file to a binary sink
+class ArrowReportWriter:
+
+    def __init__(self, sink, parquet: bool, headings: list = HEADINGS):
+        self.schema = pa.schema([('store_id', pa.string())] + [(name, pa.int64()) for name in headings[1:]])
+        self.sink = pa.PythonFile(sink, mode='w')
+        self.writer = pq.ParquetWriter(self.sink, self.schema) if parquet else pa.ipc.new_file(self.sink, self.schema)
+
+
+    def write_rows(self, rows: list):
+        columns = list(zip(*rows)) if rows else [[] for _ in self.schema]
+        self.writer.write_batch(pa.record_batch(
+            [pa.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+            schema=self.schema
+        ))
+
+
+    # The sink stays open
+    def close(self):
+        self.writer.close()
+        self.sink.flush()
+
+
+def create_writer(sink, format: ReportFormatEnum, headings: list = HEADINGS):
+    check_format(format)
+
+    if format in (ReportFormatEnum.parquet, ReportFormatEnum.arrow):
+        return ArrowReportWriter(sink, parquet=format == ReportFormatEnum.parquet, headings=headings)
+
+    return CsvReportWriter(sink, compress=format == ReportFormatEnum.csv_gzip, headings=headings)
+
+
+# Report file written batch by batch to a temporary of the blob store, never held in memory
+# Rows for report_rows go to a temporary spool in binary COPY format, finalize_report loads them from there
+class ReportFile:
+
+    def __init__(self, report_id: str, format: ReportFormatEnum, headings: list = HEADINGS, store_rows: bool = False):
+        check_format(format)
+        self.report_id = report_id
+        self.file = blob_store.temporary()
+        self.writer = create_writer(self.file, format, headings)
+        self.spool = tempfile.TemporaryFile() if store_rows else None
+        self.count = 0
+
+        if self.spool is not None:
+            self.spool.write(COPY_HEADER)
+
+
+    def write_rows(self, rows: list):
+        self.writer.write_rows(rows)
+        if self.spool is not None:
+            self.spool.write(encode_report_rows(self.report_id, rows))
+        self.count += len(rows)
+
+
+    # Finish the file and store it, returns its blob key
+    def store(self):
+
+        self.writer.close()
+        self.file.close()
+        blob_key = blob_store.put_file(self.file.name)
+        self.file = None
+
+        if self.spool is not None:
+            self.spool.write(COPY_TRAILER)
+            self.spool.seek(0)
+
+        return blob_key
+
+
+    # Remove the temporaries, e.g. of a report that failed or was cancelled
+    def discard(self):
+
+        if self.file is not None:
+            self.file.close()
+            try:
+                os.unlink(self.file.name)
+            except FileNotFoundError:
+                pass
+            self.file = None
+
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+
+# Rows of the report, times in minutes for the last hour and in hours otherwise
+def report_rows(stores: dict):
 
-    # Write data
     for _, store in stores.items():
+        report = store.report
         data = [
             store.store_id,
-            store.report[ReportColumnEnum.uptime_last_hour.value],
-            store.report[ReportColumnEnum.uptime_last_day.value]/60,
-            store.report[ReportColumnEnum.uptime_last_week.value]/60,
-            store.report[ReportColumnEnum.downtime_last_hour.value],
-            store.report[ReportColumnEnum.downtime_last_day.value]/60,
-            store.report[ReportColumnEnum.downtime_last_week.value]/60,
+            report[ReportColumnEnum.uptime_last_hour.value],
+            report[ReportColumnEnum.uptime_last_day.value]/60,
+            report[ReportColumnEnum.uptime_last_week.value]/60,
+            report[ReportColumnEnum.downtime_last_hour.value],
+            report[ReportColumnEnum.downtime_last_day.value]/60,
+            report[ReportColumnEnum.downtime_last_week.value]/60,
         ]
 
         for i in range(1,7):
             data[i] = round(data[i])
 
-        writer.writerow(data)
+        yield data
+
+
+# Write rows to a writer batch by batch, rows can be any iterable
+def write_batches(writer, rows):
+
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, BATCH_SIZE))
+        if not batch:
+            break
+        writer.write_rows(batch)
+
+
+# Write rows to a report file in the given format on sink
+def write_report(rows, format: ReportFormatEnum, sink, headings: list = HEADINGS):
+
+    writer = create_writer(sink, format, headings)
+    write_batches(writer, rows)
+    writer.close()
+
+
+# Read rows back from a report file
+def read_report(file: bytes, format: ReportFormatEnum):
+
+    if format in (ReportFormatEnum.csv, ReportFormatEnum.csv_gzip):
+        stream = io.BytesIO(file) if format == ReportFormatEnum.csv else gzip.GzipFile(fileobj=io.BytesIO(file))
+        reader = csv.reader(io.TextIOWrapper(stream, encoding='utf-8'))
+        next(reader)
+        return ([row[0]] + [int(value) for value in row[1:]] for row in reader)
+
+    check_format(format)
+    table = pq.read_table(pa.BufferReader(file)) if format == ReportFormatEnum.parquet else pa.ipc.open_file(pa.BufferReader(file)).read_all()
+    return (list(row.values()) for row in table.to_pylist())
+
+
+# Convert a report file between formats
+def convert_report(file: bytes, source: ReportFormatEnum, target: ReportFormatEnum, headings: list = HEADINGS):
+
+    if source == target:
+        return file
+
+    sink = io.BytesIO()
+    write_report(read_report(file, source), target, sink, headings)
+    return sink.getvalue()
+
+
+# Function to write all reports to a file in the report's format, returns the key of the file in the blob store
+# Rows are the default report rows of stores unless given, e.g. rows of a report with custom windows
+async def csv_writer(report_id: str, stores: dict, format: ReportFormatEnum = ReportFormatEnum.csv, rows=None, headings: list = HEADINGS):
+
+    start = time.perf_counter()
+    rows = report_rows(stores) if rows is None else rows
+
+    # Reports with the default columns also keep their rows in report_rows
+    report_file = ReportFile(report_id, format, headings, store_rows=settings.REPORT_ROWS and headings == HEADINGS)
+    try:
+        write_batches(report_file, rows)
+    except BaseException:
+        report_file.discard()
+        raise
+    report_stage_seconds.observe(time.perf_counter() - start, stage="csv")
+
+    start = time.perf_counter()
+    blob_key = await finalize_report(report_id, report_file)
+    if blob_key is None:
+        raise JobCancelled(report_id)
+    report_stage_seconds.observe(time.perf_counter() - start, stage="finalize")
+
+    return blob_key
+
+
+# Abstraction function to make final changes to report, returns the blob key of its file or None if it was cancelled or re-queued meanwhile
+# The file goes to the blob store first, the reports table keeps only its key
+# Spooled rows are stored in report_rows in the same transaction, so completed reports always have all of them
+async def finalize_report(report_id: str, report_file: ReportFile):
 
-    csv_bytes = csv_buffer.getvalue().encode('utf-8')
+    try:
+        blob_key = report_file.store()
+        rows = report_file.spool
 
-    csv_buffer.close()
+        # Mark report status as completed
+        async with semaphore:
+            async for db in get_db():
 
-    await finalize_report(report_id, csv_bytes)
+                result = await db.execute(
+                    update(Report)
+                    .where(Report.id == report_id, Report.status == ReportStatusEnum.Running, Report.owner == SERVER_ID)
+                    .values(
+                        status=ReportStatusEnum.Completed, blob_key=blob_key, progress=100, finished_at=func.now(),
+                        row_count=None if rows is None else report_file.count
+                    )
+                )
+                completed = result.rowcount > 0
 
+                if completed and rows is not None and report_file.count:
+                    await insert_rows(db, rows)
+                await db.commit()
 
-# Abstraction function to make final changes to report
-async def finalize_report(report_id: str, file):
+                return blob_key if completed else None
 
-    # Mark report status as completed
-    async with semaphore:
-        async for db in get_db():
+    finally:
+        report_file.discard()
 
-            # Fetch report
-            result = await db.execute(select(Report).filter(Report.id == report_id))
-            report = result.scalars().first()
 
-            # Make changes to report
-            report.status = ReportStatusEnum.Completed
-            report.file = file
+# Bulk load a binary COPY spool of report rows with COPY on the session's connection, inside its transaction
+async def insert_rows(db, spool):
 
-            # Commit
-            await db.merge(report)
-            await db.commit()
+    connection = await db.connection()
+    raw = await connection.get_raw_connection()
+    await raw.driver_connection.copy_to_table(
+        "report_rows",
+        source=spool,
+        columns=["report_id", "store_id"] + REPORT_ROW_METRICS,
+        format="binary",
+    )
@@ -1,105 +1,322 @@
-from .store_service import StoreService
-from .file_service import csv_writer 
-from app.db import Store, StoreStatus, Report, get_db
+from .store_service import StoreService, ReportArray
+from .file_service import csv_writer, HEADINGS, report_rows as format_rows
+from .processor_service import QueryProcessor, create_processor
+from .vector_service import compare_reports
+from .calendar_service import from_epoch
+from .metadata_service import store_metadata, DEFAULT_TIMEZONE
+from .rollup_service import process_with_rollups
+from .copy_service import copy_polls
+from .snapshot_service import snapshot_current, snapshot_stores, snapshot_polls
+from .sql_service import process_with_sql
+from .timeline_service import process_with_timelines, parse_windows, window_headings, window_row, DEFAULT_WINDOWS
+from .delta_service import DeltaStoreService, ingestion_watermark, save_state, load_base, process_delta
+from .progress_service import JobProgress, JobCancelled, fail_report
+from app.db import Store, StoreHours, StoreStatus, Report, get_db
 from app.utils import logger, semaphore
+from app.utils.metrics import report_stage_seconds, report_rows, report_stores, reports_total, store_report_seconds
+from app.core import settings
 
 from sqlalchemy import func, literal
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from datetime import datetime, timedelta
-import traceback, asyncio
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+import traceback, time
 
 
-# Function to get db
+# Generate a report, returns the blob key of its file or None if generation failed or was cancelled
 async def generator(report_id: str):
 
+    progress = JobProgress([report_id])
+
     try:
         time0 = datetime.now()
+        streaming = settings.FETCH_MODE == "stream"
+        copying = settings.FETCH_MODE == "copy"
+        snapshots = settings.FETCH_MODE == "snapshot"
+        rollups = settings.ENGINE == "rollup"
+        pushdown = settings.ENGINE == "sql"
+        delta = settings.DELTA_MAX_MINUTES > 0 and settings.ENGINE == "python" and settings.SHARD_COUNT <= 1
+
+        # Read before any poll, a saved state vouches only for polls up to it
+        watermark = await ingestion_watermark() if delta else None
+
+        # Reports shortly after a saved one slide its state instead of reading the week
+        if delta:
+            blob_key = await generate_delta(report_id, watermark, progress)
+            if blob_key is not None:
+                return blob_key
+
+        # Polls newer than the snapshot are only in the database
+        if snapshots and not await snapshot_current():
+            logger.warning(f"{report_id} : Snapshot is behind ingestion, copying queries from db")
+            snapshots, copying = False, True
+
+        # The sql engine only needs rows to verify against the python engine
+        fetch_rows = not (streaming or copying or snapshots or rollups or pushdown or settings.ENGINE == "timeline") or (pushdown and settings.VERIFY_ENGINE)
 
         #### Step 1
         logger.info(f"{report_id} : Fetch stores and queries from db")
-        stores_list, queries, created_at = await fetch_stores_and_queries(report_id)
+        stores_list, queries, report = await fetch_stores_and_queries(report_id, fetch_rows=fetch_rows, from_snapshot=snapshots)
+        created_at = report.created_at
+
+        # Custom windows are only answered by timelines
+        windows = parse_windows(report.windows) if report.windows else None
+        timelines = settings.ENGINE == "timeline" or windows is not None
+        delta = delta and windows is None
         time1 = datetime.now()
         logger.info(f"{report_id} : Done fetching {(time1 - time0).total_seconds()}")
+        report_stage_seconds.observe((time1 - time0).total_seconds(), stage="fetch")
+        await progress.update(10, force=True)
 
         #### Step 2
         logger.info(f"{report_id} : Initializing store objects")
-        stores = await initialize_store_objects(stores_list, created_at)
+        stores = await initialize_store_objects(stores_list, created_at, DeltaStoreService if delta else StoreService)
+        expected = None
+        if settings.VERIFY_ENGINE and settings.ENGINE != "python" and not (rollups or timelines):
+            expected = await initialize_store_objects(stores_list, created_at)
+        processor = create_processor(stores, created_at, expected)
         time2 = datetime.now()
         logger.info(f"{report_id} : Done Initializing store objects {(time2 - time1).total_seconds()}")
+        report_stage_seconds.observe((time2 - time1).total_seconds(), stage="init")
+        await progress.update(20, force=True)
 
         #### Step 3
-        logger.info(f"{report_id} : Processing {len(queries)} queries sequentially")
-
-        for query in queries:
-            stores[query.store_id].process_query(query)
+        rows = None
+        if timelines:
+            # Bisects over cached per-store timelines, only polls newer than the last report are replayed
+            logger.info(f"{report_id} : Querying timelines")
+            minutes = await process_with_timelines(stores, created_at, windows or DEFAULT_WINDOWS)
+            if windows is None:
+                for store_id, values in minutes.items():
+                    stores[store_id].report = values
+            else:
+                rows = (window_row(store_id, values, windows) for store_id, values in minutes.items())
+        elif pushdown:
+            # Whole computation in Postgres, six numbers per store are returned
+            logger.info(f"{report_id} : Aggregating queries in Postgres")
+            processor.count = await process_with_sql(stores, created_at)
+            if queries is not None:
+                processor.verify(queries)
+                del queries
+        elif rollups:
+            # Sum hourly rollups, only hours at the window edges are replayed from raw queries
+            logger.info(f"{report_id} : Aggregating hourly rollups")
+            await process_with_rollups(stores, created_at)
+        elif streaming:
+            # Rows are fetched and processed chunk by chunk, overlapping with step 1
+            logger.info(f"{report_id} : Streaming queries with {settings.ENGINE} engine")
+            await stream_and_process(processor, created_at, progress)
+        elif copying:
+            # Binary COPY decoded into typed arrays, no row objects are built
+            logger.info(f"{report_id} : Copying queries with {settings.ENGINE} engine")
+            await copy_and_process(processor, created_at, progress)
+        elif snapshots:
+            # Day files mapped from the page cache, the database is not read
+            logger.info(f"{report_id} : Reading snapshot with {settings.ENGINE} engine")
+            await snapshot_polls(list(processor.stores), created_at, feed_polls(processor, progress))
+        else:
+            # Fed in chunks to report progress and notice cancellation
+            logger.info(f"{report_id} : Processing {len(queries)} queries with {settings.ENGINE} engine")
+            for i in range(0, len(queries), settings.STREAM_CHUNK_SIZE):
+                processor.feed(queries[i:i + settings.STREAM_CHUNK_SIZE])
+                await progress.update(20 + 60 * min(1, (i + settings.STREAM_CHUNK_SIZE) / len(queries)))
+            del queries
+
+        await processor.dispatch()
+        mismatches = processor.finish()
+        if mismatches is not None:
+            logger.info(f"{report_id} : Verified {settings.ENGINE} engine, {len(mismatches)} stores differ")
 
         time3 = datetime.now()
-        logger.info(f"{report_id} : Finished processing queries {(time3 - time2).total_seconds()}")
+        logger.info(f"{report_id} : Finished processing {processor.count} queries {(time3 - time2).total_seconds()}")
+        report_stage_seconds.observe((time3 - time2).total_seconds(), stage="process")
+        report_rows.observe(processor.count)
+        report_stores.observe(len(stores))
+        await progress.update(85, force=True)
+
+        if delta:
+            await save_state(report_id, stores, created_at, watermark)
 
         #### Step 4
-        logger.info(f"{report_id} : Generating csv report")
-        path = await csv_writer(report_id, stores)
+        logger.info(f"{report_id} : Generating {report.format.value} report")
+        headings = window_headings(windows) if windows is not None else HEADINGS
+        blob_key = await csv_writer(report_id, stores, report.format, rows, headings)
         time4 = datetime.now()
         logger.info(f"{report_id} : Finished generating report {(time4 - time3).total_seconds()}")
 
         logger.info(f"{report_id} : Total time: {(time4 - time0).total_seconds()}")
+        report_stage_seconds.observe((time4 - time0).total_seconds(), stage="total")
+        reports_total.inc(result="completed")
+
+        return blob_key
 
-    except Exception as _:
+    except JobCancelled:
+        logger.info(f"{report_id} : Cancelled")
+        reports_total.inc(result="cancelled")
+
+    except Exception as error:
         tb = traceback.format_exc()
         logger.error(tb)
+        await fail_report(report_id, repr(error))
+        reports_total.inc(result="failed")
+
+
+# Delta report from the state saved by a report shortly before, returns the blob key of its file or None if there is no state to start from
+async def generate_delta(report_id: str, watermark: datetime, progress: JobProgress):
+
+    time0 = datetime.now()
+    async with semaphore:
+        async for db in get_db():
+            result = await db.execute(select(Report).filter(Report.id == report_id))
+            report = result.scalars().first()
+
+    created_at = report.created_at
+    base = await load_base(created_at) if report.windows is None else None
+    if base is None:
+        return None
+
+    logger.info(f"{report_id} : Sliding the state of the report at {from_epoch(base.created)}")
+    await progress.update(20, force=True)
+    stores, count = await process_delta(base, created_at)
+
+    if settings.VERIFY_ENGINE:
+        mismatches = await verify_delta(stores, created_at)
+        logger.info(f"{report_id} : Verified delta report, {len(mismatches)} stores differ")
+
+    time1 = datetime.now()
+    logger.info(f"{report_id} : Finished processing {count} queries {(time1 - time0).total_seconds()}")
+    report_stage_seconds.observe((time1 - time0).total_seconds(), stage="process")
+    report_rows.observe(count)
+    report_stores.observe(len(stores))
+    await progress.update(85, force=True)
+
+    await save_state(report_id, stores, created_at, watermark)
+
+    logger.info(f"{report_id} : Generating {report.format.value} report")
+    blob_key = await csv_writer(report_id, stores, report.format)
+    time2 = datetime.now()
+    logger.info(f"{report_id} : Finished generating report {(time2 - time1).total_seconds()}")
+
+    logger.info(f"{report_id} : Total time: {(time2 - time0).total_seconds()}")
+    report_stage_seconds.observe((time2 - time0).total_seconds(), stage="total")
+    reports_total.inc(result="completed")
+
+    return blob_key
+
+
+# Compare a delta report with a full python engine report of the same week, returns ids of stores that differ
+async def verify_delta(stores: dict, created_at: datetime):
+
+    async with semaphore:
+        async for db in get_db():
+            stores_list = await fetch_stores(db, created_at)
+            queries = await fetch_queries(db, created_at)
+
+    expected = await initialize_store_objects(stores_list, created_at)
+    for query in queries:
+        expected[query.store_id].process_query(query)
+
+    missing = list(stores.keys() ^ expected.keys())
+    for store_id in missing:
+        logger.warning(f"Delta report mismatch, {store_id} is only in one of the reports")
+
+    return compare_reports(stores, {store_id: store for store_id, store in expected.items() if store_id in stores}) + missing
+
+
+# Feed queries to the processor as they arrive from a server side cursor
+async def stream_and_process(processor: QueryProcessor, created_at: datetime, progress: JobProgress):
+
+    async with semaphore:
+        async for db in get_db():
+            async for chunk in stream_queries(db, created_at, settings.STREAM_CHUNK_SIZE):
+
+                # Rows ingested after the stores were listed are skipped
+                processor.feed([query for query in chunk if query.store_id in processor.stores])
+
+                # Row count is unknown up front, only checks for cancellation
+                await progress.update(20)
+
+
+# Callback feeding decoded polls to the processor, only checks for cancellation as the row count is unknown up front
+def feed_polls(processor: QueryProcessor, progress: JobProgress):
+
+    async def on_chunk(codes, timestamps, statuses):
+        processor.feed_polls(codes, timestamps, statuses)
+        await progress.update(20)
+
+    return on_chunk
+
+
+# Feed polls to the processor as COPY TO STDOUT chunks are decoded
+async def copy_and_process(processor: QueryProcessor, created_at: datetime, progress: JobProgress):
+
+    # Rows of stores ingested after the stores were listed are dropped by the decoder
+    await copy_polls(list(processor.stores), created_at, feed_polls(processor, progress))
 
 
 # Abstraction function for initializing a dict of store_id: store_obj
-async def initialize_store_objects(stores_list: list, created_at: datetime):
+async def initialize_store_objects(stores_list: list, created_at: datetime, store_class: type = StoreService):
+
+    # Single bulk load, reused by later reports until ingestion changes the tables
+    await store_metadata.refresh()
 
+    # Reports of all stores live in one array, each store owns the row at its ordinal
     stores = {}
-    tasks = []
-    for store in stores_list:
-        store_obj = StoreService(store.store_id, created_at, store.timezone)
+    reports = ReportArray(len(stores_list))
+    for ordinal, store in enumerate(stores_list):
+        store_obj = store_class(store.store_id, created_at, store.timezone, reports, ordinal)
+        store_obj.load_store_hours()
         stores[store.store_id] = store_obj
-        tasks.append(store_obj.load_store_hours())
-    
-    await asyncio.gather(*tasks)
 
     return stores
 
 
 # Abstraction function for stores and queries
-async def fetch_stores_and_queries(report_id: str):
+async def fetch_stores_and_queries(report_id: str, fetch_rows: bool = True, from_snapshot: bool = False):
 
     async with semaphore:
         async for db in get_db():
             result = await db.execute(select(Report).filter(Report.id == report_id))
             report = result.scalars().first()
-            stores_list = await fetch_stores(db, report.created_at)
-            queries = await fetch_queries(db, report.created_at)
-            
-            return stores_list, queries, report.created_at
+            span = max(length for _, length in parse_windows(report.windows)) if report.windows else None
+            snapshot = from_snapshot and span is None
+            stores_list = await fetch_stores(db, report.created_at, span) if not snapshot else None
+            # Custom windows are answered by timelines, which read their own polls
+            queries = await fetch_queries(db, report.created_at) if fetch_rows and span is None else None
 
+    # Outside the semaphore, timezones come from the metadata index which takes it itself
+    if snapshot:
+        stores_list = await snapshot_stores(report.created_at)
 
-# Load timezones into memory
-async def fetch_stores(db: AsyncSession, created_at: datetime):
+    return stores_list, queries, report
 
-    default_timezone = 'America/Chicago'
 
-    time_limit = created_at - timedelta(days=7)
+# Load timezones into memory, of stores polled within span microseconds before created_at, a week by default
+async def fetch_stores(db: AsyncSession, created_at: datetime, span: int = None):
+
+    default_timezone = DEFAULT_TIMEZONE
+
+    time_limit = created_at - (timedelta(microseconds=span) if span else timedelta(days=7))
+
+    # Distinct stores of the window first, an index only scan of the pruned partitions, then join their timezones
+    active_stores = select(StoreStatus.store_id).filter(
+        StoreStatus.timestamp >= time_limit,
+        StoreStatus.timestamp <= created_at
+    ).distinct().subquery()
 
     query = select(
-        StoreStatus.store_id,
+        active_stores.c.store_id,
             func.coalesce(
                 Store.timezone_str, 
                 literal(default_timezone)
             ).label('timezone')
-        ).filter(
-            StoreStatus.timestamp >= time_limit, 
-            StoreStatus.timestamp <= created_at
         ).join(
             Store, 
-            StoreStatus.store_id==Store.store_id, 
+            active_stores.c.store_id==Store.store_id, 
             isouter=True
-        ).distinct(StoreStatus.store_id)
+        )
 
     result = await db.execute(query) # Get all timezones
     stores_list = result.fetchall()
@@ -107,17 +324,75 @@ async def fetch_stores(db: AsyncSession, created_at: datetime):
     return stores_list
 
 
-# Select all values where timestamp >= current timestamp - 7 days
-async def fetch_queries(db: AsyncSession, created_at: datetime):
+# All status requests within a week from current date and not later then current_time
+# Processing only needs each store's queries in time order, which is the order of the covering (store_id, timestamp) index
+def queries_statement(created_at: datetime):
 
     time_limit = created_at - timedelta(days=7)
 
-    # All status requests within a week from current date and not later then current_time
-    result = await db.execute(select(StoreStatus.store_id, StoreStatus.timestamp, StoreStatus.status).filter(
-        StoreStatus.timestamp >= time_limit, 
+    return select(StoreStatus.store_id, StoreStatus.timestamp, StoreStatus.status).filter(
+        StoreStatus.timestamp >= time_limit,
         StoreStatus.timestamp <= created_at
-    ).order_by(StoreStatus.timestamp))
+    ).order_by(StoreStatus.store_id, StoreStatus.timestamp)
+
+
+# Select all values where timestamp >= current timestamp - 7 days
+async def fetch_queries(db: AsyncSession, created_at: datetime):
+
+    result = await db.execute(queries_statement(created_at))
 
     queries = result.fetchall()
 
-    return queries
\ No newline at end of file
+    return queries
+
+
+# Same as fetch_queries but yields chunks from a server side cursor, memory stays bounded by chunk_size
+async def stream_queries(db: AsyncSession, created_at: datetime, chunk_size: int):
+
+    result = await db.stream(queries_statement(created_at).execution_options(max_row_buffer=chunk_size))
+
+    async for chunk in result.partitions(chunk_size):
+        yield chunk
+
+
+# Report row of a single store as {heading: value}, None if the store is unknown
+# Only that store's rows are read, through the (store_id, timestamp) index, metadata of other stores is not loaded
+async def generate_store_report(store_id: str, created_at: datetime = None):
+
+    start = time.perf_counter()
+
+    if created_at is None:
+        created_at = datetime.now(timezone.utc)
+    elif created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+
+    async with semaphore:
+        async for db in get_db():
+            result = await db.execute(select(Store.timezone_str).filter(Store.store_id == store_id))
+            timezone_str = result.scalar()
+
+            result = await db.execute(queries_statement(created_at).filter(StoreStatus.store_id == store_id))
+            queries = result.fetchall()
+
+            if timezone_str is None and not queries:
+                return None
+
+            result = await db.execute(select(
+                StoreHours.day_of_week,
+                StoreHours.start_time_local,
+                StoreHours.end_time_local
+            ).filter(StoreHours.store_id == store_id).order_by(StoreHours.id))
+
+            store_hours = defaultdict(list)
+            for row in result:
+                store_hours[row.day_of_week].append((row.start_time_local, row.end_time_local))
+
+    store = StoreService(store_id, created_at, timezone_str or DEFAULT_TIMEZONE)
+    store.store_hours = dict(store_hours)
+    for query in queries:
+        store.process_query(query)
+
+    row = next(format_rows({store_id: store}))
+    store_report_seconds.observe(time.perf_counter() - start)
+
+    return {"timestamp": created_at, **dict(zip(HEADINGS, row))}
@@ -0,0 +1,70 @@
+from app.db import get_db, Store, StoreHours, IngestionState
+from app.utils import semaphore, logger
+
+from sqlalchemy.future import select
+
+from collections import defaultdict
+import asyncio
+
+METADATA_VERSION_KEY = "metadata_version"
+DEFAULT_TIMEZONE = "America/Chicago"
+
+
+# Process wide index of the stores and store_hours tables, keyed by store_id
+class StoreMetadata:
+
+    def __init__(self):
+        self.timezones = {}
+        self.store_hours = {}
+        self.version = None
+        self.loaded = False
+        self.lock = asyncio.Lock()
+
+
+    # Reload both tables if ingestion has changed them since the last load
+    async def refresh(self):
+
+        async with self.lock:
+            async with semaphore:
+                async for db in get_db():
+
+                    result = await db.execute(select(IngestionState.value).filter(IngestionState.key == METADATA_VERSION_KEY))
+                    version = result.scalar()
+
+                    if self.loaded and version == self.version:
+                        return
+
+                    result = await db.execute(select(Store.store_id, Store.timezone_str))
+                    timezones = {row.store_id: row.timezone_str for row in result}
+
+                    result = await db.execute(select(
+                        StoreHours.store_id, 
+                        StoreHours.day_of_week, 
+                        StoreHours.start_time_local, 
+                        StoreHours.end_time_local
+                    ).order_by(StoreHours.id))
+
+                    store_hours = defaultdict(lambda: defaultdict(list))
+                    for row in result:
+                        store_hours[row.store_id][row.day_of_week].append((row.start_time_local, row.end_time_local))
+
+            self.timezones, self.store_hours = timezones, dict(store_hours)
+            self.version, self.loaded = version, True
+            logger.info(f"Loaded metadata of {len(timezones)} stores, {len(self.store_hours)} with store hours")
+
+
+    # Force a reload on next refresh
+    def invalidate(self):
+        self.loaded = False
+
+
+    # Store hours as {day_of_week: [(start, end)]}, shared between reports so must not be modified
+    def get_store_hours(self, store_id: str):
+        return self.store_hours.get(store_id, {})
+
+
+    def get_timezone(self, store_id: str, default: str = None):
+        return self.timezones.get(store_id, default)
+
+
+store_metadata = StoreMetadata()
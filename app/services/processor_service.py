@@ -0,0 +1,201 @@
+from .store_service import StoreService, ReportArray
+from .vector_service import QueryColumns, process_columns, compare_reports
+from app.utils import StatusEnum
+from app.core import settings
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import namedtuple
+from datetime import datetime
+import asyncio, multiprocessing, zlib
+import numpy as np
+
+# Picklable stand-in for a store_status row
+Query = namedtuple("Query", ["store_id", "timestamp", "status"])
+
+STATUSES = (StatusEnum.inactive, StatusEnum.active)
+
+executor = None
+
+
+# Step 3 of report generation, queries can be fed all at once or in chunks ordered by timestamp
+class QueryProcessor:
+
+    def __init__(self, stores: dict, created_at: datetime, expected: dict = None):
+        self.stores = stores
+        self.created_at = created_at
+        self.expected = expected    # Stores processed by the python engine for verification
+        self.columns = QueryColumns(list(stores.keys())) if settings.ENGINE == "numpy" else None
+        self.count = 0
+
+        # Stores by ordinal, for decoded polls
+        self.store_list = list(stores.values())
+        self.expected_list = list(expected.values()) if expected is not None else None
+
+
+    # Process a chunk of queries
+    def feed(self, queries: list):
+
+        self.count += len(queries)
+
+        if self.columns is not None:
+            self.columns.extend(queries)
+        else:
+            stores = self.stores
+            for query in queries:
+                stores[query.store_id].process_query(query)
+
+        self.verify(queries)
+
+
+    # Process a chunk of decoded polls, codes are store ordinals in the order of stores
+    def feed_polls(self, codes, timestamps, statuses):
+
+        self.count += len(codes)
+
+        if self.columns is not None:
+            self.columns.append_arrays(codes, timestamps, statuses)
+        else:
+            process_polls(self.store_list, codes, timestamps, statuses)
+
+        if self.expected is not None:
+            process_polls(self.expected_list, codes, timestamps, statuses)
+
+
+    # Process a chunk with the python engine into the expected stores
+    def verify(self, queries: list):
+        if self.expected is not None:
+            for query in queries:
+                self.expected[query.store_id].process_query(query)
+
+
+    # Hand off buffered queries to worker processes, nothing to do when processing in-process
+    async def dispatch(self):
+        pass
+
+
+    # Flush buffered work, returns ids of stores differing from the python engine when verifying
+    def finish(self):
+
+        if self.columns is not None:
+            process_columns(self.stores, self.columns, self.created_at)
+
+        if self.expected is not None:
+            return compare_reports(self.stores, self.expected)
+
+
+# Splits stores into shards by hash of store_id and processes every shard in its own process
+class ShardedQueryProcessor(QueryProcessor):
+
+    def __init__(self, stores: dict, created_at: datetime, shard_count: int, expected: dict = None):
+        super().__init__(stores, created_at, expected)
+        self.columns = None
+        self.shard_count = shard_count
+        self.shard_of = {store_id: shard_index(store_id, shard_count) for store_id in stores}
+        self.shards = [[] for _ in range(shard_count)]
+        self.polls = [[] for _ in range(shard_count)]
+
+        # Shard and ordinal within the shard of every store ordinal, for decoded polls
+        self.shard_codes = np.array([self.shard_of[store_id] for store_id in stores], dtype=np.int32)
+        self.local_codes = np.zeros(len(stores), dtype=np.int32)
+        for index in range(shard_count):
+            members = self.shard_codes == index
+            self.local_codes[members] = np.arange(np.count_nonzero(members), dtype=np.int32)
+
+
+    def feed(self, queries: list):
+
+        self.count += len(queries)
+
+        shards, shard_of = self.shards, self.shard_of
+        for query in queries:
+            shards[shard_of[query.store_id]].append(Query(query.store_id, query.timestamp, query.status))
+
+        self.verify(queries)
+
+
+    def feed_polls(self, codes, timestamps, statuses):
+
+        self.count += len(codes)
+
+        shards = self.shard_codes[codes]
+        for index, polls in enumerate(self.polls):
+            members = shards == index
+            if members.any():
+                polls.append((self.local_codes[codes[members]], timestamps[members], statuses[members]))
+
+        if self.expected is not None:
+            process_polls(self.expected_list, codes, timestamps, statuses)
+
+
+    # Run every shard in the pool and merge per store reports back
+    async def dispatch(self):
+
+        loop = asyncio.get_running_loop()
+        pool = get_executor()
+        tasks = []
+
+        for index, queries in enumerate(self.shards):
+            stores_meta = {
+                store_id: (store.timezone, store.store_hours)
+                for store_id, store in self.stores.items() if self.shard_of[store_id] == index
+            }
+            tasks.append(loop.run_in_executor(pool, process_shard, self.created_at, stores_meta, queries, settings.ENGINE, self.polls[index]))
+
+        self.shards = self.polls = None
+
+        for reports in await asyncio.gather(*tasks):
+            for store_id, report in reports.items():
+                self.stores[store_id].report = report
+
+
+# Stable across processes, unlike hash() of a str
+def shard_index(store_id: str, shard_count: int):
+    return zlib.crc32(store_id.encode()) % shard_count
+
+
+# Worker pool shared between reports, created on first use
+def get_executor():
+    global executor
+
+    if executor is None:
+        executor = ProcessPoolExecutor(
+            max_workers=settings.SHARD_COUNT, 
+            mp_context=multiprocessing.get_context("spawn")
+        )
+
+    return executor
+
+
+# Process decoded polls with the python engine, codes index stores
+def process_polls(stores: list, codes, timestamps, statuses):
+    for code, timestamp, status in zip(codes.tolist(), timestamps.tolist(), statuses.tolist()):
+        stores[code].process_poll(timestamp, STATUSES[status])
+
+
+# Worker entry point, processes the queries or decoded polls of one shard and returns store_id: report
+def process_shard(created_at: datetime, stores_meta: dict, queries: list, engine: str, polls: list = ()):
+
+    stores = {}
+    reports = ReportArray(len(stores_meta))
+    for ordinal, (store_id, (timezone, store_hours)) in enumerate(stores_meta.items()):
+        store = StoreService(store_id, created_at, timezone, reports, ordinal)
+        store.store_hours = store_hours
+        stores[store_id] = store
+
+    settings.ENGINE = engine
+    processor = QueryProcessor(stores, created_at)
+    processor.feed(queries)
+    for codes, timestamps, statuses in polls:
+        processor.feed_polls(codes, timestamps, statuses)
+    processor.finish()
+
+    return {store_id: store.report.tolist() for store_id, store in stores.items()}
+
+
+# Build the processor for the configured shard count
+def create_processor(stores: dict, created_at: datetime, expected: dict = None):
+
+    if settings.SHARD_COUNT > 1:
+        return ShardedQueryProcessor(stores, created_at, settings.SHARD_COUNT, expected)
+
+    return QueryProcessor(stores, created_at, expected)
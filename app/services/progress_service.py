@@ -0,0 +1,67 @@
+from app.db import get_db, Report
+from app.utils import ReportStatusEnum, semaphore
+
+from sqlalchemy import update, func
+
+import os, time, uuid
+
+PROGRESS_INTERVAL = 1.0     # Seconds between progress writes within a stage
+
+# Owner of the reports this server claims, inherited by its worker processes through the environment
+SERVER_ID = os.environ.setdefault("REPORT_SERVER_ID", str(uuid.uuid4()))
+
+
+# Raised at a progress checkpoint of a report cancelled while running
+class JobCancelled(Exception):
+    pass
+
+
+# Mark a running report as failed, reports cancelled or re-queued meanwhile are left alone
+async def fail_report(report_id: str, error: str):
+
+    async with semaphore:
+        async for db in get_db():
+            await db.execute(
+                update(Report)
+                .where(Report.id == report_id, Report.status == ReportStatusEnum.Running, Report.owner == SERVER_ID)
+                .values(status=ReportStatusEnum.Failed, error=error, finished_at=func.now())
+            )
+            await db.commit()
+
+
+# Writes the progress percentage of running reports generated together, every write doubles as a cancellation check and a heartbeat
+# Raises JobCancelled once all of them are cancelled or lost to another server, ids of those are kept in cancelled
+class JobProgress:
+
+    def __init__(self, report_ids: list):
+        self.report_ids = report_ids
+        self.cancelled = set()
+        self.percent = 0
+        self.written_at = 0
+
+
+    # Record progress, writes within PROGRESS_INTERVAL of the last one are skipped unless forced
+    async def update(self, percent: float, force: bool = False):
+
+        percent = int(percent)
+        now = time.monotonic()
+
+        if percent < self.percent or (not force and now - self.written_at < PROGRESS_INTERVAL):
+            return
+
+        self.percent, self.written_at = percent, now
+
+        # Not gated by the semaphore, checkpoints run inside stages already holding it
+        async for db in get_db():
+            result = await db.execute(
+                update(Report)
+                .where(Report.id.in_(self.report_ids), Report.owner == SERVER_ID)
+                .values(progress=percent, heartbeat_at=func.now())
+                .returning(Report.id, Report.status)
+            )
+            statuses = dict(result.fetchall())
+            await db.commit()
+
+        self.cancelled = {report_id for report_id in self.report_ids if statuses.get(report_id, ReportStatusEnum.Cancelled) != ReportStatusEnum.Running}
+        if len(self.cancelled) == len(self.report_ids):
+            raise JobCancelled(self.report_ids)
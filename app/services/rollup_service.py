@@ -0,0 +1,251 @@
+from .store_service import StoreService, report_window
+from .calendar_service import overlapping_hours, to_epoch, from_epoch, US, HOUR_US
+from .metadata_service import store_metadata, DEFAULT_TIMEZONE
+from app.db import get_db, StoreStatus, StoreStatusHourly, IngestionState
+from app.utils import StatusEnum, semaphore, logger
+from app.core import settings
+
+from sqlalchemy import func, text
+from sqlalchemy.future import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from collections import defaultdict
+from datetime import datetime, timezone
+import asyncio, heapq
+
+ROLLUP_WATERMARK_KEY = "rollup_watermark"
+UPSERT_BATCH_SIZE = 5000
+
+# Polls of each store within its own ranges, one index range scan per range instead of a scan of the week
+RANGE_POLLS = """
+    SELECT s.store_id, p.timestamp, p.status
+    FROM unnest(CAST(:store_ids AS varchar[]), CAST(:starts AS timestamptz[]), CAST(:ends AS timestamptz[])) AS s(store_id, start, stop)
+    CROSS JOIN LATERAL (
+        SELECT timestamp, status FROM store_status
+        WHERE store_status.store_id = s.store_id AND timestamp >= s.start AND timestamp < s.stop
+    ) p
+    ORDER BY s.store_id, p.timestamp
+"""
+
+rollup_lock = asyncio.Lock()
+
+
+# Start of the UTC hour containing timestamp
+def floor_hour(timestamp: datetime):
+    return timestamp.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+# StoreService adding up/down minutes to the UTC hour of the poll that closes them instead of the report windows
+# Each hour with a poll in store hours keeps the state after it, so a replay can skip whole hours and continue from there
+class HourlyStoreService(StoreService):
+
+    __slots__ = ("hour", "buckets")
+
+    def __init__(self, store_id: str, created_at: datetime, timezone: str):
+        super().__init__(store_id, created_at, timezone)
+        self.hour = None
+        self.buckets = {}  # Epoch microseconds of the hour to [uptime, downtime, state]
+
+
+    def add_time(self, last_time: tuple, current_time: tuple, status: StatusEnum):
+        bucket = self.buckets.setdefault(self.hour, [0, 0, None])
+        bucket[0 if status == StatusEnum.active else 1] += (current_time[0] - last_time[0])/US/60
+
+
+    def process_poll(self, timestamp: int, status: StatusEnum):
+
+        self.hour = timestamp - timestamp % HOUR_US
+        super().process_poll(timestamp, status)
+
+        if self.last_utc == timestamp:
+            self.buckets.setdefault(self.hour, [0, 0, None])[2] = self.state()
+
+
+# Epoch microsecond ranges [start, end) of the raw polls a store's report replays, given its rollup rows as {hour: state}
+# Those are the hour of each window start and of its first poll in store hours, and the hour of created_at
+# Other hours only hold polls after the first one in store hours of every window they are in, their minutes count in full
+def raw_ranges(store: StoreService, rows: dict):
+
+    created, limits = store.window.created, store.window.time_limit
+    if overlapping_hours(store.store_hours):
+        return [(limits[0], created + 1)]
+
+    last_hour = created - created % HOUR_US
+    hours = {limit - limit % HOUR_US for limit in limits} | {last_hour}
+
+    for limit in limits:
+        hour = limit - limit % HOUR_US
+        if hour not in rows or rows[hour][1] < limit:
+            hour = min((other for other in rows if hour < other < last_hour), default=None)
+            if hour is not None:
+                hours.add(hour)
+
+    return [(max(hour, limits[0]), min(hour + HOUR_US, created + 1)) for hour in sorted(hours)]
+
+
+# Fill the report of a store from its rollup rows [(hour, uptime, downtime, state)] and the raw polls of its raw_ranges
+# Polls are replayed by the store itself, rows of the hours in between add their minutes to the windows already started
+def combine_rollups(store: StoreService, rows: list, ranges: list, queries: list):
+
+    values, base, limits = store.reports.values, store.ordinal * 6, store.window.time_limit
+
+    skipped = [row for row in rows if not any(start < row[0] + HOUR_US and row[0] < end for start, end in ranges)]
+    events = heapq.merge(
+        ((hour, 0, row) for hour, *row in skipped),
+        ((to_epoch(query.timestamp), 1, query) for query in queries),
+        key=lambda event: event[:2]
+    )
+
+    for _, kind, event in events:
+        if kind:
+            store.process_query(event)
+            continue
+
+        uptime, downtime, state = event
+        for i, limit in enumerate(limits):
+            if store.last_utc is not None and store.last_utc >= limit:
+                values[base + i] += uptime
+                values[base + 3 + i] += downtime
+        store.restore(state)
+
+
+# Bring store_status_hourly up to date with store_status, only hours touched by new polls are recomputed
+async def refresh_rollups():
+
+    async with rollup_lock:
+        await store_metadata.refresh()
+
+        async with semaphore:
+            async for db in get_db():
+
+                result = await db.execute(select(func.min(StoreStatus.timestamp), func.max(StoreStatus.timestamp)))
+                first, last = result.first()
+
+                result = await db.execute(select(IngestionState.value).filter(IngestionState.key == ROLLUP_WATERMARK_KEY))
+                watermark = result.scalar()
+                watermark = datetime.fromisoformat(watermark) if watermark is not None else None
+
+                if last is None or (watermark is not None and watermark >= last):
+                    return
+
+                # Hours before the watermark's hour only depend on polls up to it, later ones continue from the state left by them
+                start = floor_hour(first) if watermark is None else floor_hour(watermark)
+                states = {}
+                if watermark is not None:
+                    result = await db.execute(select(
+                        StoreStatusHourly.store_id,
+                        StoreStatusHourly.last_wall, StoreStatusHourly.last_utc, StoreStatusHourly.last_status, StoreStatusHourly.last_fold
+                    ).filter(StoreStatusHourly.hour < start).distinct(StoreStatusHourly.store_id).order_by(
+                        StoreStatusHourly.store_id, StoreStatusHourly.hour.desc()
+                    ))
+                    states = {store_id: tuple(state) for store_id, *state in result}
+
+                time0 = datetime.now()
+                stores = {}
+                count = 0
+
+                result = await db.stream(select(StoreStatus.store_id, StoreStatus.timestamp, StoreStatus.status).filter(
+                    StoreStatus.timestamp >= start,
+                    StoreStatus.timestamp <= last
+                ).order_by(StoreStatus.store_id, StoreStatus.timestamp))
+
+                async for chunk in result.partitions(settings.STREAM_CHUNK_SIZE):
+                    for query in chunk:
+                        store = stores.get(query.store_id)
+                        if store is None:
+                            store = HourlyStoreService(query.store_id, last, store_metadata.get_timezone(query.store_id, DEFAULT_TIMEZONE))
+                            store.load_store_hours()
+                            if query.store_id in states:
+                                store.restore(states[query.store_id])
+                            stores[query.store_id] = store
+                        store.process_query(query)
+                    count += len(chunk)
+
+                rows = [
+                    {
+                        "store_id": store_id, "hour": from_epoch(hour), "uptime_minutes": uptime, "downtime_minutes": downtime,
+                        "last_wall": state[0], "last_utc": state[1], "last_status": state[2], "last_fold": state[3],
+                    }
+                    for store_id, store in stores.items()
+                    for hour, (uptime, downtime, state) in store.buckets.items()
+                ]
+                await upsert_rollups(db, rows)
+
+                await db.execute(insert(IngestionState).values(key=ROLLUP_WATERMARK_KEY, value=last.isoformat()).on_conflict_do_update(
+                    index_elements=[IngestionState.key],
+                    set_={"value": last.isoformat(), "updated_at": func.now()}
+                ))
+                await db.commit()
+
+                logger.info(f"Rolled up {count} queries into {len(rows)} hours from {start} in {(datetime.now() - time0).total_seconds()}")
+
+
+# Insert or overwrite hourly buckets
+async def upsert_rollups(db: AsyncSession, rows: list):
+
+    for i in range(0, len(rows), UPSERT_BATCH_SIZE):
+        statement = insert(StoreStatusHourly).values(rows[i:i + UPSERT_BATCH_SIZE])
+        await db.execute(statement.on_conflict_do_update(
+            index_elements=[StoreStatusHourly.store_id, StoreStatusHourly.hour],
+            set_={
+                "uptime_minutes": statement.excluded.uptime_minutes,
+                "downtime_minutes": statement.excluded.downtime_minutes,
+                "last_wall": statement.excluded.last_wall,
+                "last_utc": statement.excluded.last_utc,
+                "last_status": statement.excluded.last_status,
+                "last_fold": statement.excluded.last_fold,
+            }
+        ))
+
+
+# Periodic job keeping rollups current as new store_status data is ingested
+async def rollup_job():
+
+    while True:
+        try:
+            await refresh_rollups()
+        except Exception as _:
+            logger.exception("Rollup job failed")
+
+        await asyncio.sleep(settings.ROLLUP_INTERVAL)
+
+
+# Fill store reports from hourly rollups, raw polls are read only for the hours raw_ranges needs
+async def process_with_rollups(stores: dict, created_at: datetime):
+
+    await refresh_rollups()
+
+    window = report_window(created_at)
+    week_hour, last_hour = (timestamp - timestamp % HOUR_US for timestamp in (window.time_limit[0], window.created))
+    range_polls = text(RANGE_POLLS).columns(StoreStatus.store_id, StoreStatus.timestamp, StoreStatus.status)
+
+    async with semaphore:
+        async for db in get_db():
+            result = await db.execute(select(
+                StoreStatusHourly.store_id, StoreStatusHourly.hour, StoreStatusHourly.uptime_minutes, StoreStatusHourly.downtime_minutes,
+                StoreStatusHourly.last_wall, StoreStatusHourly.last_utc, StoreStatusHourly.last_status, StoreStatusHourly.last_fold
+            ).filter(
+                StoreStatusHourly.hour >= from_epoch(week_hour),
+                StoreStatusHourly.hour < from_epoch(last_hour)
+            ).order_by(StoreStatusHourly.store_id, StoreStatusHourly.hour))
+
+            rows = defaultdict(list)
+            for store_id, hour, uptime, downtime, *state in result:
+                if store_id in stores:
+                    rows[store_id].append((to_epoch(hour), uptime, downtime, tuple(state)))
+
+            ranges = {store_id: raw_ranges(store, {row[0]: row[3] for row in rows[store_id]}) for store_id, store in stores.items()}
+            pairs = [(store_id, start, end) for store_id, store_ranges in ranges.items() for start, end in store_ranges]
+
+            result = await db.execute(range_polls, {
+                "store_ids": [store_id for store_id, _, _ in pairs],
+                "starts": [from_epoch(start) for _, start, _ in pairs],
+                "ends": [from_epoch(end) for _, _, end in pairs],
+            })
+            queries = defaultdict(list)
+            for query in result:
+                queries[query.store_id].append(query)
+
+    for store_id, store in stores.items():
+        combine_rollups(store, rows[store_id], ranges[store_id], queries[store_id])
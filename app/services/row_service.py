@@ -0,0 +1,127 @@
+from app.db import ReportRow, REPORT_ROW_METRICS
+
+from sqlalchemy import tuple_
+from sqlalchemy.future import select
+
+import base64, json, operator
+
+ROW_COLUMNS = ["store_id"] + REPORT_ROW_METRICS
+MAX_LIMIT = 1000
+
+OPERATORS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "gt": operator.gt,
+    "gte": operator.ge,
+}
+
+
+def row_column(name: str):
+    if name not in ROW_COLUMNS:
+        raise ValueError(f"Unknown column {name}, expected one of {', '.join(ROW_COLUMNS)}")
+    return getattr(ReportRow, name)
+
+
+# Projection like store_id,downtime_last_day, all columns if empty
+def parse_fields(fields: str = None):
+    if not fields:
+        return list(ROW_COLUMNS)
+    names = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    for name in names:
+        row_column(name)
+    return names
+
+
+# Filter like downtime_last_day:gte:2 or store_id:eq:<id>, returns (condition, canonical expression)
+def parse_filter(expression: str):
+
+    name, _, rest = expression.partition(":")
+    op, _, value = rest.partition(":")
+
+    column = row_column(name.strip())
+    if op not in OPERATORS:
+        raise ValueError(f"Unknown operator {op} in filter {expression}, expected one of {', '.join(OPERATORS)}")
+
+    if name.strip() != "store_id":
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError(f"Filter {expression} needs an integer value")
+
+    return OPERATORS[op](column, value), f"{name.strip()}:{op}:{value}"
+
+
+# Sort like downtime_last_day, descending with a leading -, returns (name, descending)
+def parse_sort(sort: str = None):
+    if not sort:
+        return "store_id", False
+    name = sort.lstrip("-")
+    row_column(name)
+    return name, sort.startswith("-")
+
+
+# Opaque cursor of the keyset values of the last row of a page
+# It carries the report, sort and filters it pages through, so it can not be replayed against another query
+def encode_cursor(query: dict, values: list):
+    return base64.urlsafe_b64encode(json.dumps({"query": query, "after": values}).encode()).decode()
+
+
+def decode_cursor(cursor: str, query: dict, size: int):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+
+    if not isinstance(payload, dict) or not isinstance(payload.get("after"), list) or len(payload["after"]) != size:
+        raise ValueError("Invalid cursor")
+    if payload.get("query") != query:
+        raise ValueError("Cursor belongs to a query with another report, sort or filters")
+
+    return payload["after"]
+
+
+# One page of the rows of a report, returns (rows as dicts of the projected fields, cursor of the next page or None)
+# Pages are ordered by the sort column then store_id, the next page starts after the keyset of the last row instead of an offset
+async def query_rows(db, report_id: str, fields: str = None, filters: list = None, sort: str = None, limit: int = 100, after: str = None):
+
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+
+    names = parse_fields(fields)
+    conditions, expressions = [], []
+    for expression in filters or []:
+        condition, canonical = parse_filter(expression)
+        conditions.append(condition)
+        expressions.append(canonical)
+    sort_name, descending = parse_sort(sort)
+
+    keyset = [sort_name] if sort_name == "store_id" else [sort_name, "store_id"]
+    key_columns = [row_column(name) for name in keyset]
+    spec = {"report_id": report_id, "sort": sort_name, "descending": descending, "filters": sorted(set(expressions))}
+
+    if after is not None:
+        values = decode_cursor(after, spec, len(keyset))
+        position, last = tuple_(*key_columns), tuple_(*values)
+        conditions.append(position < last if descending else position > last)
+
+    selected = list(dict.fromkeys(names + keyset))
+    query = (
+        select(*[row_column(name) for name in selected])
+        .filter(ReportRow.report_id == report_id, *conditions)
+        .order_by(*[column.desc() if descending else column for column in key_columns])
+        .limit(limit + 1)
+    )
+
+    result = await db.execute(query)
+    records = result.fetchall()
+
+    cursor = None
+    if len(records) > limit:
+        records = records[:limit]
+        last = dict(zip(selected, records[-1]))
+        cursor = encode_cursor(spec, [last[name] for name in keyset])
+
+    rows = [{name: value for name, value in zip(selected, record) if name in names} for record in records]
+    return rows, cursor
@@ -0,0 +1,259 @@
+from .generator_service import generator
+from .batch_service import batch_generator
+from .cache_service import report_cache
+from .progress_service import fail_report, SERVER_ID
+from app.db import get_db, Report
+from app.utils import ReportStatusEnum, semaphore, logger
+from app.utils.metrics import reports_in_flight, report_queue_depth, report_queue_seconds, export_metrics, merge_metrics, reset_metrics
+from app.core import settings
+
+from sqlalchemy import update, func
+from sqlalchemy.future import select
+
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio, multiprocessing
+
+worker_loop = None
+
+
+# Generate a claimed report, or all reports of a claimed batch, returns {report_id: blob key or None}
+async def generate(report_ids: list):
+    if len(report_ids) == 1:
+        return {report_ids[0]: await generator(report_ids[0])}
+    return await batch_generator(report_ids)
+
+
+# Worker process entry point, reports of a worker share one event loop so db connections and caches are reused
+def run_job(report_ids: list):
+    global worker_loop
+
+    if worker_loop is None:
+        worker_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(worker_loop)
+
+    # Workers run one job at a time, metrics of this job are sent back to the server
+    reset_metrics()
+    blob_keys = worker_loop.run_until_complete(generate(report_ids))
+
+    return blob_keys, export_metrics()
+
+
+# Runs queued reports from the reports table on a bounded pool of worker processes
+# Claiming uses SKIP LOCKED, so several servers can share one queue
+# Claimed reports are leased to this server and renewed by a heartbeat, any server queues reports with an expired lease again
+class ReportScheduler:
+
+    def __init__(self, workers: int, poll_interval: int, lease: int):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.running = {}   # first report_id of a job: task
+        self.pool = None
+        self.task = None
+        self.wakeup = None
+
+
+    # Re-queue reports left running by a crashed server and start scheduling
+    async def start(self):
+        self.wakeup = asyncio.Event()
+        await self.recover()
+        self.task = asyncio.create_task(self.run())
+
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+
+    # Check the queue now instead of at the next poll
+    def wake(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self.pool
+
+
+    # Reports of a crashed server stay Running forever otherwise
+    # Only expired leases are taken over, reports of live servers keep running there
+    async def recover(self):
+
+        heartbeat_at = func.coalesce(Report.heartbeat_at, Report.started_at, Report.queued_at)
+
+        async with semaphore:
+            async for db in get_db():
+                result = await db.execute(
+                    update(Report)
+                    .where(Report.status == ReportStatusEnum.Running, heartbeat_at < func.now() - timedelta(seconds=self.lease))
+                    .values(status=ReportStatusEnum.Queued, progress=0, started_at=None, owner=None, heartbeat_at=None)
+                    .returning(Report.id)
+                )
+                recovered = result.scalars().all()
+                await db.commit()
+
+        if recovered:
+            logger.info(f"Re-queued {len(recovered)} orphaned reports")
+
+
+    # Renew the lease of the reports this server is running, also between their progress writes
+    async def heartbeat(self):
+
+        if not self.running:
+            return
+
+        async with semaphore:
+            async for db in get_db():
+                await db.execute(
+                    update(Report)
+                    .where(Report.owner == SERVER_ID, Report.status == ReportStatusEnum.Running)
+                    .values(heartbeat_at=func.now())
+                )
+                await db.commit()
+
+
+    async def run(self):
+
+        while True:
+            self.wakeup.clear()
+
+            try:
+                await self.heartbeat()
+                await self.recover()
+
+                while len(self.running) < max(self.workers, 1):
+                    report_ids = await self.claim()
+                    if not report_ids:
+                        break
+                    self.running[report_ids[0]] = asyncio.create_task(self.execute(report_ids))
+
+                report_queue_depth.set(await self.queued())
+
+            except Exception as _:
+                logger.exception("Report scheduler failed")
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+    # Mark the next queued report as Running, highest priority first then oldest, with the rest of its batch
+    # Returns the claimed report ids, empty if the queue is empty
+    async def claim(self):
+
+        next_report = select(Report.id).filter(
+            Report.status == ReportStatusEnum.Queued
+        ).order_by(
+            Report.priority.desc(), Report.queued_at
+        ).limit(1).with_for_update(skip_locked=True).scalar_subquery()
+
+        async with semaphore:
+            async for db in get_db():
+                result = await db.execute(
+                    update(Report)
+                    .where(Report.id == next_report)
+                    .values(status=ReportStatusEnum.Running, progress=0, started_at=func.now(), owner=SERVER_ID, heartbeat_at=func.now())
+                    .returning(Report.id, Report.batch_id, Report.started_at - Report.queued_at)
+                )
+                claimed = result.fetchall()
+
+                if claimed and claimed[0].batch_id is not None:
+                    result = await db.execute(
+                        update(Report)
+                        .where(Report.batch_id == claimed[0].batch_id, Report.status == ReportStatusEnum.Queued)
+                        .values(status=ReportStatusEnum.Running, progress=0, started_at=func.now(), owner=SERVER_ID, heartbeat_at=func.now())
+                        .returning(Report.id, Report.batch_id, Report.started_at - Report.queued_at)
+                    )
+                    claimed += result.fetchall()
+
+                await db.commit()
+
+        for _, _, waited in claimed:
+            if waited is not None:
+                report_queue_seconds.observe(waited.total_seconds())
+
+        return [report_id for report_id, _, _ in claimed]
+
+
+    async def queued(self):
+
+        async with semaphore:
+            async for db in get_db():
+                result = await db.execute(select(func.count(Report.id)).filter(Report.status == ReportStatusEnum.Queued))
+                return result.scalar()
+
+
+    # Generate claimed reports in a worker process, or in the event loop without workers
+    async def execute(self, report_ids: list):
+
+        reports_in_flight.inc(len(report_ids))
+        pool = None
+
+        try:
+            if self.workers > 0:
+                loop = asyncio.get_running_loop()
+                pool = self.get_pool()
+                blob_keys, metrics = await loop.run_in_executor(pool, run_job, report_ids)
+                merge_metrics(metrics)
+            else:
+                blob_keys = await generate(report_ids)
+
+            for report_id, blob_key in blob_keys.items():
+                if blob_key is None:
+                    report_cache.fail(report_id)
+                else:
+                    report_cache.complete(report_id, blob_key)
+
+        except Exception as error:
+            logger.exception(f"{report_ids[0]} : Report job failed")
+
+            # A worker died, e.g. killed for memory, the pool can not be used anymore
+            if isinstance(error, BrokenProcessPool) and self.pool is pool:
+                self.pool = None
+
+            for report_id in report_ids:
+                report_cache.fail(report_id)
+                await fail_report(report_id, repr(error))
+
+        finally:
+            reports_in_flight.dec(len(report_ids))
+            self.running.pop(report_ids[0], None)
+            self.wake()
+
+
+# Cancel a queued or running report, returns its status or None if it does not exist
+# Running reports stop at their next progress checkpoint
+async def cancel_report(report_id: str):
+
+    async with semaphore:
+        async for db in get_db():
+            result = await db.execute(
+                update(Report)
+                .where(Report.id == report_id, Report.status.in_([ReportStatusEnum.Queued, ReportStatusEnum.Running]))
+                .values(status=ReportStatusEnum.Cancelled, finished_at=func.now())
+                .returning(Report.status)
+            )
+            status = result.scalar()
+            await db.commit()
+
+            if status is None:
+                result = await db.execute(select(Report.status).filter(Report.id == report_id))
+                return result.scalar()
+
+    # Next trigger for the same timestamp generates a new report
+    report_cache.fail(report_id)
+    return status
+
+
+scheduler = ReportScheduler(settings.REPORT_WORKERS, settings.SCHEDULER_POLL_INTERVAL, settings.REPORT_LEASE_SECONDS)
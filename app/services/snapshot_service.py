@@ -0,0 +1,222 @@
+from .copy_service import CopyDecoder
+from .calendar_service import to_epoch, DAY_US
+from .metadata_service import store_metadata, DEFAULT_TIMEZONE
+from app.db import get_db, IngestionState
+from app.utils import semaphore
+from app.core import settings
+
+from sqlalchemy.future import select
+
+from collections import namedtuple
+from datetime import date, datetime, time, timedelta, timezone
+import json, os, shutil
+import numpy as np
+
+MANIFEST = "manifest.json"
+WATERMARK_KEY = "store_status_watermark"   # Written by ingestion with the rows it merged
+
+# Same columns as the COPY fetch path, one UTC day at a time
+DAY_QUERY = """
+    COPY (
+        SELECT store_id, timestamp, status = 'active'
+        FROM store_status
+        WHERE timestamp >= %(start)s AND timestamp < %(end)s AND status IS NOT NULL
+        ORDER BY store_id, timestamp
+    ) TO STDOUT WITH (FORMAT binary)
+"""
+
+# Like a row of fetch_stores
+SnapshotStore = namedtuple("SnapshotStore", ["store_id", "timezone"])
+
+
+# Polls of one UTC day, sorted by store then timestamp
+# store_ids is the store dictionary, polls of store i are rows offsets[i] to offsets[i + 1] of timestamps and statuses
+class SnapshotDay:
+
+    def __init__(self, path: str):
+        self.day = date.fromisoformat(os.path.basename(path))
+        self.store_ids = [store_id.decode() for store_id in np.load(os.path.join(path, "store_ids.npy")).tolist()]
+        self.index = {store_id: i for i, store_id in enumerate(self.store_ids)}
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.timestamps = np.load(os.path.join(path, "timestamps.npy"), mmap_mode="r")
+        self.statuses = np.load(os.path.join(path, "statuses.npy"), mmap_mode="r")
+
+
+    # Zero copy views of the polls of one store, None if it has none this day
+    def polls(self, store_id: str):
+        i = self.index.get(store_id)
+        if i is None:
+            return None
+        return self.timestamps[self.offsets[i]:self.offsets[i + 1]], self.statuses[self.offsets[i]:self.offsets[i + 1]]
+
+
+    # Day codes, timestamps and statuses of polls from start to end epoch microseconds
+    # Only the first and last day of a window are filtered, the days between are returned as views of the mapped files
+    def window(self, start: int, end: int):
+
+        codes = np.repeat(np.arange(len(self.store_ids), dtype=np.int32), np.diff(self.offsets))
+        timestamps, statuses = self.timestamps, self.statuses
+
+        day_start = to_epoch(datetime.combine(self.day, time(), timezone.utc))
+        if day_start < start or day_start + DAY_US > end:
+            inside = (timestamps >= start) & (timestamps <= end)
+            codes, timestamps, statuses = codes[inside], timestamps[inside], statuses[inside]
+
+        return codes, timestamps, statuses
+
+
+# Snapshot directory written by ingestion, a manifest lists its days and the ingestion watermark it reflects
+class Snapshot:
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.manifest = read_manifest(directory)
+
+
+    def day_path(self, day: date):
+        return os.path.join(self.directory, day.isoformat())
+
+
+    # Days overlapping the week before created_at, days without polls have no files
+    def days(self, created_at: datetime):
+        last = created_at.astimezone(timezone.utc)
+        first, last = (last - timedelta(days=7)).date(), last.date()
+        return [
+            SnapshotDay(self.day_path(date.fromisoformat(day)))
+            for day in self.manifest["days"] if first <= date.fromisoformat(day) <= last
+        ]
+
+
+def read_manifest(directory: str):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"watermark": None, "days": []}
+
+
+def write_manifest(directory: str, manifest: dict):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+# Write the snapshot of one day from the database, replacing an older one of the same day
+def write_day(curr, directory: str, day: date):
+
+    decoder = CopyDecoder()
+    chunks = []
+
+    # copy_expert writes the stream chunk by chunk, each one is decoded right away
+    class Sink:
+        def write(self, data):
+            chunks.append(decoder.decode(bytes(data)))
+
+    start = datetime.combine(day, time(), timezone.utc)
+    curr.copy_expert(curr.mogrify(DAY_QUERY, {"start": start, "end": start + timedelta(days=1)}).decode(), Sink())
+    if not decoder.done or decoder.rest:
+        raise ValueError(f"Incomplete binary COPY stream of {day}")
+
+    if chunks:
+        codes, timestamps, statuses = (np.concatenate(column) for column in zip(*chunks))
+    else:
+        codes, timestamps, statuses = decoder.empty()
+
+    store_ids = list(decoder.store_index)
+    offsets = np.searchsorted(codes, np.arange(len(store_ids) + 1)).astype(np.int64)
+
+    path = os.path.join(directory, day.isoformat())
+    temporary = path + ".tmp"
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+
+    np.save(os.path.join(temporary, "store_ids.npy"), np.array(store_ids, dtype=bytes) if store_ids else np.array([], dtype="S1"))
+    np.save(os.path.join(temporary, "offsets.npy"), offsets)
+    np.save(os.path.join(temporary, "timestamps.npy"), timestamps)
+    np.save(os.path.join(temporary, "statuses.npy"), statuses)
+
+    # Reports still mapping the old files keep reading them until they are done
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temporary, path)
+
+    return len(codes)
+
+
+# Bring the snapshot in line with a finished ingestion, called after its commit
+# Days with new polls are rewritten, dropped days are removed, full loads start from an empty snapshot
+def write_snapshots(curr, directory: str, days: list, dropped: list, watermark: str, full: bool):
+
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+
+    removed = {day.isoformat() for day in dropped}
+    written = [day for day in days if day.isoformat() not in removed]
+    listed = (set() if full else set(manifest["days"])) - removed
+
+    # The manifest only lists complete days and no watermark while writing, reports read the database meanwhile
+    write_manifest(directory, {"watermark": None, "days": sorted(listed - {day.isoformat() for day in written})})
+    for day in set(manifest["days"]) - listed:
+        shutil.rmtree(os.path.join(directory, day), ignore_errors=True)
+
+    count = 0
+    for day in written:
+        count += write_day(curr, directory, day)
+        listed.add(day.isoformat())
+
+    write_manifest(directory, {"watermark": watermark, "days": sorted(listed)})
+
+    return count
+
+
+# Whether the snapshot reflects the latest ingestion, reports fall back to the database otherwise
+async def snapshot_current():
+
+    if not settings.SNAPSHOT_DIR:
+        return False
+
+    async with semaphore:
+        async for db in get_db():
+            result = await db.execute(select(IngestionState.value).filter(IngestionState.key == WATERMARK_KEY))
+            watermark = result.scalar()
+
+    return watermark is not None and read_manifest(settings.SNAPSHOT_DIR)["watermark"] == watermark
+
+
+# Stores with polls in the week before created_at and their timezones, from the snapshot instead of a scan of the week
+async def snapshot_stores(created_at: datetime):
+
+    await store_metadata.refresh()
+    start, end = to_epoch(created_at - timedelta(days=7)), to_epoch(created_at)
+
+    store_ids = {}
+    for day in Snapshot(settings.SNAPSHOT_DIR).days(created_at):
+        codes, _, _ = day.window(start, end)
+        for code in np.unique(codes).tolist():
+            store_ids[day.store_ids[code]] = None
+
+    return [SnapshotStore(store_id, store_metadata.get_timezone(store_id, DEFAULT_TIMEZONE)) for store_id in store_ids]
+
+
+# Hand the polls of the week before created_at to on_chunk day by day, codes are ordinals of store_ids
+async def snapshot_polls(store_ids: list, created_at: datetime, on_chunk):
+
+    store_index = {store_id: i for i, store_id in enumerate(store_ids)}
+    start, end = to_epoch(created_at - timedelta(days=7)), to_epoch(created_at)
+    count = 0
+
+    for day in Snapshot(settings.SNAPSHOT_DIR).days(created_at):
+        mapping = np.array([store_index.get(store_id, -1) for store_id in day.store_ids], dtype=np.int32)
+        codes, timestamps, statuses = day.window(start, end)
+        codes = mapping[codes]
+
+        # Stores listed after the snapshot was read are dropped like in the COPY path
+        known = codes >= 0
+        if not known.all():
+            codes, timestamps, statuses = codes[known], timestamps[known], statuses[known]
+
+        if len(codes):
+            await on_chunk(codes, timestamps, statuses)
+            count += len(codes)
+
+    return count
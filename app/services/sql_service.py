@@ -0,0 +1,189 @@
+from .calendar_service import get_zone, to_epoch, MINUTE_US, DAY_US
+from .metadata_service import DEFAULT_TIMEZONE
+from app.db import get_db
+from app.utils import semaphore
+from app.core import settings
+
+from sqlalchemy import text
+
+from datetime import datetime, timedelta
+
+# UTC offset periods of the report's timezones like ZoneOffsets, previous is the offset of the period before
+ZONES = """
+    zones AS (
+        SELECT * FROM unnest(
+            CAST(:zone_names AS text[]), CAST(:zone_starts AS bigint[]), CAST(:zone_ends AS bigint[]),
+            CAST(:zone_offsets AS bigint[]), CAST(:zone_previous AS bigint[])
+        ) AS z(zone_name, zone_start, zone_end, zone_offset, zone_previous)
+    ),
+"""
+
+# Polls of the report week as epoch microseconds in UTC with the store's timezone
+POLLS = """
+    polls AS (
+        SELECT s.id, s.store_id, s.status = 'active' AS active,
+            CAST(extract(epoch FROM s.timestamp) * 1000000 AS bigint) AS utc,
+            coalesce(z.timezone_str, :default_timezone) AS timezone_str
+        FROM store_status s
+        LEFT JOIN stores z ON z.store_id = s.store_id
+        WHERE s.timestamp >= :start AND s.timestamp <= :created_at
+    ),
+    hours AS (
+        SELECT id, store_id, day_of_week,
+            CAST(extract(epoch FROM start_time_local) * 1000000 AS bigint) AS hour_start,
+            CAST(extract(epoch FROM end_time_local) * 1000000 AS bigint) AS hour_end
+        FROM store_hours
+    ),
+"""
+
+# Same steps as the numpy engine, from the zones, polls and hours above
+# Wall clock of a poll from the offset period it falls in, fold marks the second pass through a repeated hour like StoreCalendar.folds
+STEPS = """
+    located AS (
+        SELECT p.id, p.store_id, p.active, p.utc, p.timezone_str, p.utc + z.zone_offset AS wall, z.zone_offset AS utc_offset,
+            coalesce(z.zone_previous > z.zone_offset AND p.utc < z.zone_start + z.zone_previous - z.zone_offset, false) AS fold
+        FROM polls p
+        JOIN zones z ON z.zone_name = p.timezone_str AND z.zone_start <= p.utc AND p.utc < z.zone_end
+    ),
+    matched AS (
+        SELECT p.id, p.store_id, p.active, p.utc, p.wall, p.utc_offset, p.timezone_str, p.fold,
+            (p.wall / {day} + 3) % 7 AS weekday, p.wall % {day} AS tod, h.hour_start, h.hour_end,
+            row_number() OVER (PARTITION BY p.store_id, p.utc, p.id ORDER BY h.id) AS hour_rank
+        FROM located p
+        JOIN hours h ON h.store_id = p.store_id
+            AND h.day_of_week = (p.wall / {day} + 3) % 7
+            AND p.wall % {day} >= h.hour_start AND p.wall % {day} <= h.hour_end
+    ),
+    steps AS (
+        SELECT *,
+            lag(wall) OVER w AS prev_wall, lag(utc_offset) OVER w AS prev_offset, lag(active) OVER w AS prev_active,
+            coalesce(lag(weekday) OVER w = weekday AND lag(tod) OVER w >= hour_start AND lag(tod) OVER w <= hour_end, false) AS same
+        FROM matched
+        WHERE hour_rank = 1
+        WINDOW w AS (PARTITION BY store_id ORDER BY utc, id)
+    ),
+    segments AS (
+        SELECT *,
+            coalesce(lead(same) OVER (PARTITION BY store_id ORDER BY utc, id), true) AS next_same,
+            CASE WHEN same THEN prev_wall ELSE wall - tod + hour_start END AS a,
+            CASE WHEN same THEN prev_offset ELSE {opens_offset} END AS a_offset,
+            CASE WHEN same THEN prev_active ELSE active END AS last
+        FROM steps
+    ),
+    intervals AS (
+        SELECT *,
+            CASE
+                WHEN last = active THEN wall
+                WHEN active THEN CASE WHEN a + :downtime_offset > wall THEN wall ELSE a + :downtime_offset END
+                ELSE CASE WHEN wall - :downtime_offset < a THEN a ELSE wall - :downtime_offset END
+            END AS mid,
+            CASE
+                WHEN last = active THEN utc_offset
+                WHEN active THEN CASE WHEN a + :downtime_offset > wall THEN utc_offset ELSE {after_offset} END
+                ELSE CASE WHEN wall - :downtime_offset < a THEN a_offset ELSE {before_offset} END
+            END AS mid_offset,
+            CASE WHEN next_same THEN wall ELSE wall + hour_end - tod END AS closes,
+            CASE WHEN next_same THEN utc_offset ELSE {closes_offset} END AS closes_offset
+        FROM segments
+    )
+"""
+
+
+# Offset of a wall time of the row's timezone, like ZoneOffsets.to_utc with the given fold
+# Fold 0 takes the first candidate period and fold 1 the last, wall times skipped by a transition use the offset before or after it
+def wall_offset(wall: str, fold: str):
+    return (
+        f"coalesce("
+        f"(SELECT CASE WHEN {fold} THEN min(z.zone_offset) ELSE max(z.zone_offset) END FROM zones z "
+        f"WHERE z.zone_name = timezone_str AND z.zone_start <= {wall} - z.zone_offset AND {wall} - z.zone_offset < z.zone_end), "
+        f"(SELECT CASE WHEN {fold} THEN z.zone_offset ELSE z.zone_previous END FROM zones z "
+        f"WHERE z.zone_name = timezone_str AND z.zone_start + z.zone_previous <= {wall} AND {wall} < z.zone_start + z.zone_offset "
+        f"ORDER BY z.zone_start LIMIT 1))"
+    )
+
+
+# Wall clock length of the part of [lo, hi] after limit, lengths are local unless clipped by the UTC limit
+def clipped(lo: str, lo_offset: str, hi: str, hi_offset: str, limit: str):
+    return (
+        f"CASE WHEN {hi} - {hi_offset} >= {limit} THEN "
+        f"CASE WHEN {lo} - {lo_offset} < {limit} THEN {hi} - {hi_offset} - {limit} ELSE {hi} - {lo} END "
+        f"ELSE 0 END"
+    )
+
+
+# Minutes of one status in a window, from the three pieces of every poll
+# a to mid has the previous status, mid to the poll and the poll to the close of its store hour the current one
+def window_column(active: bool, limit: str):
+    status = "" if active else "NOT "
+    return (
+        f"CAST(sum("
+        f"CASE WHEN {status}last THEN {clipped('a', 'a_offset', 'mid', 'mid_offset', limit)} ELSE 0 END + "
+        f"CASE WHEN {status}active THEN {clipped('mid', 'mid_offset', 'wall', 'utc_offset', limit)} + "
+        f"{clipped('wall', 'utc_offset', 'closes', 'closes_offset', limit)} ELSE 0 END"
+        f") AS double precision) / {MINUTE_US}"
+    )
+
+
+# Up then down minutes of the week, day and hour windows per store, in ReportColumnEnum order
+def report_statement(polls: str = POLLS):
+
+    limits = [":week", ":day", ":hour"]
+    columns = [window_column(True, limit) for limit in limits] + [window_column(False, limit) for limit in limits]
+
+    steps = STEPS.format(
+        day=DAY_US,
+        opens_offset=wall_offset("wall - tod + hour_start", "fold"),
+        after_offset=wall_offset("a + :downtime_offset", "false"),
+        before_offset=wall_offset("wall - :downtime_offset", "false"),
+        closes_offset=wall_offset("wall + hour_end - tod", "fold"),
+    )
+
+    return (
+        "WITH " + ZONES + polls + steps +
+        "SELECT store_id, count(*) AS polls, " + ", ".join(columns) +
+        " FROM intervals GROUP BY store_id"
+    )
+
+
+# Parameters of the report statement, offset periods of the timezones of the stores cover the week with margin
+def report_parameters(stores: dict, created_at: datetime):
+
+    start, end = to_epoch(created_at - timedelta(days=7)) - 2 * DAY_US, to_epoch(created_at) + 2 * DAY_US
+    params = {
+        "start": created_at - timedelta(days=7),
+        "created_at": created_at,
+        "week": to_epoch(created_at - timedelta(days=7)),
+        "day": to_epoch(created_at - timedelta(days=1)),
+        "hour": to_epoch(created_at - timedelta(hours=1)),
+        "downtime_offset": settings.DOWNTIME_OFFSET * MINUTE_US,
+        "default_timezone": DEFAULT_TIMEZONE,
+        "zone_names": [], "zone_starts": [], "zone_ends": [], "zone_offsets": [], "zone_previous": [],
+    }
+
+    for timezone_str in {store.timezone for store in stores.values()} | {DEFAULT_TIMEZONE}:
+        zone = get_zone(timezone_str, start, end)
+        params["zone_names"] += [timezone_str] * len(zone.offsets)
+        params["zone_starts"] += zone.starts
+        params["zone_ends"] += zone.ends
+        params["zone_offsets"] += zone.offsets
+        params["zone_previous"] += [None] + zone.offsets[:-1]
+
+    return params
+
+
+# Compute reports inside Postgres, only six numbers per store cross the wire
+# Follows the numpy engine, so VERIFY_ENGINE compares it with the python engine the same way, returns the polls in store hours
+async def process_with_sql(stores: dict, created_at: datetime):
+
+    count = 0
+    async with semaphore:
+        async for db in get_db():
+            result = await db.execute(text(report_statement()), report_parameters(stores, created_at))
+
+            for store_id, polls, *values in result:
+                store = stores.get(store_id)
+                if store is not None:
+                    store.report = values
+                    count += polls
+
+    return count
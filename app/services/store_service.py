@@ -1,195 +1,252 @@
-from app.db import get_db, StoreHours
-from app.utils import StatusEnum, semaphore
+from .metadata_service import store_metadata
+from .calendar_service import calendar_cache, StoreCalendar, to_epoch, US, MINUTE_US, WEEK_US
+from app.utils import StatusEnum
 from app.core import settings
 
-from sqlalchemy.future import select
+from datetime import datetime, timedelta
+from functools import lru_cache
+from array import array
 
-from collections import defaultdict
-from zoneinfo import ZoneInfo
-from datetime import datetime, timedelta, time
 
-class StoreService:
+# Times are (local wall clock, utc) pairs of epoch microseconds, wall clock is None for times that only exist in UTC
+# Like subtracting datetimes, the difference is in wall clock time if both times are local
+def elapsed(last_time: tuple, current_time: tuple):
+    if last_time[0] is None or current_time[0] is None:
+        return current_time[1] - last_time[1]
+    return current_time[0] - last_time[0]
 
-    def __init__(self, store_id: str, created_at: datetime, timezone: str):
-        self.store_id = store_id
-        self.timezone = timezone
+
+# Window limits of a report in epoch microseconds, one instance shared by all its stores
+class ReportWindow:
+
+    __slots__ = ("created_at", "created", "time_limit")
+
+    def __init__(self, created_at: datetime):
         self.created_at = created_at
-        self.report = [0, 0, 0, 0, 0, 0]
+        self.created = to_epoch(created_at)
         self.time_limit = (
-            created_at - timedelta(days = 7),
-            created_at - timedelta(days = 1),
-            created_at - timedelta(hours = 1),
+            to_epoch(created_at - timedelta(days = 7)),
+            to_epoch(created_at - timedelta(days = 1)),
+            to_epoch(created_at - timedelta(hours = 1)),
         )
-        self.last_timestamp = None
+
+
+@lru_cache(maxsize=64)
+def report_window(created_at: datetime):
+    return ReportWindow(created_at)
+
+
+# Report accumulators of many stores in one contiguous array of doubles, six columns per store ordinal
+class ReportArray:
+
+    __slots__ = ("values",)
+
+    def __init__(self, size: int):
+        self.values = array('d', bytes(8 * 6 * size))
+
+
+    # Writable view of the six columns of one store
+    def row(self, ordinal: int):
+        return memoryview(self.values)[ordinal * 6:ordinal * 6 + 6]
+
+
+class StoreService:
+
+    __slots__ = (
+        "store_id", "timezone", "store_hours", "calendar", "window", "reports", "ordinal",
+        "last_wall", "last_utc", "last_status", "last_fold", "last_calendar", "last_segment",
+    )
+
+    def __init__(self, store_id: str, created_at: datetime, timezone: str, reports: ReportArray = None, ordinal: int = 0):
+        self.store_id = store_id
+        self.timezone = timezone
+        self.window = report_window(created_at)
+        self.reports = reports if reports is not None else ReportArray(1)
+        self.ordinal = ordinal
+        self.last_wall = None       # Last query in store hours, local wall clock and utc
+        self.last_utc = None
         self.last_status = None
+        self.last_fold = 0
+        self.last_calendar = None
+        self.last_segment = None
         self.store_hours = None
-    
+        self.calendar = None
 
-    # Fetch store hours dict from store_id
-    async def load_store_hours(self):
-        
-        result = None
 
-        async with semaphore:
-            async for db in get_db():
+    # Up and down time columns of this store, a view into the shared report array
+    @property
+    def report(self):
+        return self.reports.row(self.ordinal)
 
-                result = await db.execute(select(StoreHours.day_of_week, StoreHours.start_time_local, StoreHours.end_time_local).filter(
-                    StoreHours.store_id == self.store_id
-                ))
-            
-        store_hours_list = result.fetchall()
 
-        store_hours = defaultdict(list)
+    @report.setter
+    def report(self, values):
+        self.reports.row(self.ordinal)[:] = array('d', values)
 
-        for row in store_hours_list:
-            store_hours[row.day_of_week].append((row.start_time_local, row.end_time_local))
 
-        self.store_hours = store_hours
+    # Last query in store hours as (wall, utc, status, fold)
+    def state(self):
+        return self.last_wall, self.last_utc, self.last_status, self.last_fold
 
 
-    # Check whether given timestamp is in store hours
-    def is_in_store_hours(self, timestamp: datetime):
+    # Continue from a saved state, its segment is looked up again in this store's calendar
+    def restore(self, state: tuple):
+        self.last_wall, self.last_utc, self.last_status, self.last_fold = state
+        if self.last_utc is not None:
+            self.last_segment = self.is_in_store_hours(self.last_utc)
+            self.last_calendar = self.calendar
 
-        day_of_week = timestamp.weekday()
 
-        if day_of_week not in self.store_hours:
-            return False
-        
-        for store_hour in self.store_hours[day_of_week]:
-            if timestamp.time() >= store_hour[0] and timestamp.time() <= store_hour[1]:
-                return store_hour
-        
-        return False
+    # Fetch store hours dict from the shared metadata index
+    def load_store_hours(self):
+        self.store_hours = store_metadata.get_store_hours(self.store_id)
+
+
+    # Index of the calendar segment containing a UTC timestamp, -1 if not in store hours
+    def is_in_store_hours(self, timestamp: int):
 
+        calendar = self.calendar
 
-    # Get a query and last processed query and determine if the store has closed in between
-    def is_different_store_hour(self, store_hour: tuple, current_timestamp: datetime):
-        if (
-            self.last_timestamp is not None and 
-            ( 
-                self.last_timestamp.time() < store_hour[0] or 
-                self.last_timestamp.time() > store_hour[1] or
-                self.last_timestamp.weekday() != current_timestamp.weekday()
-            )
-        ):
-            return True
-        return False
+        # Compiled calendars are shared by reports with the same window, replays of older data compile their own
+        if calendar is None:
+            calendar = self.calendar = calendar_cache.get(self.store_id, self.store_hours, self.timezone, self.window.time_limit[0], self.window.created)
+        if not calendar.lo <= timestamp < calendar.hi:
+            calendar = self.calendar = StoreCalendar(self.store_hours, self.timezone, timestamp)
 
+        return calendar.lookup(timestamp)
+
+
+    # Determine if the store has closed between the last processed query and the segment of the current one
+    # Like comparing weekday and time of day, a query exactly a week earlier counts as the same segment
+    def is_different_store_hour(self, segment: int):
+        if self.last_utc is None:
+            return False
 
-    # Add uptime between two timestamps
-    def add_time(self, last_time: datetime, current_time: datetime, status: StatusEnum):
+        opens, closes = self.calendar.opens[segment], self.calendar.closes[segment]
+        return (self.last_wall - opens) % WEEK_US > closes - opens
 
-        last_timestamp_temp = last_time
 
-        # Debug query
-        # print(last_time.strftime("%Y-%m-%d %H:%M:%S"), current_time.strftime("%Y-%m-%d %H:%M:%S"), status)
+    # Add uptime between two times
+    def add_time(self, last_time: tuple, current_time: tuple, status: StatusEnum):
+
+        values, base, time_limit = self.reports.values, self.ordinal * 6, self.window.time_limit
 
         r = range(3) if status == StatusEnum.active else range(3,6)
         for i in r:
-            if current_time >= self.time_limit[i%3]:
-                # If not entire time till last_timestamp to be included in calc
-                if self.time_limit[i%3] > last_timestamp_temp:
-                    last_timestamp_temp = self.time_limit[i%3]
-
-                minutes = (current_time - last_timestamp_temp).total_seconds()/60
-                self.report[i] += minutes
+            limit = time_limit[i%3]
+            if current_time[1] >= limit:
+                # If not entire time till last_time to be included in calc
+                if limit > last_time[1]:
+                    minutes = (current_time[1] - limit)/US/60
+                else:
+                    minutes = (current_time[0] - last_time[0])/US/60
+                values[base + i] += minutes
 
             else:
                 break
 
 
-    # Takes an input of a time and a datetime object with timezone, adds date and timezone to time object
-    def combine_timestamps(self, t: time, dt: datetime):
-        return dt.replace(hour=t.hour, minute=t.minute, second=t.second, microsecond=t.microsecond)
+    # Local wall time with the fold of a query on the same day, as a time pair
+    def local_time(self, wall: int, fold: int = 0):
+        return wall, self.calendar.zone.to_utc(wall, fold)
 
 
     # Process Individual query to get last week, day and hour times
-    def process_query_helper(self, current_timestamp: datetime, current_status: StatusEnum, store_hours: tuple):
-        
+    def process_query_helper(self, current_time: tuple, current_fold: int, current_status: StatusEnum, opens: int):
+
         # If start of new store_hour range, then give last_timestamp as start of store_hour
-        if self.last_timestamp is None:
-            self.last_timestamp = self.combine_timestamps(store_hours[0], current_timestamp)
-        
-        if self.last_status is None:
-            self.last_status = current_status
+        if self.last_utc is None:
+            last_timestamp = self.local_time(opens, current_fold)
+        else:
+            last_timestamp = (self.last_wall, self.last_utc)
+
+        last_status = current_status if self.last_status is None else self.last_status
 
         # _, active
         if current_status == StatusEnum.active:
 
             # inactive, active
-            if self.last_status == StatusEnum.inactive:
-                
+            if last_status == StatusEnum.inactive:
+
                 # Take downtime_offset minutes from last_timestamp as downtime
-                mid_time = self.last_timestamp + timedelta(minutes = settings.DOWNTIME_OFFSET)
+                mid_wall = last_timestamp[0] + settings.DOWNTIME_OFFSET * MINUTE_US
 
-                if mid_time > current_timestamp:
-                    mid_time = current_timestamp
+                if mid_wall > current_time[0]:
+                    mid_time = current_time
                 else:
                     # Add uptime between mid_time and current_timestamp
-                    self.add_time(mid_time, current_timestamp, StatusEnum.active)
-                
+                    mid_time = self.local_time(mid_wall)
+                    self.add_time(mid_time, current_time, StatusEnum.active)
+
                 # Add downtime between last_timestamp and mid_time
-                self.add_time(self.last_timestamp, mid_time, StatusEnum.inactive)
+                self.add_time(last_timestamp, mid_time, StatusEnum.inactive)
 
             # active, active
             else:
                 # Add uptime between last_timestamp and current_timestamp
-                self.add_time(self.last_timestamp, current_timestamp, StatusEnum.active)
-        
+                self.add_time(last_timestamp, current_time, StatusEnum.active)
+
         # _, Inactive
         else:
 
             # Inactive, Inactive
-            if self.last_status == StatusEnum.inactive:
+            if last_status == StatusEnum.inactive:
 
                 # Entire time between last_timestamp and current_timestamp is inactive
-                self.add_time(self.last_timestamp, current_timestamp, StatusEnum.inactive)
-            
+                self.add_time(last_timestamp, current_time, StatusEnum.inactive)
+
             # active, inactive
             else :
 
                 # Take last downtime_offset minutes from current_time as downtime
-                mid_time = current_timestamp - timedelta(minutes = settings.DOWNTIME_OFFSET)
+                mid_wall = current_time[0] - settings.DOWNTIME_OFFSET * MINUTE_US
 
-                if mid_time < self.last_timestamp:
-                    mid_time = self.last_timestamp
+                if mid_wall < last_timestamp[0]:
+                    mid_time = last_timestamp
                 else :
                     # Add uptime i.e. time between last_timestamp and mid_time
-                    self.add_time(self.last_timestamp, mid_time, StatusEnum.active)
+                    mid_time = self.local_time(mid_wall)
+                    self.add_time(last_timestamp, mid_time, StatusEnum.active)
 
                 # Add downtime between mid_time and current_timestamp
-                self.add_time(mid_time, current_timestamp, StatusEnum.inactive)
+                self.add_time(mid_time, current_time, StatusEnum.inactive)
 
 
     # Process ending query, last query before store closed
-    def process_ending_query(self, store_hours: tuple):
+    def process_ending_query(self):
 
-        # Add up/down time from last_timestamp to store_hours[1]
-        store_end_time = self.combine_timestamps(store_hours[1], self.last_timestamp)
-        self.add_time(self.last_timestamp, store_end_time, self.last_status)
+        # Add up/down time from last_timestamp to the end of its store hour
+        closes = self.last_calendar.closes[self.last_segment]
+        store_end_time = (closes, self.last_calendar.zone.to_utc(closes, self.last_fold))
+        self.add_time((self.last_wall, self.last_utc), store_end_time, self.last_status)
 
 
     # Process all queries by iterating
     def process_query(self, query):
-            
-        current_time = query.timestamp.astimezone(ZoneInfo(self.timezone)) # Convert query time from utc to local time
+        self.process_poll(to_epoch(query.timestamp), query.status)
+
+
+    # Process a poll given as UTC epoch microseconds, as decoded by the COPY fetch path
+    def process_poll(self, timestamp: int, status: StatusEnum):
 
         # If query outside service time, skip
-        store_hour = self.is_in_store_hours(current_time)
+        segment = self.is_in_store_hours(timestamp)
+
+        if segment >= 0:
 
-        if store_hour is not False:
+            # Local time from the segment's utc offset, fold marks the second pass through a repeated hour
+            calendar = self.calendar
+            current_time = (timestamp + calendar.offsets[segment], timestamp)
+            current_fold = 1 if timestamp < calendar.folds[segment] else 0
 
             # If day or time store_hour segment has changed since last processed query
-            if (self.is_different_store_hour(store_hour, current_time)):
-
-                last_store_hour = self.is_in_store_hours(self.last_timestamp)
-                self.process_ending_query(last_store_hour)
-                self.last_timestamp, self.last_status = None, None
-            
-            # Debug query
-            # print(current_time.strftime("%Y-%m-%d %H:%M:%S"), store_hour[0].strftime("%H:%M:%S"), store_hour[1].strftime("%H:%M:%S"), query.status)
-
-            self.process_query_helper(current_time, query.status, store_hour)
-            self.last_timestamp, self.last_status = current_time, query.status
-            
+            if (self.is_different_store_hour(segment)):
+
+                self.process_ending_query()
+                self.last_utc, self.last_status = None, None
+
+            self.process_query_helper(current_time, current_fold, status, calendar.opens[segment])
+            self.last_wall, self.last_utc = current_time
+            self.last_status, self.last_fold = status, current_fold
+            self.last_calendar, self.last_segment = calendar, segment
 
@@ -0,0 +1,245 @@
+from .store_service import StoreService
+from .calendar_service import StoreCalendar, to_epoch, MINUTE_US, HOUR_US, DAY_US, WEEK_US
+from .metadata_service import store_metadata, DEFAULT_TIMEZONE
+from app.db import get_db, StoreStatus
+from app.utils import StatusEnum, semaphore, logger
+from app.core import settings
+
+from sqlalchemy.future import select
+
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from array import array
+import asyncio, re
+
+WINDOW_UNITS = {"m": MINUTE_US, "h": HOUR_US, "d": DAY_US, "w": WEEK_US}
+MAX_WINDOWS = 16
+
+# Windows of the default report in column order of ReportColumnEnum
+DEFAULT_WINDOWS = [("week", WEEK_US), ("day", DAY_US), ("hour", HOUR_US)]
+
+
+# Parse report windows like "15m,4h,30d", sorted from shortest to longest, raises ValueError
+def parse_windows(windows: str):
+
+    parsed = {}
+    for window in windows.split(","):
+        match = re.fullmatch(r"\s*(\d+)\s*([mhdw])\s*", window)
+        if match is None:
+            raise ValueError(f"Invalid window {window!r}, expected a number followed by m, h, d or w")
+
+        label = match.group(1) + match.group(2)
+        length = int(match.group(1)) * WINDOW_UNITS[match.group(2)]
+        if length <= 0 or length > settings.REPORT_MAX_WINDOW_DAYS * DAY_US:
+            raise ValueError(f"Window {label} must be positive and at most {settings.REPORT_MAX_WINDOW_DAYS} days")
+        parsed[length] = label
+
+    if len(parsed) > MAX_WINDOWS:
+        raise ValueError(f"At most {MAX_WINDOWS} windows per report")
+
+    return [(label, length) for length, label in sorted(parsed.items())]
+
+
+# Canonical form of windows, stored with the report and part of its cache key
+def format_windows(windows: list):
+    return ",".join(label for label, _ in windows)
+
+
+# Headings of a report with custom windows, times are in minutes for windows up to an hour and in hours above
+def window_headings(windows: list):
+    return (
+        ["store_id"] +
+        [f"uptime_last_{label}" for label, _ in windows] +
+        [f"downtime_last_{label}" for label, _ in windows]
+    )
+
+
+def window_row(store_id: str, minutes: list, windows: list):
+    scales = [1 if length <= HOUR_US else 60 for _, length in windows] * 2
+    return [store_id] + [round(value / scale) for value, scale in zip(minutes, scales)]
+
+
+# Replays a store's polls once into time ordered up/down intervals with prefix sums of their wall clock length
+# Intervals are grouped by the poll whose processing produced them, any report time and window is answered by bisects
+# Intervals only overlap around overlapping store hours, the few straddling a window start are summed one by one
+class StoreTimeline(StoreService):
+
+    __slots__ = (
+        "polls", "active", "fresh_lo", "fresh_length", "ends",
+        "los", "his", "kinds", "up", "down", "hi_max", "lo_min", "pending",
+    )
+
+    def __init__(self, store_id: str, created_at: datetime, timezone: str):
+        super().__init__(store_id, created_at, timezone)
+        self.polls = array('q')         # UTC of polls in store hours
+        self.active = bytearray()       # Status of each poll
+        self.fresh_lo = array('q')      # UTC opening of each poll's store hour, its interval when no earlier poll was fetched
+        self.fresh_length = array('q')
+        self.ends = array('q')          # Intervals produced up to and including each poll
+        self.los = array('q')           # UTC bounds of intervals
+        self.his = array('q')
+        self.kinds = bytearray()        # 1 uptime, 0 downtime
+        self.up = array('q', [0])       # Prefix sums of interval wall clock lengths
+        self.down = array('q', [0])
+        self.hi_max = array('q')        # Latest end of the intervals up to each one
+        self.lo_min = array('q')        # Earliest start of the intervals from each one on
+        self.pending = []
+
+
+    def add_time(self, last_time: tuple, current_time: tuple, status: StatusEnum):
+        self.pending.append((current_time[1], last_time[1], current_time[0] - last_time[0], status == StatusEnum.active))
+
+
+    def process_query_helper(self, current_time: tuple, current_fold: int, current_status: StatusEnum, opens: int):
+
+        fresh = self.local_time(opens, current_fold)
+        super().process_query_helper(current_time, current_fold, current_status, opens)
+
+        # Splits around the downtime offset are added out of order
+        self.pending.sort()
+        for hi, lo, length, active in self.pending:
+            self.los.append(lo)
+            self.his.append(hi)
+            self.kinds.append(active)
+            self.up.append(self.up[-1] + (length if active else 0))
+            self.down.append(self.down[-1] + (0 if active else length))
+            self.hi_max.append(max(hi, self.hi_max[-1]) if self.hi_max else hi)
+
+            # New intervals start at most a day before the previous poll, so this walks back only a few entries
+            lo_min = self.lo_min
+            lo_min.append(lo)
+            k = len(lo_min) - 2
+            while k >= 0 and lo_min[k] > lo:
+                lo_min[k] = lo
+                k -= 1
+        self.pending.clear()
+
+        self.polls.append(current_time[1])
+        self.active.append(current_status == StatusEnum.active)
+        self.fresh_lo.append(fresh[1])
+        self.fresh_length.append(current_time[0] - fresh[0])
+        self.ends.append(len(self.his))
+
+
+    # Up then down minutes of each window ending at end, for polls fetched from start like StoreService sees them
+    # The first fetched poll has no predecessor and only counts the time since its store hour opened
+    def window_minutes(self, start: int, end: int, limits: list):
+
+        up, down = [0] * len(limits), [0] * len(limits)
+        first, last = bisect_left(self.polls, start), bisect_right(self.polls, end) - 1
+
+        if first <= last:
+            poll, lo, hi = self.polls[first], self.ends[first], self.ends[last]
+            for j, limit in enumerate(limits):
+
+                if poll >= limit:
+                    length = poll - limit if limit > self.fresh_lo[first] else self.fresh_length[first]
+                    if self.active[first]:
+                        up[j] += length
+                    else:
+                        down[j] += length
+
+                # Intervals before reaching are all before the window and intervals from whole on all inside it
+                reaching = bisect_left(self.hi_max, limit, lo, hi)
+                whole = bisect_left(self.lo_min, limit, reaching, hi)
+                up[j] += self.up[hi] - self.up[whole]
+                down[j] += self.down[hi] - self.down[whole]
+
+                for k in range(reaching, whole):
+                    if self.his[k] < limit:
+                        continue
+                    if limit > self.los[k]:
+                        length = self.his[k] - limit
+                    else:
+                        length = self.up[k + 1] - self.up[k] + self.down[k + 1] - self.down[k]
+                    if self.kinds[k]:
+                        up[j] += length
+                    else:
+                        down[j] += length
+
+        return [value / MINUTE_US for value in up + down]
+
+
+# Timelines of all stores, extended with newer polls between reports
+# Rebuilt when a report needs older polls, store hours change or the cached span exceeds TIMELINE_RETAIN_DAYS
+class TimelineCache:
+
+    def __init__(self):
+        self.timelines = {}
+        self.start = None       # Polls from start on are replayed
+        self.end = None         # Latest replayed poll
+        self.version = None
+        self.lock = asyncio.Lock()
+
+
+    async def get(self, start: datetime):
+
+        async with self.lock:
+            await store_metadata.refresh()
+
+            if (
+                self.start is None or
+                start < self.start or
+                start - self.start > timedelta(days=settings.TIMELINE_RETAIN_DAYS) or
+                store_metadata.version != self.version
+            ):
+                self.timelines, self.start, self.end = {}, start, None
+                self.version = store_metadata.version
+
+            await self.extend()
+
+        return self.timelines
+
+
+    # Replay polls newer than the latest replayed one, ingestion only ever adds polls after the latest loaded
+    async def extend(self):
+
+        time0 = datetime.now()
+        count = 0
+
+        async with semaphore:
+            async for db in get_db():
+                statement = select(StoreStatus.store_id, StoreStatus.timestamp, StoreStatus.status).filter(
+                    StoreStatus.timestamp > self.end if self.end is not None else StoreStatus.timestamp >= self.start
+                ).order_by(StoreStatus.store_id, StoreStatus.timestamp)
+
+                result = await db.stream(statement.execution_options(max_row_buffer=settings.STREAM_CHUNK_SIZE))
+                async for chunk in result.partitions(settings.STREAM_CHUNK_SIZE):
+                    for query in chunk:
+                        timeline = self.timelines.get(query.store_id)
+                        if timeline is None:
+                            timeline = self.timelines[query.store_id] = StoreTimeline(
+                                query.store_id, self.start, store_metadata.get_timezone(query.store_id, DEFAULT_TIMEZONE)
+                            )
+                            timeline.load_store_hours()
+
+                            # Compiled for the replay, the shared calendar cache holds calendars of report windows
+                            timeline.calendar = StoreCalendar(timeline.store_hours, timeline.timezone, to_epoch(query.timestamp))
+                        timeline.process_query(query)
+
+                        if self.end is None or query.timestamp > self.end:
+                            self.end = query.timestamp
+                    count += len(chunk)
+
+        if count:
+            logger.info(f"Extended timelines of {len(self.timelines)} stores with {count} polls in {(datetime.now() - time0).total_seconds()}")
+
+
+timeline_cache = TimelineCache()
+
+
+# Up then down minutes of each window for every store, windows as (label, length) all ending at created_at
+# Polls are taken from the longest window like the other engines fetch a week
+async def process_with_timelines(stores: dict, created_at: datetime, windows: list):
+
+    end = to_epoch(created_at)
+    span = max(length for _, length in windows)
+    limits = [end - length for _, length in windows]
+
+    timelines = await timeline_cache.get(created_at - timedelta(microseconds=span))
+
+    zeros = [0.0] * (2 * len(windows))
+    return {
+        store_id: timelines[store_id].window_minutes(end - span, end, limits) if store_id in timelines else zeros
+        for store_id in stores
+    }
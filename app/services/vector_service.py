@@ -0,0 +1,267 @@
+from .calendar_service import get_zone, to_epoch, time_to_micros, US, DAY_US
+from app.utils import StatusEnum, ReportColumnEnum, logger
+from app.core import settings
+
+from datetime import datetime, timedelta
+import numpy as np
+
+ACTIVE, INACTIVE = 1, 0
+
+
+# Columnar buffer of store_status rows, codes are store ordinals
+class QueryColumns:
+
+    def __init__(self, store_ids: list):
+        self.store_ids = store_ids
+        self.store_index = {store_id: i for i, store_id in enumerate(store_ids)}
+        self.chunks = []
+        self.count = 0
+
+
+    # Append a batch of rows with store_id, timestamp and status attributes
+    def extend(self, rows):
+        n = len(rows)
+        if n == 0:
+            return
+
+        store_index = self.store_index
+        codes = np.fromiter((store_index[row.store_id] for row in rows), dtype=np.int32, count=n)
+        timestamps = np.fromiter((to_epoch(row.timestamp) for row in rows), dtype=np.int64, count=n)
+        statuses = np.fromiter((row.status == StatusEnum.active for row in rows), dtype=np.uint8, count=n)
+
+        self.append_arrays(codes, timestamps, statuses)
+
+
+    # Append already columnar data
+    def append_arrays(self, codes, timestamps, statuses):
+        self.chunks.append((codes, timestamps, statuses))
+        self.count += len(codes)
+
+
+    # Yield (store_id, timestamps, statuses) for every store having rows, ordered by time
+    def groups(self):
+        if not self.chunks:
+            return
+
+        codes = np.concatenate([c[0] for c in self.chunks])
+        timestamps = np.concatenate([c[1] for c in self.chunks])
+        statuses = np.concatenate([c[2] for c in self.chunks])
+        self.chunks = []
+
+        # Stable sort on (store, timestamp), chunks may come from different sources
+        order = np.lexsort((timestamps, codes))
+        codes, timestamps, statuses = codes[order], timestamps[order], statuses[order]
+
+        bounds = np.flatnonzero(np.diff(codes)) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(codes)]))
+
+        for start, end in zip(starts, ends):
+            yield self.store_ids[codes[start]], timestamps[start:end], statuses[start:end]
+
+
+# UTC offset periods of timezones as arrays, shared by all stores of a report
+# Vectorized lookups of what ZoneOffsets and StoreCalendar give one time at a time
+class OffsetTable:
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+        self.tables = {}
+
+
+    # Zone of a timezone with its period starts and offsets as arrays, built once per report
+    def table(self, timezone_str: str):
+        table = self.tables.get(timezone_str)
+
+        if table is None:
+            zone = get_zone(timezone_str, self.start, self.end)
+            table = self.tables[timezone_str] = (zone, np.array(zone.starts, dtype=np.int64), np.array(zone.offsets, dtype=np.int64))
+
+        return table
+
+
+    # Offset in microseconds for each timestamp in the given timezone, and its fold like StoreCalendar.folds
+    def lookup(self, timezone_str: str, timestamps):
+        _, starts, offsets = self.table(timezone_str)
+
+        period = np.searchsorted(starts, timestamps, side="right") - 1
+        offset = offsets[period]
+
+        # Second pass through the wall times repeated when the offset goes back
+        previous = offsets[np.maximum(period - 1, 0)]
+        fold = (period > 0) & (previous > offset) & (timestamps < starts[period] + previous - offset)
+
+        return offset, fold
+
+
+    # UTC instants of local wall times, like ZoneOffsets.to_utc with the fold of each
+    def to_utc(self, timezone_str: str, walls, folds):
+        zone, _, _ = self.table(timezone_str)
+
+        if len(zone.offsets) == 1:
+            return walls - zone.offsets[0]
+
+        utc = np.zeros(len(walls), dtype=np.int64)
+        found = np.zeros(len(walls), dtype=bool)
+
+        # Fold 0 keeps the first candidate and fold 1 the last
+        for start, end, offset in zip(zone.starts, zone.ends, zone.offsets):
+            candidate = walls - offset
+            m = (start <= candidate) & (candidate < end) & (folds | ~found)
+            utc[m] = candidate[m]
+            found |= m
+
+        # Wall time skipped by a transition, fold 0 uses the offset before it and fold 1 the offset after
+        for i in range(1, len(zone.starts)):
+            m = ~found & (zone.starts[i] + zone.offsets[i - 1] <= walls) & (walls < zone.starts[i] + zone.offsets[i])
+            utc[m] = walls[m] - np.where(folds[m], zone.offsets[i], zone.offsets[i - 1])
+            found |= m
+
+        return utc
+
+
+# Sum minutes of intervals falling in each of the week, day and hour windows
+# Like StoreService.add_time, lengths are in local wall time unless clipped by a (UTC) window limit
+def window_minutes(lo, lo_offset, hi, hi_offset, limits: tuple):
+
+    lo_utc, hi_utc = lo - lo_offset, hi - hi_offset
+
+    return [
+        np.where(hi_utc >= limit, np.where(lo_utc < limit, hi_utc - limit, hi - lo), 0).sum() / (60 * US)
+        for limit in limits
+    ]
+
+
+# Vectorized equivalent of StoreService.process_query over all rows of one store
+def process_store(store, timestamps, statuses, offset_table: OffsetTable, limits: tuple):
+
+    # Flatten store hours, list order is kept so the first matching range wins
+    hours = [
+        (day_of_week, time_to_micros(start), time_to_micros(end))
+        for day_of_week, ranges in store.store_hours.items()
+        for start, end in ranges
+    ]
+
+    if not hours:
+        return
+
+    offsets, folds = offset_table.lookup(store.timezone, timestamps)
+    local = timestamps + offsets
+    day = local // DAY_US
+    tod = local - day * DAY_US
+    weekday = (day + 3) % 7     # 1970-01-01 was a Thursday
+
+    hour = np.full(len(timestamps), -1, dtype=np.int32)
+    for k, (day_of_week, start, end) in enumerate(hours):
+        hour[(hour < 0) & (weekday == day_of_week) & (tod >= start) & (tod <= end)] = k
+
+    # Skip queries outside store hours
+    keep = hour >= 0
+    if not keep.any():
+        return
+
+    local, offsets, folds, status = local[keep], offsets[keep], folds[keep], statuses[keep]
+    tod, weekday, hour = tod[keep], weekday[keep], hour[keep]
+    hour_start = np.array([h[1] for h in hours], dtype=np.int64)[hour]
+    hour_end = np.array([h[2] for h in hours], dtype=np.int64)[hour]
+
+    # Whether the previous query lies in the same store hour segment
+    same = np.zeros(len(local), dtype=bool)
+    same[1:] = (weekday[:-1] == weekday[1:]) & (tod[:-1] >= hour_start[1:]) & (tod[:-1] <= hour_end[1:])
+
+    # Interval from previous query, a new segment starts at store opening with the current status
+    # Openings and closings are wall times whose offset may differ from the query's across a transition, like StoreService.local_time
+    opens = local - (tod - hour_start)
+    a = opens.copy()
+    a[1:][same[1:]] = local[:-1][same[1:]]
+    a_offset = opens - offset_table.to_utc(store.timezone, opens, folds)
+    a_offset[1:][same[1:]] = offsets[:-1][same[1:]]
+    last = status.copy()
+    last[1:][same[1:]] = status[:-1][same[1:]]
+    b, b_offset = local, offsets
+
+    downtime_offset = settings.DOWNTIME_OFFSET * 60 * US
+    no_fold = np.zeros(len(local), dtype=bool)
+
+    # Every interval is split in an uptime and a downtime piece, either may be empty
+    up_lo, up_lo_offset, up_hi, up_hi_offset = a.copy(), a_offset.copy(), a.copy(), a_offset.copy()
+    down_lo, down_lo_offset, down_hi, down_hi_offset = a.copy(), a_offset.copy(), a.copy(), a_offset.copy()
+
+    # active, active
+    m = (last == ACTIVE) & (status == ACTIVE)
+    up_hi[m], up_hi_offset[m] = b[m], b_offset[m]
+
+    # inactive, inactive
+    m = (last == INACTIVE) & (status == INACTIVE)
+    down_hi[m], down_hi_offset[m] = b[m], b_offset[m]
+
+    # inactive, active : downtime_offset minutes after last query are downtime
+    m = (last == INACTIVE) & (status == ACTIVE)
+    clamped = a + downtime_offset > b
+    mid = np.where(clamped, b, a + downtime_offset)
+    mid_offset = np.where(clamped, b_offset, mid - offset_table.to_utc(store.timezone, mid, no_fold))
+    down_hi[m], down_hi_offset[m] = mid[m], mid_offset[m]
+    up_lo[m], up_lo_offset[m] = mid[m], mid_offset[m]
+    up_hi[m], up_hi_offset[m] = b[m], b_offset[m]
+
+    # active, inactive : downtime_offset minutes before current query are downtime
+    m = (last == ACTIVE) & (status == INACTIVE)
+    clamped = b - downtime_offset < a
+    mid = np.where(clamped, a, b - downtime_offset)
+    mid_offset = np.where(clamped, a_offset, mid - offset_table.to_utc(store.timezone, mid, no_fold))
+    up_hi[m], up_hi_offset[m] = mid[m], mid_offset[m]
+    down_lo[m], down_lo_offset[m] = mid[m], mid_offset[m]
+    down_hi[m], down_hi_offset[m] = b[m], b_offset[m]
+
+    # Close previous segment from its last query till end of its store hour
+    ending = np.flatnonzero(~same[1:])
+    end_lo, end_offset = local[ending], offsets[ending]
+    end_hi = end_lo + (hour_end[ending] - tod[ending])
+    end_hi_offset = end_hi - offset_table.to_utc(store.timezone, end_hi, folds[ending])
+    up = status[ending] == ACTIVE
+
+    uptime = window_minutes(
+        np.concatenate((up_lo, end_lo[up])), np.concatenate((up_lo_offset, end_offset[up])),
+        np.concatenate((up_hi, end_hi[up])), np.concatenate((up_hi_offset, end_hi_offset[up])),
+        limits
+    )
+    downtime = window_minutes(
+        np.concatenate((down_lo, end_lo[~up])), np.concatenate((down_lo_offset, end_offset[~up])),
+        np.concatenate((down_hi, end_hi[~up])), np.concatenate((down_hi_offset, end_hi_offset[~up])),
+        limits
+    )
+
+    for i, column in enumerate((ReportColumnEnum.uptime_last_week, ReportColumnEnum.uptime_last_day, ReportColumnEnum.uptime_last_hour)):
+        store.report[column.value] += float(uptime[i])
+
+    for i, column in enumerate((ReportColumnEnum.downtime_last_week, ReportColumnEnum.downtime_last_day, ReportColumnEnum.downtime_last_hour)):
+        store.report[column.value] += float(downtime[i])
+
+
+# Process all buffered queries store by store
+def process_columns(stores: dict, columns: QueryColumns, created_at: datetime):
+
+    limits = (
+        to_epoch(created_at - timedelta(days = 7)),
+        to_epoch(created_at - timedelta(days = 1)),
+        to_epoch(created_at - timedelta(hours = 1)),
+    )
+
+    offset_table = OffsetTable(limits[0] - 2 * DAY_US, to_epoch(created_at) + 2 * DAY_US)
+
+    for store_id, timestamps, statuses in columns.groups():
+        process_store(stores[store_id], timestamps, statuses, offset_table, limits)
+
+
+# Compare reports of two engines, log and return ids of stores that differ
+def compare_reports(stores: dict, expected: dict, tolerance: float = 1e-6):
+
+    mismatches = []
+    for store_id, store in expected.items():
+        report = stores[store_id].report
+        if any(abs(report[i] - store.report[i]) > tolerance for i in range(6)):
+            mismatches.append(store_id)
+            logger.warning(f"Engine mismatch for {store_id} : {list(report)} != {list(store.report)}")
+
+    return mismatches
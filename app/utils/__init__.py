@@ -1,2 +1,3 @@
-from .common import ReportColumnEnum, ReportStatusEnum, semaphore, StatusEnum, TimeDecrement, cleanup
-from .logger import logger
\ No newline at end of file
+from .common import ReportColumnEnum, ReportStatusEnum, ReportFormatEnum, semaphore, StatusEnum, TimeDecrement
+from .logger import logger
+from .streaming import blob_response, accepts_gzip
\ No newline at end of file
@@ -1,7 +1,19 @@
+from .metrics import semaphore_wait_seconds
 from app.core import settings
-import enum, asyncio, os
+import enum, asyncio, time
 
-semaphore = asyncio.Semaphore(settings.POOL_SIZE)
+
+# Semaphore recording how long acquire waited
+class TimedSemaphore(asyncio.Semaphore):
+
+    async def acquire(self):
+        start = time.perf_counter()
+        result = await super().acquire()
+        semaphore_wait_seconds.observe(time.perf_counter() - start)
+        return result
+
+
+semaphore = TimedSemaphore(settings.POOL_SIZE)
 
 class StatusEnum(enum.Enum):
     active = "active"
@@ -10,6 +22,15 @@ class StatusEnum(enum.Enum):
 class ReportStatusEnum(enum.Enum):
     Running = "Running"
     Completed = "Completed"
+    Queued = "Queued"
+    Cancelled = "Cancelled"
+    Failed = "Failed"
+
+class ReportFormatEnum(enum.Enum):
+    csv = "csv"
+    csv_gzip = "csv_gzip"
+    parquet = "parquet"
+    arrow = "arrow"
 
 class ReportColumnEnum(enum.Enum):
     uptime_last_week = 0
@@ -22,9 +43,4 @@ class ReportColumnEnum(enum.Enum):
 class TimeDecrement(enum.Enum):
     week = 0
     day = 1
-    hour = 2
-
-# Remove the file after the response is sent
-async def cleanup(file_path):
-    if os.path.exists(file_path):
-        os.remove(file_path)
\ No newline at end of file
+    hour = 2
\ No newline at end of file
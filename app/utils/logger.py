@@ -4,8 +4,8 @@ import logging
 logger = logging.getLogger('app_logger')  # General logger for app
 logger.setLevel(logging.INFO)
 
-# Create a file handler with overwrite mode
-file_handler = logging.FileHandler('app.log', mode='w')  # Logs everything
+# Create a file handler in append mode, logs survive restarts
+file_handler = logging.FileHandler('app.log', mode='a')  # Logs everything
 file_handler.setLevel(logging.INFO)
 
 # Add a formatter
@@ -0,0 +1,193 @@
+import asyncio, threading
+
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+
+# Render label values as {name="value",...}
+def format_labels(names: tuple, values: tuple, extra: str = None):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# Base of all metrics, values are kept per tuple of label values
+class Metric:
+
+    type = None
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+
+    def key(self, labels: dict):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            for values, value in self.values.items():
+                lines.append(f"{self.name}{format_labels(self.label_names, values)} {value}")
+        return lines
+
+
+    # Copy of the values, picklable to send from a worker process
+    def export(self):
+        with self.lock:
+            return dict(self.values)
+
+
+    # Add values exported by another process
+    def merge(self, values: dict):
+        with self.lock:
+            for key, value in values.items():
+                self.values[key] = self.values.get(key, 0) + value
+
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    type = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)  # buckets, sum, count
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+
+    def export(self):
+        with self.lock:
+            return {values: list(counts) for values, counts in self.values.items()}
+
+
+    def merge(self, values: dict):
+        with self.lock:
+            for key, counts in values.items():
+                current = self.values.get(key)
+                self.values[key] = list(counts) if current is None else [a + b for a, b in zip(current, counts)]
+
+
+    # {label values: (count, sum)}
+    def snapshot(self):
+        with self.lock:
+            return {values: (counts[-1], counts[-2]) for values, counts in self.values.items()}
+
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            for values, counts in self.values.items():
+                for i, bound in enumerate(self.buckets):
+                    le = format_labels(self.label_names, values, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{le} {counts[i]}")
+                le = format_labels(self.label_names, values, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{le} {counts[-1]}")
+                lines.append(f"{self.name}_sum{format_labels(self.label_names, values)} {counts[-2]}")
+                lines.append(f"{self.name}_count{format_labels(self.label_names, values)} {counts[-1]}")
+        return lines
+
+
+# Values of all metrics by name, observations of a report generated in a worker process are merged into the server's
+def export_metrics():
+    return {metric.name: metric.export() for metric in REGISTRY}
+
+
+def merge_metrics(values: dict):
+    for metric in REGISTRY:
+        if metric.name in values:
+            metric.merge(values[metric.name])
+
+
+def reset_metrics():
+    for metric in REGISTRY:
+        metric.reset()
+
+
+# All metrics in Prometheus text exposition format
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+report_stage_seconds = Histogram("report_stage_seconds", "Time spent in each report generation stage", ("stage",))
+report_rows = Histogram("report_rows", "Status queries processed per report", buckets=SIZE_BUCKETS)
+report_stores = Histogram("report_stores", "Stores processed per report", buckets=SIZE_BUCKETS)
+reports_in_flight = Gauge("reports_in_flight", "Reports currently being generated")
+reports_in_flight.set(0)
+reports_total = Counter("reports_total", "Finished report generations", ("result",))
+store_report_seconds = Histogram("store_report_seconds", "Time to compute the report of a single store")
+report_queue_depth = Gauge("report_queue_depth", "Reports queued for generation")
+report_queue_depth.set(0)
+report_queue_seconds = Histogram("report_queue_seconds", "Time reports waited in the queue before running")
+semaphore_wait_seconds = Histogram("semaphore_wait_seconds", "Time waiting for the db semaphore")
+db_pool_checkout_seconds = Histogram("db_pool_checkout_seconds", "Time to check out a connection from the db pool")
+db_pool_timeouts_total = Counter("db_pool_timeouts_total", "Connection checkouts failed because the pool was exhausted")
+event_loop_lag_seconds = Histogram("event_loop_lag_seconds", "How much later than scheduled the event loop woke up a sleeping task")
+
+
+# Sample event loop lag every interval seconds, work blocking the loop delays every request by as much
+async def monitor_loop_lag(interval: float):
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag_seconds.observe(max(loop.time() - start - interval, 0))
@@ -0,0 +1,193 @@
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
+
+import os, zlib
+
+CHUNK_SIZE = 64 * 1024
+
+
+# Yield blob[start:end] in chunks without copying the whole blob
+def iter_blob(blob: bytes, start: int = 0, end: int = None, chunk_size: int = CHUNK_SIZE):
+
+    view = memoryview(blob)
+    end = len(blob) if end is None else end
+
+    for i in range(start, end, chunk_size):
+        yield bytes(view[i:min(i + chunk_size, end)])
+
+
+# Yield bytes start to end of a file in chunks
+def iter_file(path: str, start: int = 0, end: int = None, chunk_size: int = CHUNK_SIZE):
+
+    with open(path, "rb") as file:
+        file.seek(start)
+        remaining = (os.fstat(file.fileno()).st_size if end is None else end) - start
+
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+# Bytes start to end of a file, handed to the server to send from the file when it supports the ASGI zero copy extensions
+# Servers without them get the file in chunks read off the event loop
+class FileRangeResponse(Response):
+
+    def __init__(self, path: str, start: int, end: int, status_code: int, headers: dict, media_type: str):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.path, self.start, self.end = path, start, end
+
+
+    async def __call__(self, scope, receive, send):
+
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        extensions = scope.get("extensions") or {}
+
+        if scope["method"].upper() == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+
+        elif "http.response.zerocopy" in extensions:
+            with open(self.path, "rb") as file:
+                await send({"type": "http.response.zerocopy", "file": file, "offset": self.start, "count": self.end - self.start})
+
+        elif "http.response.pathsend" in extensions and self.start == 0 and self.end == os.stat(self.path).st_size:
+            await send({"type": "http.response.pathsend", "path": self.path})
+
+        else:
+            async for chunk in iterate_in_threadpool(iter_file(self.path, self.start, self.end)):
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+
+
+# Body of bytes start to end of a blob, blobs given by path are sent from their file
+def blob_body(blob, start: int, end: int, status_code: int, headers: dict, media_type: str):
+    if isinstance(blob, str):
+        return FileRangeResponse(blob, start, end, status_code, headers, media_type)
+    return StreamingResponse(iter_blob(blob, start, end), status_code=status_code, media_type=media_type, headers=headers)
+
+
+# Compress chunks on the fly with a gzip header
+def iter_gzip(chunks):
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+# Whether the client accepts gzip content encoding
+def accepts_gzip(request: Request):
+
+    for coding in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+
+        return quality > 0
+
+    return False
+
+
+# Parse a single "bytes=" range into (start, end) with end exclusive
+# Returns None to serve the full content and False when unsatisfiable
+def parse_range(header: str, size: int):
+
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None     # Multiple ranges are not supported, full content is a valid answer
+
+    first, _, last = spec.strip().partition("-")
+
+    try:
+        if first == "":
+            length = int(last)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size
+
+        start = int(first)
+        end = size if last == "" else min(int(last) + 1, size)
+
+    except ValueError:
+        return None
+
+    if start >= size or start >= end:
+        return False
+
+    return start, end
+
+
+# Entity tag of the gzip content encoding of a representation, so caches and If-Range never mix bytes of the two
+def gzip_etag(etag: str):
+    return etag[:-1] + '-gzip"' if etag.endswith('"') else etag + "-gzip"
+
+
+# Stream a blob honouring If-None-Match, Range and gzip Accept-Encoding
+# blob is the content or the path of a file holding it, encoding is the content encoding it is already stored in, if any
+# etag identifies the identity encoded content, gzip encoded responses carry gzip_etag(etag)
+def blob_response(request: Request, blob, filename: str, etag: str, media_type: str = "text/csv", encoding: str = None):
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+
+    # Text is compressed on the fly for clients accepting gzip, binary formats are already compressed
+    # Range requests for the identity content are still served from it
+    compress = encoding is None and media_type.startswith("text/") and accepts_gzip(request)
+    if compress and range_header is not None and (if_range is None or if_range.strip() == etag):
+        compress = False
+
+    if compress or encoding is not None:
+        etag = gzip_etag(etag)
+
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "none" if compress else "bytes",
+        "Vary": "Accept-Encoding",
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    }
+
+    if compress or encoding is not None:
+        headers["Content-Encoding"] = encoding or "gzip"
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    if compress:
+        chunks = iter_file(blob) if isinstance(blob, str) else iter_blob(blob)
+        return StreamingResponse(iter_gzip(chunks), media_type=media_type, headers=headers)
+
+    size = os.stat(blob).st_size if isinstance(blob, str) else len(blob)
+
+    # Range applies only if the client's copy is still current
+    if range_header is not None and (if_range is None or if_range.strip() == etag):
+        byte_range = parse_range(range_header, size)
+
+        if byte_range is False:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+            headers["Content-Length"] = str(end - start)
+            return blob_body(blob, start, end, 206, headers, media_type)
+
+    headers["Content-Length"] = str(size)
+    return blob_body(blob, 0, size, 200, headers, media_type)
@@ -0,0 +1,47 @@
+from datetime import datetime, timezone
+import argparse, asyncio, json, time
+
+
+# Time the ORM fetch of a report week against the binary COPY fetch, on data already in the database
+async def time_fetch(created_at: datetime, repeat: int):
+    from app.db import get_db
+    from app.services.generator_service import fetch_stores, fetch_queries
+    from app.services.copy_service import copy_polls
+
+    async for db in get_db():
+        store_ids = [store.store_id for store in await fetch_stores(db, created_at)]
+
+    results = {"stores": len(store_ids), "orm": [], "copy": []}
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        async for db in get_db():
+            rows = len(await fetch_queries(db, created_at))
+        results["orm"].append(time.perf_counter() - start)
+
+        async def on_chunk(codes, timestamps, statuses):
+            pass
+
+        start = time.perf_counter()
+        polls = await copy_polls(store_ids, created_at, on_chunk)
+        results["copy"].append(time.perf_counter() - start)
+
+    results["rows"] = {"orm": rows, "copy": polls}
+    for path in ("orm", "copy"):
+        best = min(results[path])
+        results[f"{path}_rows_per_second"] = results["rows"][path] / max(best, 1e-9)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the ORM and binary COPY fetch of report polls")
+    parser.add_argument("--timestamp", type=datetime.fromisoformat, default=datetime(2024, 10, 7, 12, 40, tzinfo=timezone.utc))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(time_fetch(args.timestamp, args.repeat)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+from .run import reset_database, serve
+from .synthetic import generate
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.error import HTTPError
+from urllib.request import urlopen, Request
+import argparse, json, math, os, random, re, tempfile, threading, time
+
+OPERATIONS = ("trigger", "get", "rows", "progress")
+PENDING = (b'"Queued"', b'"Running"')
+
+# Server histograms compared before and after the run, waits above the threshold count as contention
+CONTENTION_SECONDS = 0.01
+SAMPLE = re.compile(r'^(\w+?)(_bucket)?(\{.*\})? (\S+)$')
+LE = re.compile(r'le="([^"]+)"')
+COUNTERS = ("db_pool_timeouts_total", "reports_total")
+
+
+# Weights of operations like trigger=1,get=4
+def parse_mix(mix: str):
+
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name}, expected one of {', '.join(OPERATIONS)}")
+        weights[name] = float(weight or 1)
+
+    if sum(weights.values()) <= 0:
+        raise ValueError("The mix needs a positive weight")
+
+    return weights
+
+
+# Nearest rank percentile of sorted values
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))]
+
+
+# Histogram buckets {le: count} and counters of a /metrics scrape, summed over labels
+def scrape_metrics(base: str):
+
+    with urlopen(f"{base}/metrics", timeout=60) as response:
+        text = response.read().decode()
+
+    histograms, counters = {}, dict.fromkeys(COUNTERS, 0)
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match is None:
+            continue
+        name, bucket, labels, value = match.groups()
+
+        if bucket:
+            bound = LE.search(labels).group(1)
+            buckets = histograms.setdefault(name, {})
+            bound = math.inf if bound == "+Inf" else float(bound)
+            buckets[bound] = buckets.get(bound, 0) + float(value)
+        elif name in counters:
+            counters[name] += float(value)
+
+    return histograms, counters
+
+
+# Observations of a histogram during the run, their count, how many exceeded threshold and an upper bound of the q-th percentile
+def histogram_delta(before: dict, after: dict, name: str, q: float = 99, threshold: float = CONTENTION_SECONDS):
+
+    buckets = after.get(name, {})
+    counts = {bound: count - before.get(name, {}).get(bound, 0) for bound, count in buckets.items()}
+    total = counts.get(math.inf, 0)
+    if total <= 0:
+        return {"count": 0, f"over_{threshold}s": 0, f"p{q:g}_at_most": None}
+
+    within = max((count for bound, count in counts.items() if bound <= threshold), default=0)
+    bound_q = next(bound for bound in sorted(counts) if counts[bound] >= q / 100 * total)
+
+    return {"count": int(total), f"over_{threshold}s": int(total - within), f"p{q:g}_at_most": None if math.isinf(bound_q) else bound_q}
+
+
+# Clients of one run share the report ids triggered so far and record every request
+class LoadRun:
+
+    def __init__(self, base: str, weights: dict, timestamps: list, rows_query: str):
+        self.base = base
+        self.operations = list(weights)
+        self.weights = list(weights.values())
+        self.timestamps = timestamps
+        self.rows_query = rows_query
+        self.report_ids = []
+        self.latencies = {name: [] for name in weights}
+        self.outcomes = {name: {} for name in weights}
+        self.lock = threading.Lock()
+
+
+    def request(self, method: str, path: str):
+
+        start = time.perf_counter()
+        try:
+            with urlopen(Request(f"{self.base}{path}", method=method), timeout=600) as response:
+                body = response.read()
+            outcome = "pending" if body in PENDING else "ok"
+        except HTTPError as error:
+            error.read()
+            body, outcome = None, f"http_{error.code}"
+        except OSError as error:
+            body, outcome = None, type(error).__name__
+
+        return time.perf_counter() - start, body, outcome
+
+
+    def run_once(self, rng: random.Random):
+
+        name = rng.choices(self.operations, self.weights)[0]
+
+        if name == "trigger":
+            timestamp = rng.choice(self.timestamps).isoformat().replace("+", "%2B")
+            seconds, body, outcome = self.request("POST", f"/report/trigger?timestamp={timestamp}")
+            if outcome == "ok":
+                with self.lock:
+                    self.report_ids.append(json.loads(body))
+        else:
+            with self.lock:
+                report_id = rng.choice(self.report_ids)
+            path = {
+                "get": f"/report/get?id={report_id}",
+                "rows": f"/report/{report_id}/rows?{self.rows_query}",
+                "progress": f"/report/progress?id={report_id}",
+            }[name]
+            seconds, body, outcome = self.request("GET", path)
+
+        with self.lock:
+            self.latencies[name].append(seconds)
+            self.outcomes[name][outcome] = self.outcomes[name].get(outcome, 0) + 1
+
+
+    def client(self, deadline: float, seed: int):
+        rng = random.Random(seed)
+        while time.monotonic() < deadline:
+            self.run_once(rng)
+
+
+    # Latency percentiles in milliseconds and throughput of each operation
+    def summary(self, seconds: float):
+
+        results = {}
+        for name, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            results[name] = {
+                "requests": len(latencies),
+                "per_second": len(latencies) / seconds,
+                "outcomes": self.outcomes[name],
+            }
+            for q in (50, 95, 99, 100):
+                value = percentile(latencies, q)
+                results[name]["max_ms" if q == 100 else f"p{q}_ms"] = None if value is None else value * 1000
+
+        return results
+
+
+# Trigger a report and wait until it is completed, so downloads have something to fetch from the start
+def seed_report(run: LoadRun, timestamp: datetime, timeout: float):
+
+    _, body, outcome = run.request("POST", f"/report/trigger?timestamp={timestamp.isoformat().replace('+', '%2B')}")
+    if outcome != "ok":
+        raise RuntimeError(f"Seed trigger failed with {outcome}")
+    report_id = json.loads(body)
+
+    start = time.monotonic()
+    while True:
+        seconds, body, outcome = run.request("GET", f"/report/progress?id={report_id}")
+        status = json.loads(body)["status"] if outcome == "ok" else None
+        if status == "Completed":
+            break
+        if status in ("Failed", "Cancelled") or time.monotonic() - start > timeout:
+            raise RuntimeError(f"Seed report {report_id} is {status}")
+        time.sleep(0.2)
+
+    run.report_ids.append(report_id)
+    return report_id, time.monotonic() - start
+
+
+# Drive concurrent clients for duration seconds against a running server and collect client and server side numbers
+def load(base: str, weights: dict, concurrency: int, duration: float, timestamps: list, rows_query: str, timeout: float, seed: int):
+
+    run = LoadRun(base, weights, timestamps, rows_query)
+    seed_id, seed_seconds = seed_report(run, timestamps[0], timeout)
+
+    before, counters_before = scrape_metrics(base)
+    start = time.perf_counter()
+    deadline = time.monotonic() + duration
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(run.client, deadline, seed * 1000 + i) for i in range(concurrency)]:
+            future.result()
+
+    seconds = time.perf_counter() - start
+    after, counters_after = scrape_metrics(base)
+    counters = {name: counters_after[name] - counters_before[name] for name in COUNTERS}
+    operations = run.summary(seconds)
+
+    return {
+        "seed_report": {"report_id": seed_id, "seconds": seed_seconds},
+        "seconds": seconds,
+        "requests": sum(operation["requests"] for operation in operations.values()),
+        "per_second": sum(operation["requests"] for operation in operations.values()) / seconds,
+        "operations": operations,
+        "server": {
+            "event_loop_lag": histogram_delta(before, after, "event_loop_lag_seconds"),
+            "semaphore_wait": histogram_delta(before, after, "semaphore_wait_seconds"),
+            "pool_checkout": histogram_delta(before, after, "db_pool_checkout_seconds"),
+            "pool_timeouts": counters["db_pool_timeouts_total"],
+            "reports_finished": counters["reports_total"],
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /report/trigger and /report/get with concurrent clients on synthetic data")
+    parser.add_argument("--stores", type=int, default=1000)
+    parser.add_argument("--polls-per-hour", type=float, default=1)
+    parser.add_argument("--days", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-load", action="store_true", help="Reuse data already in the database")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of load")
+    parser.add_argument("--mix", default="trigger=1,get=4,rows=2,progress=2", help="Weights of operations")
+    parser.add_argument("--timestamps", type=int, default=4, help="Distinct report timestamps triggered, more means fewer cache hits")
+    parser.add_argument("--spacing", type=int, default=3600, help="Seconds between report timestamps")
+    parser.add_argument("--rows-query", default="sort=-downtime_last_day&limit=50")
+    parser.add_argument("--pool-size", type=int, help="Overrides POOL_SIZE")
+    parser.add_argument("--workers", type=int, help="Overrides REPORT_WORKERS")
+    parser.add_argument("--engine", help="Overrides ENGINE")
+    parser.add_argument("--fetch-mode", help="Overrides FETCH_MODE")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--output", help="Write results as json to this file instead of stdout")
+    args = parser.parse_args()
+
+    weights = parse_mix(args.mix)
+    if args.concurrency < 1 or args.timestamps < 1:
+        parser.error("--concurrency and --timestamps must be positive")
+
+    # The server inherits the environment, settings are read on import of app
+    overrides = {"POOL_SIZE": args.pool_size, "REPORT_WORKERS": args.workers, "ENGINE": args.engine, "FETCH_MODE": args.fetch_mode}
+    for key, value in overrides.items():
+        if value is not None:
+            os.environ[key] = str(value)
+
+    end = datetime(2024, 10, 7, 12, 40, tzinfo=timezone.utc)
+    timestamps = [end - timedelta(seconds=args.spacing * i) for i in range(args.timestamps)]
+    results = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "settings": {key: value for key, value in overrides.items() if value is not None},
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "mix": weights,
+    }
+
+    if not args.skip_load:
+        from app.ingestion.ingestion import ingest
+
+        with tempfile.TemporaryDirectory() as csv_dir:
+            results["dataset"] = generate(csv_dir, args.stores, args.polls_per_hour, args.days, end, args.seed)
+            reset_database()
+            ingest(csv_dir)
+
+    with serve(args.port) as (_, base):
+        results.update(load(base, weights, args.concurrency, args.duration, timestamps, args.rows_query, args.timeout, args.seed))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
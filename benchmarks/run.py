@@ -0,0 +1,194 @@
+from .synthetic import generate
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.request import urlopen, Request
+import argparse, asyncio, json, os, platform, resource, subprocess, sys, tempfile, time
+
+TABLES = [
+    "store_status", "store_hours", "stores", "store_status_hourly", "ingestion_state", "report_rows", "reports",
+    "stores_staging", "store_hours_staging", "store_status_staging",
+]
+
+
+# Drop everything created by ingestion and the app so the run starts from an empty database
+def reset_database():
+    from app.ingestion.ingestion import get_connection
+
+    conn = get_connection()
+    curr = conn.cursor()
+    curr.execute(f"DROP TABLE IF EXISTS {', '.join(TABLES)} CASCADE;")
+    curr.execute("DROP TYPE IF EXISTS status, statusenum, reportstatusenum, reportformatenum CASCADE;")
+    conn.commit()
+    curr.close()
+    conn.close()
+
+
+# Peak resident memory of this process in MB
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Peak resident memory of another process in MB
+def process_peak_rss_mb(pid: int):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+# Generate one report in process and return time per generator stage
+async def time_stages(created_at: datetime):
+    from app.db import create_tables, get_db, Report
+    from app.services import generator
+    from app.services.progress_service import SERVER_ID
+    from app.utils import ReportStatusEnum
+    from app.utils.metrics import report_stage_seconds
+    from sqlalchemy import func
+
+    await create_tables()
+
+    # Claimed by this process like the scheduler does, progress and finalize only write reports it owns
+    async for db in get_db():
+        report = Report(status=ReportStatusEnum.Running, created_at=created_at, started_at=func.now(), owner=SERVER_ID, heartbeat_at=func.now())
+        db.add(report)
+        await db.commit()
+        await db.refresh(report)
+        report_id = report.id
+
+    before = report_stage_seconds.snapshot()
+    start = time.perf_counter()
+    await generator(report_id)
+    total = time.perf_counter() - start
+
+    stages = {}
+    for (stage,), (count, seconds) in report_stage_seconds.snapshot().items():
+        stages[stage] = seconds - before.get((stage,), (0, 0))[1]
+
+    return {"report_id": report_id, "seconds": total, "stages": stages}
+
+
+def http(method: str, url: str):
+    start = time.perf_counter()
+    with urlopen(Request(url, method=method), timeout=600) as response:
+        body = response.read()
+    return time.perf_counter() - start, body
+
+
+# Run the api with uvicorn until the block exits, yields the server process and its base url once it answers
+@contextmanager
+def serve(port: int):
+
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base = f"http://127.0.0.1:{port}"
+
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                http("GET", f"{base}/metrics")
+                break
+            except OSError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise RuntimeError("Server did not start")
+                time.sleep(0.2)
+
+        yield server, base
+
+    finally:
+        server.terminate()
+        server.wait()
+
+
+# Run the api with uvicorn and time /report/trigger until /report/get returns the file
+def time_end_to_end(created_at: datetime, port: int, timeout: float):
+
+    with serve(port) as (server, base):
+        start = time.perf_counter()
+        trigger_seconds, body = http("POST", f"{base}/report/trigger?timestamp={created_at.isoformat().replace('+', '%2B')}")
+        report_id = json.loads(body)
+
+        polls = 0
+        while True:
+            get_seconds, body = http("GET", f"{base}/report/get?id={report_id}")
+            polls += 1
+            if body not in (b'"Queued"', b'"Running"'):
+                break
+            if time.perf_counter() - start > timeout:
+                raise RuntimeError(f"Report {report_id} not ready after {timeout} seconds")
+            time.sleep(0.1)
+
+        return {
+            "report_id": report_id,
+            "seconds": time.perf_counter() - start,
+            "trigger_seconds": trigger_seconds,
+            "download_seconds": get_seconds,
+            "download_bytes": len(body),
+            "polls": polls,
+            "server_peak_rss_mb": process_peak_rss_mb(server.pid),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark report generation on synthetic data")
+    parser.add_argument("--stores", type=int, default=1000)
+    parser.add_argument("--polls-per-hour", type=float, default=1)
+    parser.add_argument("--days", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", help="Overrides ENGINE")
+    parser.add_argument("--fetch-mode", help="Overrides FETCH_MODE")
+    parser.add_argument("--shards", type=int, help="Overrides SHARD_COUNT")
+    parser.add_argument("--skip-load", action="store_true", help="Reuse data already in the database")
+    parser.add_argument("--skip-http", action="store_true", help="Only time generator stages in process")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--output", help="Write results as json to this file instead of stdout")
+    args = parser.parse_args()
+
+    # Settings are read on import of app, overrides must be in the environment first
+    overrides = {"ENGINE": args.engine, "FETCH_MODE": args.fetch_mode, "SHARD_COUNT": args.shards}
+    for key, value in overrides.items():
+        if value is not None:
+            os.environ[key] = str(value)
+
+    end = datetime(2024, 10, 7, 12, 40, tzinfo=timezone.utc)
+    results = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "settings": {key: value for key, value in overrides.items() if value is not None},
+    }
+
+    if not args.skip_load:
+        from app.ingestion.ingestion import ingest
+
+        with tempfile.TemporaryDirectory() as csv_dir:
+            start = time.perf_counter()
+            results["dataset"] = generate(csv_dir, args.stores, args.polls_per_hour, args.days, end, args.seed)
+            results["generate_seconds"] = time.perf_counter() - start
+
+            reset_database()
+            start = time.perf_counter()
+            results["ingest"] = ingest(csv_dir)
+            results["ingest_seconds"] = time.perf_counter() - start
+
+    results["generator"] = asyncio.run(time_stages(end))
+    results["generator"]["peak_rss_mb"] = peak_rss_mb()
+
+    if not args.skip_http:
+        results["end_to_end"] = time_end_to_end(end, args.port, args.timeout)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
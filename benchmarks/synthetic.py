@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta, timezone
+import argparse, csv, os, random, uuid
+
+# Mix of common and odd timezones, half hour and 45 minute offsets and DST edges
+TIMEZONES = [
+    "America/Chicago", "America/New_York", "America/Los_Angeles", "America/Denver",
+    "Asia/Kolkata", "Asia/Kathmandu", "Australia/Lord_Howe", "Pacific/Chatham",
+    "America/St_Johns", "Europe/London", "Asia/Tokyo",
+]
+
+
+# Store hours for one day, normal, split into two ranges or overnight (end before start)
+def day_hours(rng: random.Random):
+
+    kind = rng.random()
+
+    if kind < 0.6:
+        start = rng.randint(6, 11)
+        return [(f"{start:02d}:00:00", f"{rng.randint(18, 23):02d}:{rng.choice(['00', '30'])}:00")]
+
+    if kind < 0.85:
+        return [
+            (f"{rng.randint(7, 10):02d}:00:00", f"{rng.randint(13, 14):02d}:30:00"),
+            (f"{rng.randint(16, 17):02d}:00:00", f"{rng.randint(21, 23):02d}:00:00"),
+        ]
+
+    return [(f"{rng.randint(18, 22):02d}:00:00", f"{rng.randint(1, 4):02d}:00:00")]
+
+
+# Write timezones.csv, menu_hours.csv and store_status.csv in the ingestion format
+def generate(output_dir: str, stores: int, polls_per_hour: float, days: int, end: datetime, seed: int = 0):
+
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+
+    store_ids = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(stores)]
+    rows = 0
+
+    with open(os.path.join(output_dir, "timezones.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["store_id", "timezone_str"])
+        for store_id in store_ids:
+            # Some stores have no timezone and fall back to the default
+            if rng.random() < 0.95:
+                writer.writerow([store_id, rng.choice(TIMEZONES)])
+
+    with open(os.path.join(output_dir, "menu_hours.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["store_id", "dayOfWeek", "start_time_local", "end_time_local"])
+        for store_id in store_ids:
+            # Some stores have no hours at all
+            if rng.random() < 0.05:
+                continue
+            for day in range(7):
+                for start, end_time in day_hours(rng):
+                    writer.writerow([store_id, day, start, end_time])
+
+    start = end - timedelta(days=days)
+    interval = 3600 / polls_per_hour
+
+    with open(os.path.join(output_dir, "store_status.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["store_id", "status", "timestamp_utc"])
+        for store_id in store_ids:
+
+            # Outages come in runs, a store stays in a state for a few polls
+            active = True
+            t = start.timestamp() + rng.random() * interval
+            while t < end.timestamp():
+                if rng.random() < (0.05 if active else 0.4):
+                    active = not active
+                timestamp = datetime.fromtimestamp(t, timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f UTC")
+                writer.writerow([store_id, "active" if active else "inactive", timestamp])
+                rows += 1
+                t += interval * rng.uniform(0.8, 1.2)
+
+    return {"stores": stores, "polls_per_hour": polls_per_hour, "days": days, "rows": rows, "end": end.isoformat()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic store monitoring csv files")
+    parser.add_argument("output_dir")
+    parser.add_argument("--stores", type=int, default=1000)
+    parser.add_argument("--polls-per-hour", type=float, default=1)
+    parser.add_argument("--days", type=int, default=8)
+    parser.add_argument("--end", type=datetime.fromisoformat, default=datetime(2024, 10, 7, 12, 40, tzinfo=timezone.utc))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(generate(args.output_dir, args.stores, args.polls_per_hour, args.days, args.end, args.seed))
+
+
+if __name__ == "__main__":
+    main()
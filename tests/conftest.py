@@ -0,0 +1,120 @@
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Settings are read on import of app, these tests never connect to the database
+os.environ.setdefault("DATABASE_URL", "postgresql+asyncpg://localhost/store_monitoring_test")
+
+
+from app.services.metadata_service import store_metadata
+from app.utils import StatusEnum
+
+from app.core import settings
+
+from collections import namedtuple
+from datetime import datetime, time, timedelta, timezone
+import asyncio, random
+import pytest
+
+Poll = namedtuple("Poll", "store_id timestamp status")
+
+# Zones with DST on both hemispheres, a 30 minute DST shift and a 45 minute offset
+TIMEZONES = ["America/Chicago", "America/New_York", "Europe/London", "Australia/Lord_Howe", "Pacific/Chatham", "Asia/Kolkata"]
+
+# Report weeks around DST changes of the zones above
+DST_DATES = [datetime(2024, 3, 12, tzinfo=timezone.utc), datetime(2024, 4, 2, tzinfo=timezone.utc), datetime(2024, 11, 5, tzinfo=timezone.utc)]
+
+
+# Ranges of one day, regular, split, all day, overlapping or overnight (end before start)
+def random_day_hours(rng: random.Random, overlapping: bool):
+
+    kind = rng.choice(["regular", "regular", "split", "all day", "closed"] + (["overlapping", "overnight"] if overlapping else []))
+
+    if kind == "regular":
+        start = rng.randint(0, 20)
+        return [(time(start, rng.choice([0, 30])), time(rng.randint(start, 23), 59, 59))]
+    if kind == "split":
+        return [(time(rng.randint(0, 9), 0), time(rng.randint(10, 12), 59, 59)), (time(rng.randint(13, 18), 0), time(23, 59, 59))]
+    if kind == "all day":
+        return [(time(0, 0), time(23, 59, 59))]
+    if kind == "overlapping":
+        start = rng.randint(0, 12)
+        return [(time(start, 0), time(start + 6, 59, 59)), (time(rng.randint(0, start + 6), 30), time(rng.randint(start + 6, 23), 0))]
+    if kind == "overnight":
+        return [(time(rng.randint(18, 23), 0), time(rng.randint(1, 5), 0))]
+    return []
+
+
+# Random stores in store_metadata and their polls from start to end, ordered by store then timestamp
+# Polls come every few minutes to hours, with gaps of a day or more
+@pytest.fixture
+def random_polls(monkeypatch):
+
+    monkeypatch.setattr(store_metadata, "timezones", {})
+    monkeypatch.setattr(store_metadata, "store_hours", {})
+    monkeypatch.setattr(store_metadata, "version", None)
+
+    def generate(seed: int, start: datetime, end: datetime, stores: int = 30, overlapping: bool = True):
+
+        rng = random.Random(seed)
+        polls = []
+
+        for i in range(stores):
+            store_id = f"{seed:04d}-{i:031d}"
+            store_metadata.timezones[store_id] = rng.choice(TIMEZONES)
+            store_metadata.store_hours[store_id] = {day: random_day_hours(rng, overlapping) for day in range(7)}
+
+            timestamp = start + timedelta(minutes=rng.uniform(0, 600))
+            while timestamp <= end:
+                status = StatusEnum.active if rng.random() < 0.75 else StatusEnum.inactive
+                polls.append(Poll(store_id, timestamp, status))
+                timestamp += timedelta(minutes=rng.choice([rng.uniform(1, 120), rng.uniform(1, 20), 600, 1500, 3000]))
+
+        return polls
+
+    return generate
+
+
+# Report columns of every store polled in the week before created_at, by the python engine
+@pytest.fixture
+def full_report():
+
+    from app.services.store_service import StoreService, ReportArray
+    from app.services.metadata_service import DEFAULT_TIMEZONE
+
+    def report(polls: list, created_at: datetime, service=StoreService):
+
+        week = [poll for poll in polls if created_at - timedelta(days=7) <= poll.timestamp <= created_at]
+        store_ids = list(dict.fromkeys(poll.store_id for poll in week))
+        reports, stores = ReportArray(len(store_ids)), {}
+
+        for ordinal, store_id in enumerate(store_ids):
+            store = stores[store_id] = service(store_id, created_at, store_metadata.get_timezone(store_id, DEFAULT_TIMEZONE), reports, ordinal)
+            store.load_store_hours()
+        for poll in week:
+            stores[poll.store_id].process_query(poll)
+
+        return stores
+
+    return report
+
+
+# Tests needing Postgres at DATABASE_URL, skipped when there is none
+@pytest.fixture
+def database():
+
+    import asyncpg
+
+    async def connect():
+        connection = await asyncpg.connect(settings.DATABASE_URL.replace("+asyncpg", ""), timeout=2)
+        await connection.close()
+
+    try:
+        asyncio.run(connect())
+    except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as error:
+        pytest.skip(f"No database at DATABASE_URL: {error}")
+
+    yield
+
+    from app.db.database import engine
+    engine.sync_engine.dispose()
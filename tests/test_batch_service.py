@@ -0,0 +1,50 @@
+from app.services import file_service
+from app.services.batch_service import batch_passes
+from app.services.blob_service import LocalBlobStore
+from app.services.file_service import read_report
+from app.utils import ReportFormatEnum
+from app.core import settings
+
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+import os, resource
+import pytest
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = LocalBlobStore(str(tmp_path / "blobs"))
+    monkeypatch.setattr(file_service, "blob_store", store)
+    return store
+
+
+# Hundreds of hourly reports run under an open files limit far below two files per report
+def test_batch_passes_bound_open_files(store, random_polls, monkeypatch):
+
+    monkeypatch.setattr(settings, "BATCH_PASS_REPORTS", 20)
+    monkeypatch.setattr(settings, "REPORT_ROWS", True)
+
+    end = datetime(2024, 11, 5, tzinfo=timezone.utc)
+    polls = sorted(random_polls(0, end - timedelta(days=20), end, stores=4), key=lambda poll: (poll.store_id, poll.timestamp))
+    reports = [SimpleNamespace(id=f"report-{k}", created_at=end - timedelta(hours=k), format=ReportFormatEnum.csv) for k in range(300)]
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (len(os.listdir("/proc/self/fd")) + 64, hard))
+    try:
+        keys = {}
+        for batch in batch_passes(reports):
+            start = batch.reports[0].created_at - timedelta(days=7)
+            for poll in polls:
+                if start <= poll.timestamp <= batch.reports[-1].created_at:
+                    batch.feed(poll)
+            batch.flush()
+
+            for k, report in enumerate(batch.reports):
+                report_file = batch.close(k)
+                keys[report.id] = report_file.store()
+                report_file.discard()
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    assert len(keys) == len(reports)
+    assert all(len(list(read_report(store.read(key), ReportFormatEnum.csv))) == 4 for key in keys.values())
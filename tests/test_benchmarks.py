@@ -0,0 +1,23 @@
+from benchmarks.run import time_stages
+from app.db import get_db, Report
+from app.utils import ReportStatusEnum
+
+from sqlalchemy.future import select
+
+from datetime import datetime, timezone
+import asyncio
+
+
+# The stage benchmark claims its report, so progress checkpoints and finalize accept it and every stage runs
+def test_time_stages_completes_its_report(database):
+
+    async def run():
+        stages = await time_stages(datetime(2024, 10, 7, 12, 40, tzinfo=timezone.utc))
+        async for db in get_db():
+            result = await db.execute(select(Report.status, Report.blob_key).filter(Report.id == stages["report_id"]))
+            return stages, result.first()
+
+    stages, (status, blob_key) = asyncio.run(run())
+
+    assert status == ReportStatusEnum.Completed and blob_key is not None
+    assert {"fetch", "init", "process", "finalize"} <= set(stages["stages"])
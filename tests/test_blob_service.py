@@ -0,0 +1,40 @@
+from app.services.blob_service import LocalBlobStore
+
+import hashlib, io, os, time
+
+
+def files(directory):
+    return sorted(os.path.relpath(os.path.join(root, name), directory) for root, _, names in os.walk(directory) for name in names)
+
+
+def test_put_hashes_streams_and_bytes(tmp_path):
+    store = LocalBlobStore(str(tmp_path))
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    key = store.put(io.BytesIO(data))
+    assert key == hashlib.sha256(data).hexdigest()
+    assert store.put(data) == key
+    assert store.read(key) == data
+    assert files(store.directory) == [os.path.join(key[:2], key)]
+
+
+def test_put_file_moves_the_temporary(tmp_path):
+    store = LocalBlobStore(str(tmp_path))
+    with store.temporary() as file:
+        file.write(b"report")
+    key = store.put_file(file.name)
+    assert store.read(key) == b"report"
+    assert files(store.directory) == [os.path.join(key[:2], key)]
+
+    with store.temporary() as file:
+        file.write(b"report")
+    assert store.put_file(file.name) == key
+    assert files(store.directory) == [os.path.join(key[:2], key)]
+
+
+def test_keys_remove_stale_temporaries(tmp_path):
+    store = LocalBlobStore(str(tmp_path))
+    key = store.put(b"report")
+    with store.temporary() as file:
+        file.write(b"partial")
+    assert list(store.keys(time.time() + 1)) == [key]
+    assert files(store.directory) == [os.path.join(key[:2], key)]
@@ -0,0 +1,59 @@
+from app.services.copy_service import CopyDecoder, SIGNATURE, PG_EPOCH_US
+
+import struct
+import pytest
+
+STORES = ["a" * 36, "b" * 36, "short-id"]
+
+
+def field(value: bytes):
+    if value is None:
+        return struct.pack(">i", -1)
+    return struct.pack(">i", len(value)) + value
+
+
+def row(store_id, timestamp, status):
+    return struct.pack(">h", 3) + b"".join((
+        field(None if store_id is None else store_id.encode()),
+        field(None if timestamp is None else struct.pack(">q", timestamp - PG_EPOCH_US)),
+        field(None if status is None else bytes([status])),
+    ))
+
+
+def stream(rows: list):
+    return SIGNATURE + struct.pack(">ii", 0, 0) + b"".join(row(*values) for values in rows) + struct.pack(">h", -1)
+
+
+ROWS = [
+    (STORES[0], 1_700_000_000_000_000, 1),
+    (STORES[0], 1_700_000_060_000_000, 0),
+    (STORES[0], None, 1),
+    (STORES[1], 1_700_000_120_000_000, None),
+    (STORES[1], 1_700_000_180_000_000, 1),
+    (None, 1_700_000_240_000_000, 1),
+    (STORES[2], 1_700_000_300_000_000, 0),
+]
+EXPECTED = [(0, ROWS[0][1], 1), (0, ROWS[1][1], 0), (1, ROWS[4][1], 1), (2, ROWS[6][1], 0)]
+
+
+def decode(data: bytes, chunk_size: int):
+    decoder = CopyDecoder(STORES)
+    polls = []
+    for i in range(0, len(data), chunk_size):
+        codes, timestamps, statuses = decoder.decode(data[i:i + chunk_size])
+        polls.extend(zip(codes.tolist(), timestamps.tolist(), statuses.tolist()))
+    return decoder, polls
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1 << 20])
+def test_null_fields_are_skipped(chunk_size):
+    decoder, polls = decode(stream(ROWS), chunk_size)
+    assert decoder.done and not decoder.rest
+    assert polls == EXPECTED
+
+
+def test_unknown_stores_are_dropped():
+    decoder = CopyDecoder(STORES[:1])
+    codes, timestamps, statuses = decoder.decode(stream(ROWS))
+    assert decoder.done
+    assert codes.tolist() == [0, 0]
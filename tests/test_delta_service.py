@@ -0,0 +1,61 @@
+from app.services.delta_service import DeltaState, DeltaStoreService, SlidingReport, dump_state, NEXT_POLLS_COUNT
+from app.services.calendar_service import to_epoch
+
+from collections import Counter
+from datetime import timedelta
+import random
+import pytest
+
+from conftest import DST_DATES
+
+
+# Slide a base state to created_at like process_delta, with polls from the list instead of the database
+def slide(base: DeltaState, created_at, polls: list):
+
+    tail = [poll for poll in polls if base.until < to_epoch(poll.timestamp) <= to_epoch(created_at)]
+    sliding = SlidingReport(base, created_at, tail)
+
+    for column, limit in enumerate(sliding.window.time_limit):
+        sliding.age(column, [poll for poll in polls if sliding.old_limits[column] <= to_epoch(poll.timestamp) < limit])
+
+        pending = sliding.pending(column)
+        while pending:
+            queries = []
+            for store_id, start in sorted(pending.items()):
+                queries += [
+                    poll for poll in polls
+                    if poll.store_id == store_id and start <= to_epoch(poll.timestamp) <= base.created
+                ][:NEXT_POLLS_COUNT]
+            sliding.age(column, queries)
+
+            counts = Counter(query.store_id for query in queries)
+            pending = {store_id: start for store_id, start in sliding.pending(column).items() if counts[store_id] == NEXT_POLLS_COUNT}
+
+    sliding.replay([poll for poll in polls if poll.store_id in sliding.replayed and created_at - timedelta(days=7) <= poll.timestamp <= created_at])
+    return sliding.finish()
+
+
+def assert_same_reports(got: dict, expected: dict):
+    for store_id in set(got) | set(expected):
+        got_report = list(got[store_id].report) if store_id in got else [0] * 6
+        expected_report = list(expected[store_id].report) if store_id in expected else [0] * 6
+        assert got_report == pytest.approx(expected_report, abs=1e-6), store_id
+
+
+# Chains of delta reports a few minutes to hours apart equal full reports, also for stores with overlapping or overnight hours
+@pytest.mark.parametrize("seed", range(8))
+def test_delta_reports_match_full_reports(seed, random_polls, full_report):
+
+    rng = random.Random(seed)
+    start = DST_DATES[seed % len(DST_DATES)]
+    polls = random_polls(seed, start - timedelta(days=10), start + timedelta(days=4), stores=60)
+
+    created_at = start + timedelta(hours=rng.uniform(-24, 24))
+    stores = full_report(polls, created_at, DeltaStoreService)
+
+    for _ in range(8):
+        base = DeltaState(dump_state(stores, to_epoch(created_at), to_epoch(created_at), None))
+        created_at += timedelta(minutes=rng.choice([1, 7, 30, 61, 90]), seconds=rng.randint(0, 59))
+
+        stores = slide(base, created_at, polls)
+        assert_same_reports(stores, full_report(polls, created_at))
@@ -0,0 +1,294 @@
+from app.services import file_service, processor_service, snapshot_service
+from app.services.processor_service import QueryProcessor, ShardedQueryProcessor
+from app.services.store_service import StoreService, ReportArray
+from app.services.timeline_service import StoreTimeline, DEFAULT_WINDOWS
+from app.services.batch_service import BatchPass
+from app.services.copy_service import CopyDecoder, SIGNATURE, PG_EPOCH_US
+from app.services.sql_service import report_statement, report_parameters
+from app.services.snapshot_service import snapshot_polls, write_day, write_manifest
+from app.services.calendar_service import StoreCalendar, ZoneOffsets, to_epoch, from_epoch, time_to_micros
+from app.services.metadata_service import store_metadata, DEFAULT_TIMEZONE
+from app.services.blob_service import LocalBlobStore
+from app.services.file_service import report_rows, read_report
+from app.utils import StatusEnum, ReportFormatEnum
+from app.db import get_db
+from app.core import settings
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from types import SimpleNamespace
+import asyncio, random, struct
+import pytest
+
+from sqlalchemy import text
+
+from conftest import DST_DATES, TIMEZONES
+
+ENGINES = ["python", "numpy"]
+
+# Polls and store hours of the report statement given as arrays instead of read from the tables
+SQL_POLLS = """
+    polls AS (
+        SELECT * FROM unnest(
+            CAST(:ids AS bigint[]), CAST(:store_ids AS text[]), CAST(:actives AS boolean[]), CAST(:utcs AS bigint[]), CAST(:timezones AS text[])
+        ) AS p(id, store_id, active, utc, timezone_str)
+    ),
+    hours AS (
+        SELECT * FROM unnest(
+            CAST(:hour_ids AS bigint[]), CAST(:hour_stores AS text[]), CAST(:days AS integer[]), CAST(:hour_starts AS bigint[]), CAST(:hour_ends AS bigint[])
+        ) AS h(id, store_id, day_of_week, hour_start, hour_end)
+    ),
+"""
+
+
+# Report weeks around DST changes, with overlapping and overnight store hours
+# Each seed draws other stores and report times, every week of a report holds a transition of some of its zones
+@pytest.fixture(params=range(12))
+def week(request, random_polls):
+
+    seed = request.param
+    rng = random.Random(seed)
+    start = DST_DATES[seed % len(DST_DATES)]
+    polls = random_polls(seed, start - timedelta(days=9), start + timedelta(days=3), stores=30)
+    times = [start + timedelta(hours=rng.uniform(-48, 48)) for _ in range(3)]
+
+    # Reports whose day or hour window starts within an hour or two of a transition, where local and UTC lengths differ
+    lo, hi = to_epoch(start - timedelta(days=3)), to_epoch(start)
+    transitions = sorted({t for timezone_str in TIMEZONES for t in ZoneOffsets(timezone_str, lo, hi).starts[1:]})
+    for _ in range(3):
+        transition = from_epoch(rng.choice(transitions))
+        times.append(transition + rng.choice([timedelta(days=1), timedelta(hours=1)]) + timedelta(minutes=rng.uniform(-120, 120)))
+
+    return polls, times
+
+
+# Fresh stores of the report at created_at and its polls in the order they are fetched, like initialize_store_objects
+def report_stores(polls: list, created_at):
+
+    week = [poll for poll in polls if created_at - timedelta(days=7) <= poll.timestamp <= created_at]
+    store_ids = list(dict.fromkeys(poll.store_id for poll in week))
+
+    reports, stores = ReportArray(len(store_ids)), {}
+    for ordinal, store_id in enumerate(store_ids):
+        stores[store_id] = StoreService(store_id, created_at, store_metadata.get_timezone(store_id, DEFAULT_TIMEZONE), reports, ordinal)
+        stores[store_id].load_store_hours()
+
+    return stores, week
+
+
+def assert_same_reports(stores: dict, expected: dict):
+    assert set(stores) == set(expected)
+    for store_id, store in expected.items():
+        assert list(stores[store_id].report) == pytest.approx(list(store.report), abs=1e-6), store_id
+
+
+# Binary COPY stream of polls with the columns of COPY_QUERY
+def copy_stream(polls: list):
+
+    def field(value: bytes):
+        return struct.pack(">i", len(value)) + value
+
+    rows = (
+        struct.pack(">h", 3) + field(poll.store_id.encode()) +
+        field(struct.pack(">q", to_epoch(poll.timestamp) - PG_EPOCH_US)) + field(bytes([poll.status == StatusEnum.active]))
+        for poll in polls
+    )
+    return SIGNATURE + struct.pack(">ii", 0, 0) + b"".join(rows) + struct.pack(">h", -1)
+
+
+# Cursor of write_day answering its COPY of one day from a list of polls
+class DayCursor:
+
+    def __init__(self, polls: list):
+        self.polls = polls
+
+    def mogrify(self, query: str, parameters: dict):
+        self.day = parameters
+        return query.encode()
+
+    def copy_expert(self, query: str, sink):
+        polls = [poll for poll in self.polls if self.day["start"] <= poll.timestamp < self.day["end"]]
+        data = copy_stream(polls)
+        for i in range(0, len(data), 4096):
+            sink.write(memoryview(data[i:i + 4096]))
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_query_processor(engine, week, full_report, monkeypatch):
+
+    monkeypatch.setattr(settings, "ENGINE", engine)
+    polls, times = week
+
+    for created_at in times:
+        stores, queries = report_stores(polls, created_at)
+        processor = QueryProcessor(stores, created_at)
+        for i in range(0, len(queries), 500):
+            processor.feed(queries[i:i + 500])
+        processor.finish()
+
+        assert_same_reports(stores, full_report(polls, created_at))
+
+
+# Shards run in threads instead of worker processes, queries and decoded polls are split and merged back the same way
+@pytest.mark.parametrize("engine", ENGINES)
+@pytest.mark.parametrize("decoded", [False, True])
+def test_sharded_processor(engine, decoded, week, full_report, monkeypatch):
+
+    monkeypatch.setattr(settings, "ENGINE", engine)
+    monkeypatch.setattr(processor_service, "get_executor", lambda: ThreadPoolExecutor(max_workers=1))
+    polls, times = week
+
+    for created_at in times:
+        stores, queries = report_stores(polls, created_at)
+        processor = ShardedQueryProcessor(stores, created_at, 3)
+        if decoded:
+            decoder = CopyDecoder(list(stores))
+            processor.feed_polls(*decoder.decode(copy_stream(queries)))
+        else:
+            processor.feed(queries)
+        asyncio.run(processor.dispatch())
+        processor.finish()
+
+        assert_same_reports(stores, full_report(polls, created_at))
+
+
+# Polls of the COPY fetch path, decoded from a binary stream cut into chunks that split rows
+@pytest.mark.parametrize("engine", ENGINES)
+def test_copy_stream(engine, week, full_report, monkeypatch):
+
+    monkeypatch.setattr(settings, "ENGINE", engine)
+    polls, times = week
+
+    for created_at in times:
+        stores, queries = report_stores(polls, created_at)
+        processor = QueryProcessor(stores, created_at)
+        decoder = CopyDecoder(list(stores))
+
+        data = copy_stream(queries)
+        for i in range(0, len(data), 1000):
+            codes, timestamps, statuses = decoder.decode(data[i:i + 1000])
+            if len(codes):
+                processor.feed_polls(codes, timestamps, statuses)
+        processor.finish()
+
+        assert decoder.done and not decoder.rest
+        assert_same_reports(stores, full_report(polls, created_at))
+
+
+# Polls of the snapshot fetch path, read from day files written like ingestion writes them
+@pytest.mark.parametrize("engine", ENGINES)
+def test_snapshot(engine, week, full_report, monkeypatch, tmp_path):
+
+    monkeypatch.setattr(settings, "ENGINE", engine)
+    monkeypatch.setattr(settings, "SNAPSHOT_DIR", str(tmp_path))
+    polls, times = week
+
+    ordered = sorted(polls, key=lambda poll: (poll.store_id, poll.timestamp))
+    days = sorted({poll.timestamp.date() for poll in polls})
+    for day in days:
+        write_day(DayCursor(ordered), str(tmp_path), day)
+    write_manifest(str(tmp_path), {"watermark": None, "days": [day.isoformat() for day in days]})
+
+    for created_at in times:
+        stores, _ = report_stores(polls, created_at)
+        processor = QueryProcessor(stores, created_at)
+
+        async def on_chunk(codes, timestamps, statuses):
+            processor.feed_polls(codes, timestamps, statuses)
+
+        asyncio.run(snapshot_polls(list(stores), created_at, on_chunk))
+        processor.finish()
+
+        assert_same_reports(stores, full_report(polls, created_at))
+
+
+# One replay of all polls from before the earliest week answers every report time
+def test_timelines(week, full_report):
+
+    polls, times = week
+    start = min(times) - timedelta(days=7)
+
+    timelines = {}
+    for poll in polls:
+        if poll.timestamp >= start:
+            timeline = timelines.get(poll.store_id)
+            if timeline is None:
+                timeline = timelines[poll.store_id] = StoreTimeline(poll.store_id, start, store_metadata.get_timezone(poll.store_id, DEFAULT_TIMEZONE))
+                timeline.load_store_hours()
+                timeline.calendar = StoreCalendar(timeline.store_hours, timeline.timezone, to_epoch(poll.timestamp))
+            timeline.process_query(poll)
+
+    for created_at in times:
+        end = to_epoch(created_at)
+        limits = [end - length for _, length in DEFAULT_WINDOWS]
+        expected = full_report(polls, created_at)
+
+        for store_id, store in expected.items():
+            minutes = timelines[store_id].window_minutes(limits[0], end, limits)
+            assert minutes == pytest.approx(list(store.report), abs=1e-6), store_id
+
+
+# All report times of a batch in one pass, rows as written to the report files
+def test_batch_pass(week, full_report, monkeypatch, tmp_path):
+
+    monkeypatch.setattr(file_service, "blob_store", LocalBlobStore(str(tmp_path)))
+    polls, times = week
+
+    reports = [SimpleNamespace(id=f"report-{k}", created_at=created_at, format=ReportFormatEnum.csv) for k, created_at in enumerate(times)]
+    batch = BatchPass(reports)
+
+    start, end = min(times) - timedelta(days=7), max(times)
+    for poll in sorted(polls, key=lambda poll: (poll.store_id, poll.timestamp)):
+        if start <= poll.timestamp <= end:
+            batch.feed(poll)
+    batch.flush()
+
+    for k, report in enumerate(batch.reports):
+        report_file = batch.close(k)
+        rows = list(read_report(file_service.blob_store.read(report_file.store()), ReportFormatEnum.csv))
+        report_file.discard()
+
+        expected = [list(row) for row in report_rows(full_report(polls, report.created_at))]
+        assert sorted(rows) == sorted(expected)
+
+
+# The SQL engine runs the statement of process_with_sql in Postgres, store hours keep their list order as ids
+def test_sql_engine(week, full_report, database):
+
+    polls, times = week
+
+    async def run(stores: dict, queries: list, created_at):
+        hours = [
+            (store_id, day_of_week, time_to_micros(start), time_to_micros(end))
+            for store_id, store in stores.items()
+            for day_of_week, ranges in store.store_hours.items()
+            for start, end in ranges
+        ]
+        params = report_parameters(stores, created_at) | {
+            "ids": list(range(len(queries))),
+            "store_ids": [poll.store_id for poll in queries],
+            "actives": [poll.status == StatusEnum.active for poll in queries],
+            "utcs": [to_epoch(poll.timestamp) for poll in queries],
+            "timezones": [stores[poll.store_id].timezone for poll in queries],
+            "hour_ids": list(range(len(hours))),
+            "hour_stores": [hour[0] for hour in hours],
+            "days": [hour[1] for hour in hours],
+            "hour_starts": [hour[2] for hour in hours],
+            "hour_ends": [hour[3] for hour in hours],
+        }
+        async for db in get_db():
+            result = await db.execute(text(report_statement(SQL_POLLS)), params)
+            for store_id, _, *values in result:
+                stores[store_id].report = values
+
+    # Pooled connections belong to the event loop, so every report time runs in the same one
+    async def run_all():
+        reports = []
+        for created_at in times:
+            stores, queries = report_stores(polls, created_at)
+            await run(stores, queries, created_at)
+            reports.append((stores, created_at))
+        return reports
+
+    for stores, created_at in asyncio.run(run_all()):
+        assert_same_reports(stores, full_report(polls, created_at))
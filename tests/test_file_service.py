@@ -0,0 +1,99 @@
+from app.services import file_service
+from app.services.blob_service import LocalBlobStore
+from app.services.copy_service import SIGNATURE
+from app.services.file_service import ReportFile, write_report, read_report, convert_report, HEADINGS
+from app.utils import ReportFormatEnum
+
+import gzip, io, os, struct
+import pytest
+
+ROWS = [["a" * 36, 60, 20, 150, 0, 4, 18], ["short-id", 0, 0, 0, 60, 24, 168], ["b" * 36, 7, 1, 2, 53, 23, 166]]
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = LocalBlobStore(str(tmp_path / "blobs"))
+    monkeypatch.setattr(file_service, "blob_store", store)
+    return store
+
+
+def files(directory):
+    return sorted(os.path.relpath(os.path.join(root, name), directory) for root, _, names in os.walk(directory) for name in names)
+
+
+# Tuples of a binary COPY stream of report rows
+def decode_copy(data: bytes):
+
+    assert data[:11] == SIGNATURE
+    pos, rows = 19, []
+    while True:
+        (fields,) = struct.unpack_from(">h", data, pos)
+        pos += 2
+        if fields == -1:
+            break
+        values = []
+        for _ in range(fields):
+            (length,) = struct.unpack_from(">i", data, pos)
+            values.append(data[pos + 4:pos + 4 + length])
+            pos += 4 + length
+        rows.append([values[0].decode(), values[1].decode()] + [struct.unpack(">i", value)[0] for value in values[2:]])
+
+    assert pos == len(data)
+    return rows
+
+
+@pytest.mark.parametrize("format", list(ReportFormatEnum))
+def test_write_report_round_trip(format):
+    sink = io.BytesIO()
+    write_report(iter(ROWS), format, sink)
+    assert list(read_report(sink.getvalue(), format)) == ROWS
+
+
+def test_csv_is_written_to_the_sink():
+    sink = io.BytesIO()
+    write_report(ROWS, ReportFormatEnum.csv_gzip, sink)
+    text = gzip.decompress(sink.getvalue()).decode()
+    assert text.splitlines()[0] == ",".join(HEADINGS)
+    assert len(text.splitlines()) == len(ROWS) + 1
+
+
+def test_convert_report():
+    sink = io.BytesIO()
+    write_report(ROWS, ReportFormatEnum.csv, sink)
+    parquet = convert_report(sink.getvalue(), ReportFormatEnum.csv, ReportFormatEnum.parquet)
+    assert list(read_report(parquet, ReportFormatEnum.parquet)) == ROWS
+
+
+def test_report_file_is_stored_with_its_row_spool(store):
+
+    report_file = ReportFile("report", ReportFormatEnum.csv, store_rows=True)
+    report_file.write_rows(ROWS[:2])
+    report_file.write_rows(ROWS[2:])
+    key = report_file.store()
+
+    assert report_file.count == len(ROWS)
+    assert list(read_report(store.read(key), ReportFormatEnum.csv)) == ROWS
+    assert decode_copy(report_file.spool.read()) == [["report"] + row for row in ROWS]
+
+    report_file.discard()
+    assert files(store.directory) == [os.path.join(key[:2], key)]
+
+
+def test_identical_report_files_share_a_blob(store):
+
+    keys = []
+    for report_id in ("first", "second"):
+        report_file = ReportFile(report_id, ReportFormatEnum.parquet)
+        report_file.write_rows(ROWS)
+        keys.append(report_file.store())
+        report_file.discard()
+
+    assert keys[0] == keys[1]
+    assert files(store.directory) == [os.path.join(keys[0][:2], keys[0])]
+
+
+def test_discard_removes_temporaries(store):
+    report_file = ReportFile("report", ReportFormatEnum.arrow, store_rows=True)
+    report_file.write_rows(ROWS)
+    report_file.discard()
+    assert files(store.directory) == []
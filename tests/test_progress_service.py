@@ -0,0 +1,58 @@
+from app.services import progress_service
+from app.services.progress_service import JobProgress, JobCancelled, SERVER_ID
+from app.utils import ReportStatusEnum
+
+from sqlalchemy.dialects import postgresql
+
+import asyncio
+import pytest
+
+
+# Session answering progress writes with the rows still owned by this server
+def fake_get_db(owned: dict, statements: list):
+
+    class Session:
+        async def execute(self, statement):
+            statements.append(str(statement.compile(dialect=postgresql.dialect())))
+
+            class Result:
+                def fetchall(self):
+                    return list(owned.items())
+
+            return Result()
+
+        async def commit(self):
+            pass
+
+    async def get_db():
+        yield Session()
+
+    return get_db
+
+
+def test_progress_is_a_heartbeat_of_owned_reports(monkeypatch):
+    statements = []
+    monkeypatch.setattr(progress_service, "get_db", fake_get_db({"a": ReportStatusEnum.Running}, statements))
+
+    asyncio.run(JobProgress(["a"]).update(10, force=True))
+
+    assert "reports.owner = " in statements[0]
+    assert "heartbeat_at=now()" in statements[0]
+
+
+def test_reports_taken_over_by_another_server_stop(monkeypatch):
+    owned = {"a": ReportStatusEnum.Running}
+    monkeypatch.setattr(progress_service, "get_db", fake_get_db(owned, []))
+
+    progress = JobProgress(["a", "b"])
+    asyncio.run(progress.update(10, force=True))
+    assert progress.cancelled == {"b"}
+
+    owned.clear()
+    with pytest.raises(JobCancelled):
+        asyncio.run(progress.update(20, force=True))
+
+
+def test_workers_inherit_the_server_id():
+    import os
+    assert os.environ["REPORT_SERVER_ID"] == SERVER_ID
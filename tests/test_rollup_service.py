@@ -0,0 +1,80 @@
+from app.services.rollup_service import HourlyStoreService, raw_ranges, combine_rollups
+from app.services.store_service import StoreService, ReportArray
+from app.services.calendar_service import to_epoch, HOUR_US
+from app.services.metadata_service import store_metadata, DEFAULT_TIMEZONE
+
+from datetime import timedelta
+import random
+import pytest
+
+from conftest import DST_DATES
+
+
+# Rollup rows of every store like two runs of refresh_rollups, the second continuing from the state before the watermark's hour
+def rollups(polls: list, watermark):
+
+    start = to_epoch(watermark) - to_epoch(watermark) % HOUR_US
+    stores, rows = {}, {}
+
+    for run in (0, 1):
+        for poll in polls:
+            if (to_epoch(poll.timestamp) <= to_epoch(watermark)) if run == 0 else (to_epoch(poll.timestamp) >= start):
+                store = stores.get((run, poll.store_id))
+                if store is None:
+                    store = stores[run, poll.store_id] = HourlyStoreService(poll.store_id, watermark, store_metadata.get_timezone(poll.store_id, DEFAULT_TIMEZONE))
+                    store.load_store_hours()
+                    states = [row for hour, row in sorted(rows.get(poll.store_id, {}).items()) if hour < start]
+                    if run and states:
+                        store.restore(states[-1][2])
+                store.process_query(poll)
+
+        for (_, store_id), store in stores.items():
+            store_rows = rows.setdefault(store_id, {})
+            for hour, bucket in store.buckets.items():
+                if run == 0 or hour >= start:
+                    store_rows[hour] = bucket
+
+    return rows
+
+
+# Reports from the rollup rows and the raw polls of the ranges each store asks for
+def rollup_report(polls: list, rows: dict, store_ids: list, created_at):
+
+    reports, stores = ReportArray(len(store_ids)), {}
+    for ordinal, store_id in enumerate(store_ids):
+        store = stores[store_id] = StoreService(store_id, created_at, store_metadata.get_timezone(store_id, DEFAULT_TIMEZONE), reports, ordinal)
+        store.load_store_hours()
+
+        week_hour, last_hour = (limit - limit % HOUR_US for limit in (store.window.time_limit[0], store.window.created))
+        store_rows = [(hour, *bucket) for hour, bucket in sorted(rows.get(store_id, {}).items()) if week_hour <= hour < last_hour]
+
+        ranges = raw_ranges(store, {row[0]: row[3] for row in store_rows})
+        queries = [poll for poll in polls if poll.store_id == store_id and any(start <= to_epoch(poll.timestamp) < end for start, end in ranges)]
+        combine_rollups(store, store_rows, ranges, queries)
+
+    return stores
+
+
+# Reports summed from rollups equal full replays, around DST changes and with overlapping or overnight store hours
+# Most stores with overlapping hours replay their week, the others only a few hours
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("overlapping", [False, True])
+def test_rollup_reports_match_full_reports(seed, overlapping, random_polls, full_report):
+
+    rng = random.Random(seed)
+    start = DST_DATES[seed % len(DST_DATES)]
+    polls = random_polls(seed, start - timedelta(days=12), start + timedelta(days=5), stores=40, overlapping=overlapping)
+    store_ids = list(dict.fromkeys(poll.store_id for poll in polls))
+
+    rows = rollups(polls, start + timedelta(days=rng.uniform(-4, 4)))
+
+    for _ in range(6):
+        created_at = start + timedelta(days=rng.uniform(-3, 3))
+        if rng.random() < 0.3:
+            created_at = created_at.replace(minute=0, second=0, microsecond=0)
+
+        got = rollup_report(polls, rows, store_ids, created_at)
+        expected = full_report(polls, created_at)
+        for store_id in store_ids:
+            expected_report = list(expected[store_id].report) if store_id in expected else [0] * 6
+            assert list(got[store_id].report) == pytest.approx(expected_report, abs=1e-6), (store_id, created_at)
@@ -0,0 +1,67 @@
+from app.services.row_service import query_rows
+
+from sqlalchemy.dialects import postgresql
+
+import asyncio
+import pytest
+
+RECORDS = [("a" * 36, 5), ("b" * 36, 4), ("c" * 36, 4)]
+
+
+# Records the compiled queries and answers with the records after the cursor, like Postgres would
+class FakeDb:
+
+    def __init__(self, records: list):
+        self.records = records
+        self.queries = []
+
+    async def execute(self, query):
+        self.queries.append(str(query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})))
+        limit = query._limit_clause.value
+        records = self.records[self.offset:self.offset + limit]
+
+        class Result:
+            def fetchall(self):
+                return records
+
+        return Result()
+
+
+def page(db, offset, **kwargs):
+    db.offset = offset
+    return asyncio.run(query_rows(db, "report", fields="store_id,downtime_last_day", sort="-downtime_last_day", limit=1, **kwargs))
+
+
+def test_cursor_pages_through_the_same_query():
+    db = FakeDb(RECORDS)
+    rows, cursor = page(db, 0, filters=["downtime_last_day:gte:2"])
+    assert rows == [{"store_id": "a" * 36, "downtime_last_day": 5}]
+    assert cursor is not None
+
+    rows, cursor = page(db, 1, filters=[" downtime_last_day:gte:2"], after=cursor)
+    assert rows == [{"store_id": "b" * 36, "downtime_last_day": 4}]
+    assert "(report_rows.downtime_last_day, report_rows.store_id) < (5, 'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa')" in db.queries[-1]
+
+
+@pytest.mark.parametrize("changed", [
+    {"sort": "downtime_last_day"},
+    {"sort": "-uptime_last_day"},
+    {"filters": ["downtime_last_day:gte:3"]},
+    {"filters": []},
+    {"report_id": "other"},
+])
+def test_cursor_of_another_query_is_rejected(changed):
+    db = FakeDb(RECORDS)
+    _, cursor = page(db, 0, filters=["downtime_last_day:gte:2"])
+
+    arguments = {"fields": None, "filters": ["downtime_last_day:gte:2"], "sort": "-downtime_last_day", "limit": 1, "after": cursor}
+    report_id = changed.pop("report_id", "report")
+    arguments.update(changed)
+
+    with pytest.raises(ValueError):
+        asyncio.run(query_rows(db, report_id, **arguments))
+
+
+def test_malformed_cursor_is_rejected():
+    with pytest.raises(ValueError):
+        asyncio.run(query_rows(FakeDb(RECORDS), "report", after="not a cursor"))
@@ -0,0 +1,89 @@
+from app.utils.streaming import blob_response
+
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+import gzip
+import pytest
+
+BLOB = b"store_id,uptime_last_hour\n" + b"".join(b"%036d,%d\n" % (i, i % 60) for i in range(5000))
+ETAG = '"report-csv"'
+
+app = FastAPI()
+
+
+@app.get("/blob")
+async def get_blob(request: Request):
+    return blob_response(request, BLOB, "report.csv", etag=ETAG)
+
+
+@app.get("/file")
+async def get_file(request: Request):
+    return blob_response(request, request.app.state.path, "report.csv", etag=ETAG)
+
+
+@app.get("/stored-gzip")
+async def get_stored_gzip(request: Request):
+    return blob_response(request, gzip.compress(BLOB), "report.csv", etag=ETAG, encoding="gzip")
+
+
+@pytest.fixture(params=["/blob", "/file"])
+def path(request, tmp_path):
+    blob_path = tmp_path / "blob"
+    blob_path.write_bytes(BLOB)
+    app.state.path = str(blob_path)
+    return request.param
+
+
+client = TestClient(app)
+
+
+def test_identity(path):
+    response = client.get(path, headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    assert response.content == BLOB
+    assert response.headers["etag"] == ETAG
+    assert response.headers["vary"] == "Accept-Encoding"
+
+
+def test_gzip_has_its_own_etag(path):
+    response = client.get(path, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["etag"] == '"report-csv-gzip"'
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.content == BLOB
+
+
+def test_if_none_match_per_encoding(path):
+    assert client.get(path, headers={"Accept-Encoding": "gzip", "If-None-Match": '"report-csv-gzip"'}).status_code == 304
+    assert client.get(path, headers={"Accept-Encoding": "gzip", "If-None-Match": ETAG}).status_code == 200
+    assert client.get(path, headers={"Accept-Encoding": "identity", "If-None-Match": ETAG}).status_code == 304
+    assert client.get(path, headers={"Accept-Encoding": "identity", "If-None-Match": '"report-csv-gzip"'}).status_code == 200
+
+
+def test_range_of_identity_content(path):
+    response = client.get(path, headers={"Accept-Encoding": "gzip", "Range": "bytes=10-99"})
+    assert response.status_code == 206
+    assert response.content == BLOB[10:100]
+    assert response.headers["etag"] == ETAG
+    assert "content-encoding" not in response.headers
+    assert response.headers["content-range"] == f"bytes 10-99/{len(BLOB)}"
+
+
+def test_if_range_with_gzip_etag_sends_full_content(path):
+    response = client.get(path, headers={"Accept-Encoding": "identity", "Range": "bytes=10-99", "If-Range": '"report-csv-gzip"'})
+    assert response.status_code == 200
+    assert response.content == BLOB
+
+
+def test_unsatisfiable_range(path):
+    response = client.get(path, headers={"Accept-Encoding": "identity", "Range": f"bytes={len(BLOB)}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(BLOB)}"
+
+
+def test_stored_gzip_has_the_gzip_etag():
+    response = client.get("/stored-gzip", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["etag"] == '"report-csv-gzip"'
+    assert response.content == BLOB